@@ -28,11 +28,19 @@ if [ ! -e ${XNAT_ARCHIVE} -a ! -e $(dirname ${XNAT_ARCHIVE}) ]; then
   exit 1
 fi
 
+zips=()
 for zip in ${ZIPFOLDER}/*.zip; do 
   scanid=$(basename ${zip} .zip)
   if [ -e ${XNAT_ARCHIVE}/${scanid} ]; then 
     continue
   fi
-  xnat-upload.py --credfile ${CREDFILE} ${STUDYNAME} ${zip} 
+  zips+=("${zip}")
 done
 
+if [ ${#zips[@]} -eq 0 ]; then
+  exit 0
+fi
+
+# upload them all in one batch (and one login)
+xnat-upload.py --credfile ${CREDFILE} --parallel 2 ${STUDYNAME} "${zips[@]}"
+
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+Benchmarks dm-check-headers.py's header comparisons over a study's exams,
+comparing the original compare_headers() against gold standards compiled once
+into comparison plans (compile_standards() and check_headers()).
+
+Usage:
+    bench_check_headers.py [options] <standards/> <examsdir/>
+
+Arguments:
+    <standards/>        Folder with a subfolder of gold standard dicoms per tag
+    <examsdir/>         Folder with a subfolder for each exam to check
+
+Options:
+    --header-index FILE Database of dicom headers to read headers from
+    --repeat N          Number of times to repeat each measurement, the best
+                        time is reported [default: 3]
+
+DETAILS
+    All headers are read before timing starts, so only the comparisons are
+    measured. The mismatches found by both implementations are checked to be
+    the same.
+"""
+from docopt import docopt
+import datman.headerindex
+import datman.scanid
+import datman.utils
+import glob
+import imp
+import numpy as np
+import os
+import time
+
+CHECK_HEADERS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'bin', 'dm-check-headers.py')
+
+
+def original_compare_headers(stdhdr, cmphdr, tolerances, ignore_headers):
+    """The original dm-check-headers.py compare_headers."""
+    stdhdr_names = stdhdr.dir()
+    cmphdr_names = cmphdr.dir()
+
+    headers = set(stdhdr_names).union(cmphdr_names).difference(ignore_headers)
+
+    mismatches = []
+
+    for header in headers:
+        if header not in stdhdr_names:
+            mismatches.append((header, None, cmphdr.get(header), None))
+            continue
+
+        if header not in cmphdr_names:
+            mismatches.append((header, stdhdr.get(header), None, None))
+            continue
+
+        stdval = stdhdr.get(header)
+        cmpval = cmphdr.get(header)
+
+        if header in tolerances.integer:
+            n = tolerances.integer[header]
+            stdval_rounded = np.round(float(stdval))
+            cmpval_rounded = np.round(float(cmpval))
+            if np.abs(stdval_rounded - cmpval_rounded) > n:
+                mismatches.append((header, stdval_rounded, cmpval_rounded, n))
+
+        elif header in tolerances.decimal:
+            n = tolerances.decimal[header]
+            stdval_rounded = round(float(stdval), n)
+            cmpval_rounded = round(float(cmpval), n)
+            if stdval_rounded != cmpval_rounded:
+                mismatches.append((header, stdval_rounded, cmpval_rounded, n))
+
+        elif str(cmpval) != str(stdval):
+            mismatches.append((header, stdval, cmpval, None))
+
+    return mismatches
+
+
+def load_exams(examsdir, index):
+    """Returns a list of (tag, headers) for every dicom in every exam."""
+    pairs = []
+    for examdir in glob.glob(os.path.join(examsdir, '*/')):
+        manifest = datman.utils.get_all_headers_in_folder(examdir, index=index)
+        for path, headers in manifest.iteritems():
+            ident, tag, series, description = datman.scanid.parse_filename(path)
+            pairs.append((tag, headers))
+    return pairs
+
+
+def best_of(repeat, func):
+    """Returns (result, seconds) of the fastest of <repeat> calls to func."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best[1]:
+            best = (result, elapsed)
+    return best
+
+
+def main():
+    arguments = docopt(__doc__)
+    repeat = int(arguments['--repeat'])
+    indexfile = arguments['--header-index']
+
+    check_headers = imp.load_source('check_headers', CHECK_HEADERS)
+    tolerances = check_headers.DEFAULT_TOLERANCES
+    ignored = check_headers.DEFAULT_IGNORED_HEADERS
+
+    index = indexfile and datman.headerindex.HeaderIndex(indexfile) or None
+    stdmap = check_headers.get_gold_standard_headers(
+        arguments['<standards/>'], index)
+    pairs = [(tag, hdr) for tag, hdr in load_exams(arguments['<examsdir/>'],
+                                                   index)
+             if tag in stdmap]
+
+    def run_original():
+        return [sorted(original_compare_headers(stdmap[tag][1], hdr,
+                                                tolerances, ignored))
+                for tag, hdr in pairs]
+
+    def run_plans():
+        plans = check_headers.compile_standards(stdmap, ignored, tolerances)
+        return [[tuple(m) for m in check_headers.check_headers(
+                     plans[tag][1], hdr)]
+                for tag, hdr in pairs]
+
+    original, original_secs = best_of(repeat, run_original)
+    planned, planned_secs = best_of(repeat, run_plans)
+    if original != planned:
+        print "WARNING: the mismatches found differ"
+
+    print "files,mismatches,original_s,plan_s,speedup"
+    print "{},{},{:.3f},{:.3f},{:.1f}".format(
+        len(pairs), sum(len(m) for m in planned), original_secs,
+        planned_secs, original_secs / max(planned_secs, 1e-6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Benchmarks the slice/TR statistics behind qc-html.py's spike plots, comparing
+the original TR-by-TR implementation against epi_spike_table().
+
+Usage:
+    bench_epi_spikes.py [options] [<image>]
+
+Arguments:
+    <image>             A 4D nifti to benchmark with. By default, a random
+                        image the size of a multiband resting state run is
+                        used (see --shape).
+
+Options:
+    --shape SHAPE       Shape of the random image, as X,Y,Z,T
+                        [default: 96,96,60,600]
+    --repeat N          Number of times to repeat each measurement, the best
+                        time is reported [default: 1]
+    --skip-original     Only time epi_spike_table() (the original
+                        implementation is quadratic in the number of TRs)
+"""
+from docopt import docopt
+from copy import copy
+import imp
+import nibabel as nib
+import numpy as np
+import os
+import time
+
+QC_HTML = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'bin', 'qc-html.py')
+
+def original_reorient_4d_image(image):
+    """The original qc-html.py reorient_4d_image."""
+    for i in np.arange(image.shape[3]):
+
+        if i == 0:
+            newimage = np.transpose(image[:, :, :, i], (2,0,1))
+            newimage = np.rot90(newimage, 2)
+
+        elif i == 1:
+            tmpimage = np.transpose(image[:, :, :, i], (2,0,1))
+            tmpimage = np.rot90(tmpimage, 2)
+            newimage = np.concatenate((newimage[...,np.newaxis],
+                                       tmpimage[...,np.newaxis]), axis=3)
+
+        else:
+            tmpimage = np.transpose(image[:, :, :, i], (2,0,1))
+            tmpimage = np.rot90(tmpimage, 2)
+            newimage = np.concatenate((newimage,
+                                       tmpimage[...,np.newaxis]), axis=3)
+
+    return copy(newimage)
+
+def original_spike_stats(image):
+    """The statistics from the original qc-html.py find_epi_spikes."""
+    image = original_reorient_4d_image(image)
+    x = image.shape[1]
+    z = image.shape[0]
+    t = image.shape[3]
+    c1 = int(np.round(x*0.25))
+    c2 = int(np.round(x*0.75))
+
+    spikecount = 0
+    for i in np.arange(z):
+        for j in np.arange(t):
+            sample = image[i, c1:c2, c1:c2, j]
+            mean = np.mean(sample)
+            sd = np.std(sample)
+            if j == 0:
+                v_mean = copy(mean)
+                v_sd = copy(sd)
+            else:
+                v_mean = np.hstack((v_mean, mean))
+                v_sd = np.hstack((v_sd, sd))
+        v_spikes = np.where(v_mean > np.mean(v_mean)+np.mean(v_sd))[0]
+        spikecount = spikecount + len(v_spikes)
+    return spikecount
+
+def measure(func, image, repeat):
+    """Returns (result, seconds) for the fastest of <repeat> calls."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = func(image)
+        elapsed = time.time() - start
+        if best is None or elapsed < best[1]:
+            best = (result, elapsed)
+    return best
+
+def main():
+    arguments = docopt(__doc__)
+    repeat    = int(arguments['--repeat'])
+
+    if arguments['<image>']:
+        image = nib.load(arguments['<image>']).get_data()
+    else:
+        shape = [int(n) for n in arguments['--shape'].split(',')]
+        image = np.random.RandomState(0).randint(0, 1000, size=shape)
+        image = image.astype(np.int16)
+
+    qc_html = imp.load_source('qc_html', QC_HTML)
+    table, secs = measure(qc_html.epi_spike_table, image, repeat)
+    spikes = int(table['spike'].sum())
+
+    print "shape,implementation,spikes,seconds"
+    print "{},epi_spike_table,{},{:.2f}".format(
+            'x'.join(map(str, image.shape)), spikes, secs)
+
+    if not arguments['--skip-original']:
+        spikes, secs = measure(original_spike_stats, image, repeat)
+        print "{},original,{},{:.2f}".format(
+                'x'.join(map(str, image.shape)), spikes, secs)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Benchmarks matching series descriptions to tags, comparing the uncompiled
+patterns of datman.utils.guess_tag() against a datman.utils.TagMatcher.
+
+Usage:
+    bench_guess_tag.py [options]
+
+Options:
+    --exportinfo FILE   Export info file to take tag patterns from (see
+                        xnat-extract.py), otherwise datman.utils.SERIES_TAGS_MAP
+                        is used.
+    --exams N           Number of exams to simulate [default: 1000]
+    --repeat N          Number of times to repeat each measurement, the best
+                        time is reported [default: 3]
+
+DETAILS
+    Each simulated exam has one series of each of a typical set of
+    SeriesDescriptions, mangled as xnat-extract.py does, so descriptions
+    repeat across exams the way they do within a study.
+"""
+from docopt import docopt
+import datman.utils
+import pandas as pd
+import time
+
+DESCRIPTIONS = [
+    "3-Plane Localizer", "Calibration Scan", "Sag T1 BRAVO", "Ax T2 FSE",
+    "Ax FLAIR", "Ax DTI 60 directions", "Axial Resting State fMRI",
+    "Back 1", "Back 2", "Imitate", "Observe", "EA Task Run 1",
+    "EA Task Run 2", "MRS sgACC TE 35", "MRS DLPFC TE 35", "TE6.5", "TE8.5",
+    "FA Map", "Screen Save", "ASSET Cal",
+]
+
+def measure(func, descriptions, repeat):
+    """Returns the fastest of <repeat> passes over <descriptions>."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for description in descriptions:
+            func(description)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    arguments = docopt(__doc__)
+    exams     = int(arguments['--exams'])
+    repeat    = int(arguments['--repeat'])
+
+    if arguments['--exportinfo']:
+        exportinfo = pd.read_table(arguments['--exportinfo'], sep='\s*',
+                engine="python")
+        tagmap = dict(zip(exportinfo['pattern'].tolist(),
+                          exportinfo['tag'].tolist()))
+    else:
+        tagmap = datman.utils.SERIES_TAGS_MAP
+
+    descriptions = [datman.utils.mangle(d) for d in DESCRIPTIONS] * exams
+
+    uncompiled = measure(lambda d: datman.utils.guess_tag(d, tagmap),
+            descriptions, repeat)
+    matcher = measure(datman.utils.TagMatcher(tagmap), descriptions, repeat)
+
+    print "descriptions,patterns,guess_tag_s,matcher_s,speedup"
+    print "{},{},{:.3f},{:.3f},{:.1f}".format(len(descriptions), len(tagmap),
+            uncompiled, matcher, uncompiled / max(matcher, 1e-6))
+
+if __name__ == '__main__':
+    main()
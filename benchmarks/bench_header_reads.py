@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Benchmarks reading dicom headers from exam folders, comparing full reads of
+each dicom against the header-only reads used by datman.utils.
+
+Usage:
+    bench_header_reads.py [options] <examdir>...
+
+Arguments:
+    <examdir>           Exam folder of series folders containing dicoms
+                        (e.g. an XNAT archive folder, or an unpacked exam)
+
+Options:
+    --repeat N          Number of times to repeat each measurement, the best
+                        time is reported [default: 3]
+
+DETAILS
+    For each exam, every file in every series folder is read twice: once
+    entirely with dicom.read_file(), and once with datman.utils.read_headers().
+    The bytes read (from /proc/self/io, so Linux only) and the wall time for
+    each mode is printed as a CSV table.
+
+    Note that the OS file cache will serve most reads after the first pass, so
+    bytes read here is the number of bytes requested by the reader, not the
+    number of bytes fetched from the disk or network.
+"""
+from docopt import docopt
+import datman.utils
+import dicom
+import os
+import time
+
+
+def bytes_read():
+    """Returns the number of bytes read by this process so far."""
+    for line in open('/proc/self/io'):
+        if line.startswith('rchar:'):
+            return int(line.split()[1])
+
+
+def exam_files(examdir):
+    files = []
+    for dirname, dirnames, filenames in os.walk(examdir):
+        files.extend(os.path.join(dirname, f) for f in filenames)
+    return files
+
+
+def full_read(path):
+    return dicom.read_file(path)
+
+
+def measure(reader, files, repeat):
+    """Returns (bytes read, seconds) for the fastest of <repeat> passes."""
+    best = None
+    for i in range(repeat):
+        start_bytes = bytes_read()
+        start = time.time()
+        for path in files:
+            try:
+                reader(path)
+            except dicom.filereader.InvalidDicomError:
+                pass
+        result = (bytes_read() - start_bytes, time.time() - start)
+        if best is None or result[1] < best[1]:
+            best = result
+    return best
+
+
+def main():
+    arguments = docopt(__doc__)
+    repeat = int(arguments['--repeat'])
+
+    print "exam,files,full_mb,full_s,header_mb,header_s,speedup"
+    for examdir in arguments['<examdir>']:
+        files = exam_files(examdir)
+        full_bytes, full_secs = measure(full_read, files, repeat)
+        hdr_bytes, hdr_secs = measure(datman.utils.read_headers, files, repeat)
+        print "{},{},{:.1f},{:.2f},{:.1f},{:.2f},{:.1f}".format(
+            os.path.basename(os.path.normpath(examdir)), len(files),
+            full_bytes / 1e6, full_secs, hdr_bytes / 1e6, hdr_secs,
+            full_secs / max(hdr_secs, 1e-6))
+
+if __name__ == '__main__':
+    main()
@@ -12,10 +12,14 @@ Options:
      --headers=LIST      Comma separated list of dicom header names to print.
      --oneseries         Only show one series (useful for just exam info)
      --showheaders       Just list all of the headers for each archive
+     --header-index FILE Database of dicom headers to consult (and update)
+                         rather than re-reading unchanged dicoms
+     -j,--jobs N         Number of series folders to scan at once [default: 1]
 """
 
 import datman
 import datman.utils
+import datman.headerindex
 import dicom
 import tarfile
 import zipfile
@@ -35,11 +39,16 @@ def main():
     from docopt import docopt
     import sys
     arguments = docopt(__doc__)
+    indexfile = arguments['--header-index']
+    index = indexfile and datman.headerindex.HeaderIndex(indexfile) or None
+    jobs = int(arguments['--jobs'])
 
     if arguments['--showheaders']:
         for archive in arguments['<archive>']:
             manifest = datman.utils.get_archive_headers(archive, 
-                                                        stop_after_first=False)
+                                                        stop_after_first=False,
+                                                        index=index,
+                                                        jobs=jobs)
             filepath, headers = manifest.items()[0] 
             print ",".join([archive,filepath])
             print "\t"+"\n\t".join(headers.dir())
@@ -51,7 +60,8 @@ def main():
 
     rows = []
     for archive in arguments['<archive>']:
-        manifest = datman.utils.get_archive_headers(archive)
+        manifest = datman.utils.get_archive_headers(archive, index=index,
+                                                    jobs=jobs)
         sortedseries = sorted(manifest.iteritems(), 
                               key = lambda x: x[1].get('SeriesNumber'))
         for path, dataset in sortedseries:
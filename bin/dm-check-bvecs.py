@@ -22,10 +22,16 @@ Options:
                             exam folders found in <examsdir/> must have this
                             text in their name.
     --verbose               Print mismatches to stdout as well as the log file
+
+DETAILS
+    The differences found in each exam are also recorded in
+    <logdir>/checks.db (see datman.checkdb), which is where qc-html.py reads
+    them from.
 """
 
 from docopt import docopt
 import datman as dm
+import datman.checkdb
 import difflib
 import glob
 import logging as log
@@ -58,6 +64,24 @@ def diff_files(examdir, standardsdir):
 
     return diffs 
 
+def get_mismatch_rows(diffs):
+    """
+    Returns the differences of an exam (a map from file -> diff, see
+    diff_files) as a list of (series, header, expected, actual, tolerance)
+    rows for datman.checkdb, one per changed line. The header is the file
+    type (bvec or bval), and a line is either expected (in the gold standard
+    only) or actual (in the exam file only).
+    """
+    rows = []
+    for path, diff in sorted(diffs.iteritems()):
+        series, ext = os.path.splitext(os.path.basename(path))
+        for line in diff.splitlines():
+            if line.startswith('+ '):
+                rows.append((series, ext[1:], line[2:], None, None))
+            else:
+                rows.append((series, ext[1:], None, line[2:], None))
+    return rows
+
 def main():
     arguments = docopt(__doc__)
     standardsdir = arguments['<standards/>']
@@ -86,11 +110,16 @@ def main():
     if filtertext: 
         globexpr = '*{}*'.format(filtertext)
 
+    checkdb = datman.checkdb.CheckDatabase(
+        os.path.join(logsdir, datman.checkdb.DB_NAME))
+
     for examdir in glob.glob('{}/{}/'.format(examsdir,globexpr)):
         if '_PHA_' in examdir:  # ignore phantoms
             continue
 
         diffs = diff_files(examdir, standardsdir)
+        checkdb.write('dm-check-bvecs', os.path.basename(os.path.normpath(examdir)),
+                      get_mismatch_rows(diffs))
 
         if not diffs: 
             continue
@@ -108,5 +137,7 @@ def main():
             log.info(message)
             fname.write(message + "\n")
 
+    checkdb.close()
+
 if __name__ == '__main__':
     main()
@@ -24,17 +24,47 @@ Options:
                             text in their name.
     --ignore-headers LIST   Comma delimited list of headers to ignore
     --verbose               Print mismatches to stdout as well as the log file
+    --header-index FILE     Database of dicom headers to consult (and update)
+                            rather than re-reading unchanged dicoms
+    -j, --jobs N            Number of dicom files to read at once [default: 1]
+    --cache FILE            Database of earlier results. Exams that are
+                            unchanged since they were last checked (against
+                            the same standards and settings) are skipped
+    -p, --processes N       Number of exams to check at once [default: 1]
+
+DETAILS
+    The mismatches of each exam are also recorded in <logdir>/checks.db (see
+    datman.checkdb), which is where qc-html.py reads them from.
+
+    With --cache, the results of checking each exam are recorded along with
+    fingerprints of the exam's files, the standards, and the ignored headers
+    and tolerances (the path, mtime and size of each file, so nothing is
+    read). An exam is checked again only if any of these have changed. If the
+    log file (or database rows) of a cached exam with mismatches are missing,
+    they are rewritten from the cache.
+
+    With --processes, exams are checked by a pool of processes (each reading
+    dicoms with --jobs threads), which is useful when first checking a
+    study's whole backlog.
 """
 
 import sys
 import collections
+import datetime
+import hashlib
+import json
+import multiprocessing
+import sqlite3
 from docopt import docopt
 import dicom as dcm
+import dicom.datadict
 import datman as dm
 import glob
 import logging as log
 import numpy as np
 import datman.utils
+import datman.checkdb
+import datman.headerindex
 import os.path
 
 DEFAULT_IGNORED_HEADERS = set([
@@ -141,8 +171,21 @@ DEFAULT_TOLERANCES = Tolerances(
     integer=INTEGER_TOLERANCES,
     decimal=DECIMAL_TOLERANCES)
 
+# A gold standard compiled for comparison (see compile_standard).
+#   names   -- the set of unignored header names in the standard
+#   ignored -- the set of ignored header names
+#   checks  -- a list of (header, kind, tolerance, expected, stdval) for each
+#              header in names, sorted by header. kind is 'integer', 'decimal'
+#              or None, and expected is the normalized standard value (the
+#              rounded float, or the str() of the value).
+ComparisonPlan = collections.namedtuple(
+    'ComparisonPlan', ['names', 'ignored', 'checks'])
 
-def get_gold_standard_headers(path):
+# dicom tag -> keyword names, see get_header_names
+TAG_NAMES = {}
+
+
+def get_gold_standard_headers(path, index=None, jobs=1):
     """Fetches the gold standard headers.
 
     Expects there to be subfolders named by the tag and containing a single
@@ -150,89 +193,154 @@ def get_gold_standard_headers(path):
 
     Returns a map from tag -> headers.
     """
-    manifest = dm.utils.get_all_headers_in_folder(path, recurse=True)
+    manifest = dm.utils.get_all_headers_in_folder(path, recurse=True,
+                                                  index=index, jobs=jobs)
     map = {os.path.basename(os.path.dirname(k)): (k, v)
            for (k, v) in manifest.items()}
     return map
 
 
-def compare_headers(stdhdr, cmphdr, tolerances=None, ignore_headers=None):
+def get_header_names(headers):
     """
-    Accepts two pydicom objects and prints out header value differences.
-
-    Headers in ignore set are ignored.
+    Returns the set of header names in a pydicom dataset.
 
-    Returns a tuple containing a list of mismatched headers (as a list of
-    Mismatch objects)
+    This is the same as set(headers.dir()), but the names of each dicom tag
+    are only looked up once (dir() is expensive).
     """
+    if not isinstance(headers, dcm.dataset.Dataset):
+        return set(headers.dir())
+
+    names = set()
+    for tag in headers.keys():
+        try:
+            names.update(TAG_NAMES[tag])
+        except KeyError:
+            TAG_NAMES[tag] = [n for n in dcm.datadict.all_names_for_tag(tag) if n]
+            names.update(TAG_NAMES[tag])
+    return names
 
+
+def compile_standard(stdhdr, tolerances=None, ignore_headers=None):
+    """
+    Compiles the gold standard headers <stdhdr> into a ComparisonPlan, so that
+    the work that depends only on the standard is done once rather than for
+    every header compared against it.
+    """
     tolerances = tolerances or DEFAULT_TOLERANCES
-    ignore_headers = ignore_headers or []
+    ignored = frozenset(ignore_headers or [])
+    names = frozenset(get_header_names(stdhdr).difference(ignored))
 
-    # dir() is expensive so we cache results here
-    stdhdr_names = stdhdr.dir()
-    cmphdr_names = cmphdr.dir()
+    checks = []
+    for header in sorted(names):
+        stdval = stdhdr.get(header)
 
-    # get the unignored headers
-    headers = set(stdhdr_names).union(cmphdr_names).difference(ignore_headers)
+        # integer level tolerance
+        if header in tolerances.integer:
+            n = tolerances.integer[header]
+            checks.append((header, 'integer', n, np.round(float(stdval)),
+                           stdval))
 
-    mismatches = []  # list of Mismatches
+        # decimal level tolerance
+        elif header in tolerances.decimal:
+            n = tolerances.decimal[header]
+            checks.append((header, 'decimal', n, round(float(stdval), n),
+                           stdval))
 
-    for header in headers:
-        if header not in stdhdr_names:
-            mismatches.append(Mismatch(
-                header=header, expected=None, actual=cmphdr.get(header), tolerance=None))
-            continue
+        # no tolerance set
+        else:
+            checks.append((header, None, None, str(stdval), stdval))
+
+    return ComparisonPlan(names, ignored, checks)
 
+
+def check_headers(plan, cmphdr):
+    """
+    Compares the headers <cmphdr> against a compiled gold standard <plan>.
+
+    Returns a list of Mismatch objects, ordered by header.
+    """
+    cmphdr_names = get_header_names(cmphdr)
+
+    mismatches = []  # list of Mismatches
+
+    for header, kind, n, expected, stdval in plan.checks:
         if header not in cmphdr_names:
             mismatches.append(Mismatch(
-                header=header, expected=stdhdr.get(header), actual=None, tolerance=None))
+                header=header, expected=stdval, actual=None, tolerance=None))
             continue
 
-        stdval = stdhdr.get(header)
         cmpval = cmphdr.get(header)
 
-        # integer level tolerance
-        if header in tolerances.integer:
-            n = tolerances.integer[header]
-
-            stdval_rounded = np.round(float(stdval))
+        if kind == 'integer':
             cmpval_rounded = np.round(float(cmpval))
-            difference = np.abs(stdval_rounded - cmpval_rounded)
-
-            if difference > n:
+            if np.abs(expected - cmpval_rounded) > n:
                 mismatches.append(Mismatch(
-                    header=header, expected=stdval_rounded, actual=cmpval_rounded, tolerance=n))
-
-        # decimal level tolerance
-        elif header in tolerances.decimal:
-            n = tolerances.decimal[header]
+                    header=header, expected=expected, actual=cmpval_rounded, tolerance=n))
 
-            stdval_rounded = round(float(stdval), n)
+        elif kind == 'decimal':
             cmpval_rounded = round(float(cmpval), n)
-
-            if stdval_rounded != cmpval_rounded:
+            if expected != cmpval_rounded:
                 mismatches.append(Mismatch(
-                    header=header, expected=stdval_rounded, actual=cmpval_rounded, tolerance=n))
+                    header=header, expected=expected, actual=cmpval_rounded, tolerance=n))
 
-        # no tolerance set
-        elif str(cmpval) != str(stdval):
+        elif str(cmpval) != expected:
             mismatches.append(Mismatch(
                 header=header, expected=stdval, actual=cmpval, tolerance=None))
 
+    # headers missing from the standard
+    extra = cmphdr_names.difference(plan.names).difference(plan.ignored)
+    for header in extra:
+        mismatches.append(Mismatch(
+            header=header, expected=None, actual=cmphdr.get(header), tolerance=None))
+
+    mismatches.sort(key=lambda m: m.header)
     return mismatches
 
 
-def compare_exam_headers(stdmap, examdir, ignore_headers, tolerances=None):
+def compare_headers(stdhdr, cmphdr, tolerances=None, ignore_headers=None):
+    """
+    Accepts two pydicom objects and prints out header value differences.
+
+    Headers in ignore set are ignored.
+
+    Returns a tuple containing a list of mismatched headers (as a list of
+    Mismatch objects)
+
+    To compare many headers against the same standard, compile the standard
+    once with compile_standard() and use check_headers() instead.
+    """
+    plan = compile_standard(stdhdr, tolerances, ignore_headers)
+    return check_headers(plan, cmphdr)
+
+
+def compile_standards(stdmap, ignore_headers, tolerances=None):
+    """
+    Compiles each of the gold standards in <stdmap> (a map from tag ->
+    (path, headers), see get_gold_standard_headers) into a ComparisonPlan.
+
+    Returns a map from tag -> (path, plan).
+    """
+    return {tag: (path, compile_standard(headers, tolerances, ignore_headers))
+            for tag, (path, headers) in stdmap.iteritems()}
+
+
+def compare_exam_headers(stdmap, examdir, ignore_headers, tolerances=None,
+                         index=None, jobs=1):
     """
     Compares headers for each series in an exam against gold standards
 
     <stdmap> is a map from description -> (cmppath, headers) of all of the
-    standard headers to compare against.
+    standard headers to compare against. The headers may instead be a
+    ComparisonPlan (see compile_standards).
 
     <ignore_headers> is a list of headers to ignore.
+
+    <index> is an optional datman.headerindex.HeaderIndex to read headers from.
+
+    <jobs> is the number of exam dicom files to read at once.
     """
-    exam_headers = dm.utils.get_all_headers_in_folder(examdir)
+    exam_headers = dm.utils.get_all_headers_in_folder(
+        examdir, index=index, jobs=jobs)
 
     all_mismatches = {}
     for cmppath, cmphdr in exam_headers.iteritems():
@@ -244,14 +352,168 @@ def compare_exam_headers(stdmap, examdir, ignore_headers, tolerances=None):
             continue
 
         stdpath, stdhdr = stdmap[tag]
-        mismatches = compare_headers(
-            stdhdr, cmphdr, tolerances, ignore_headers)
+        if isinstance(stdhdr, ComparisonPlan):
+            mismatches = check_headers(stdhdr, cmphdr)
+        else:
+            mismatches = compare_headers(
+                stdhdr, cmphdr, tolerances, ignore_headers)
         if mismatches:
             all_mismatches[cmppath] = mismatches
 
     return all_mismatches
 
 
+class ResultCache:
+    """Results of earlier header checks, by exam, in the database at <path>.
+
+    Each exam's results (its mismatch rows, see get_mismatch_rows) are kept
+    with the fingerprints they were found with (see get_fingerprint), and are
+    only returned while those are unchanged.
+    """
+
+    SCHEMA = """CREATE TABLE IF NOT EXISTS results (
+                    exam        TEXT PRIMARY KEY,
+                    exam_key    TEXT,
+                    std_key     TEXT,
+                    config_key  TEXT,
+                    mismatches  TEXT,
+                    checked_at  TEXT)"""
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=timeout)
+        self.db.text_factory = str
+        self.db.execute(self.SCHEMA)
+        self.db.commit()
+
+    def lookup(self, exam, exam_key, std_key, config_key):
+        """Returns the cached mismatch rows of an exam, or None."""
+        row = self.db.execute(
+            'SELECT mismatches FROM results WHERE exam = ? AND exam_key = ? '
+            'AND std_key = ? AND config_key = ?',
+            (exam, exam_key, std_key, config_key)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def store(self, exam, exam_key, std_key, config_key, rows):
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                (exam, exam_key, std_key, config_key, json.dumps(rows),
+                 datetime.datetime.utcnow().isoformat()))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def get_fingerprint(path, recurse=False):
+    """
+    Returns a digest of the names, mtimes and sizes of the files in a folder
+    (and, with recurse, its subfolders).
+    """
+    stats = []
+    for dirname, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            filepath = os.path.join(dirname, filename)
+            mtime, size = datman.headerindex.stat_key(filepath)
+            stats.append((os.path.relpath(filepath, path), mtime, size))
+        if not recurse: break
+    return hashlib.sha1(repr(sorted(stats))).hexdigest()
+
+
+def get_config_key(ignore_headers, tolerances=None):
+    """Returns a digest of the ignored headers and tolerances."""
+    tolerances = tolerances or DEFAULT_TOLERANCES
+    config = [sorted(ignore_headers), sorted(tolerances.integer.items()),
+              sorted(tolerances.decimal.items())]
+    return hashlib.sha1(json.dumps(config)).hexdigest()
+
+
+def get_mismatch_rows(all_mismatches):
+    """
+    Returns the mismatches of an exam (a map from path -> Mismatches) as a
+    list of (path, header, expected, actual, tolerance) rows, ordered by path,
+    with the values as text (or None).
+    """
+    to_text = datman.checkdb.to_text
+    rows = []
+    for path, mismatches in sorted(all_mismatches.iteritems()):
+        for m in mismatches:
+            rows.append((path, m.header, to_text(m.expected),
+                         to_text(m.actual), to_text(m.tolerance)))
+    return rows
+
+
+def write_log(logfile, rows, examdir):
+    if not os.path.exists(logfile):  # display warning on first encounter
+        log.warn('{} mismatches for exam {}'.format(len(rows), examdir))
+
+    with open(logfile, "w") as fname:
+        for row in rows:
+            message = "{}: header {}, expected = {}, actual = {} [tolerance = {}]".format(*row)
+            log.info(message)
+            fname.write(message + "\n")
+
+
+def write_checks(checkdb, rows, examdir):
+    """Records the mismatch rows of an exam in a datman.checkdb database."""
+    exam = os.path.basename(os.path.normpath(examdir))
+    checkdb.write('dm-check-headers', exam, [
+        (get_series(path), header, expected, actual, tolerance)
+        for path, header, expected, actual, tolerance in rows])
+
+
+def get_series(path):
+    """Returns the stem of a file name, e.g. the series of an exam dicom."""
+    filename = os.path.basename(path)
+    return filename[:len(filename) - len(dm.utils.get_extension(filename))]
+
+
+# The settings of the processes checking exams, see check_exams
+WORKER = {}
+
+def init_worker(stdmap, ignore_headers, indexfile, jobs):
+    WORKER['stdmap'] = stdmap
+    WORKER['ignore_headers'] = ignore_headers
+    WORKER['index'] = indexfile and datman.headerindex.HeaderIndex(indexfile) or None
+    WORKER['jobs'] = jobs
+
+
+def check_exam(examdir):
+    """Returns (examdir, mismatch rows) for an exam, see init_worker."""
+    all_mismatches = compare_exam_headers(
+        WORKER['stdmap'], examdir, WORKER['ignore_headers'],
+        index=WORKER['index'], jobs=WORKER['jobs'])
+    return examdir, get_mismatch_rows(all_mismatches)
+
+
+def check_exams(examdirs, stdmap, ignore_headers, indexfile=None, jobs=1,
+                processes=1):
+    """
+    Yields (examdir, mismatch rows) for each exam, as they are checked.
+
+    With processes > 1, exams are checked by a pool of that many processes,
+    each with their own header index, and results come in any order.
+    """
+    if processes <= 1 or len(examdirs) < 2:
+        init_worker(stdmap, ignore_headers, indexfile, jobs)
+        for examdir in examdirs:
+            yield check_exam(examdir)
+        return
+
+    pool = multiprocessing.Pool(processes, init_worker,
+                                (stdmap, ignore_headers, indexfile, jobs))
+    try:
+        for result in pool.imap_unordered(check_exam, examdirs):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 def main():
     arguments = docopt(__doc__)
     standardsdir = arguments['<standards/>']
@@ -260,6 +522,10 @@ def main():
     verbose = arguments['--verbose']
     filtertext = arguments['--filter']
     ignore_headers = arguments['--ignore-headers']
+    indexfile = arguments['--header-index']
+    jobs = int(arguments['--jobs'])
+    cachefile = arguments['--cache']
+    processes = int(arguments['--processes'])
 
     log.basicConfig(
         level=log.WARN, format="[dm-check-headers] %(levelname)s: %(message)s")
@@ -280,33 +546,63 @@ def main():
     ignore_headers = ignore_headers and ignore_headers.split(",") or []
     ignore_headers = DEFAULT_IGNORED_HEADERS.union(ignore_headers)
 
-    stdmap = get_gold_standard_headers(standardsdir)
+    index = indexfile and datman.headerindex.HeaderIndex(indexfile) or None
+    stdmap = get_gold_standard_headers(standardsdir, index, jobs)
+    stdmap = compile_standards(stdmap, ignore_headers)
+    if index is not None:
+        index.close()
 
     globexpr = '*'
     if filtertext:
         globexpr = '*{}*'.format(filtertext)
 
-    for examdir in glob.glob('{}/{}/'.format(examsdir,globexpr)):
-        if '_PHA_' in examdir:  # ignore phantoms
-            continue
+    examdirs = [examdir for examdir in
+                glob.glob('{}/{}/'.format(examsdir,globexpr))
+                if '_PHA_' not in examdir]  # ignore phantoms
 
-        logfile = os.path.join(logsdir, "dm-check-headers-{}.log".format(
+    def get_logfile(examdir):
+        return os.path.join(logsdir, "dm-check-headers-{}.log".format(
             os.path.basename(os.path.normpath(examdir))))
 
-        all_mismatches = compare_exam_headers(stdmap, examdir, ignore_headers)
-        if not all_mismatches:
-            continue
-
-        if not os.path.exists(logfile):  # display warning on first encounter
-            log.warn('{} mismatches for exam {}'.format(len(all_mismatches), examdir))
-
-        with open(logfile, "w") as fname:
-            for path, mismatches in all_mismatches.iteritems():
-                for m in mismatches:
-                    message = "{}: header {}, expected = {}, actual = {} [tolerance = {}]".format(
-                        path, m.header, m.expected, m.actual, m.tolerance)
-                    log.info(message)
-                    fname.write(message + "\n")
+    checkdb = datman.checkdb.CheckDatabase(
+        os.path.join(logsdir, datman.checkdb.DB_NAME))
+    cache = cachefile and ResultCache(cachefile) or None
+    if cache is not None:
+        std_key = get_fingerprint(standardsdir, recurse=True)
+        config_key = get_config_key(ignore_headers)
+
+    # only check the exams that have changed since they were last checked
+    exam_keys = {}
+    todo = []
+    for examdir in examdirs:
+        if cache is not None:
+            exam_keys[examdir] = get_fingerprint(examdir)
+            rows = cache.lookup(examdir, exam_keys[examdir], std_key,
+                                config_key)
+            if rows is not None:
+                logfile = get_logfile(examdir)
+                if rows and not os.path.exists(logfile):
+                    write_log(logfile, rows, examdir)
+                exam = os.path.basename(os.path.normpath(examdir))
+                if rows and not checkdb.has_exam('dm-check-headers', exam):
+                    write_checks(checkdb, rows, examdir)
+                continue
+        todo.append(examdir)
+
+    log.info('Checking {} of {} exams'.format(len(todo), len(examdirs)))
+
+    for examdir, rows in check_exams(todo, stdmap, ignore_headers, indexfile,
+                                     jobs, processes):
+        if rows:
+            write_log(get_logfile(examdir), rows, examdir)
+        write_checks(checkdb, rows, examdir)
+        if cache is not None:
+            cache.store(examdir, exam_keys[examdir], std_key, config_key,
+                        rows)
+
+    checkdb.close()
+    if cache is not None:
+        cache.close()
 
 if __name__ == '__main__':
     main()
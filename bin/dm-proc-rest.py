@@ -236,21 +236,25 @@ def analyze_data(sub, atlas, func_path):
         else:
             logger.info(output)
 
-        rois, _, _, _ = dm.utils.loadnii(
-            '{func_path}/{sub}/{basename}_rois.nii.gz'.format(func_path=func_path, sub=sub, basename=basename))
-        data, _, _, _ = dm.utils.loadnii(f)
+        roifile = '{func_path}/{sub}/{basename}_rois.nii.gz'.format(
+            func_path=func_path, sub=sub, basename=basename)
+        rois, _, _, _ = dm.utils.loadnii(roifile)
 
-        n_rois = len(np.unique(rois[rois > 0]))
+        # only load the voxels within an ROI, rois is reduced to match
+        data = dm.utils.load_masked_data(f, roifile, dtype=np.float32)
+        rois = rois[rois > 0]
+
+        n_rois = len(np.unique(rois))
         dims = np.shape(data)
 
         # loop through all ROIs, extracting mean timeseries.
         output = np.zeros((n_rois, dims[1]))
 
-        for i, roi in enumerate(np.unique(rois[rois > 0])):
+        for i, roi in enumerate(np.unique(rois)):
             idx = np.where(rois == roi)[0]
 
             if len(idx) > 0:
-                output[i, :] = np.mean(data[idx, :], axis=0)
+                output[i, :] = np.mean(data[idx, :], axis=0, dtype=np.float64)
 
         # save the raw time series
         np.savetxt('{func_path}/{sub}/{basename}_roi-timeseries.csv'.format(
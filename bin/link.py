@@ -17,6 +17,8 @@ Options:
                                 [default: metadata/scans.csv]
     --scanid_field STR       Dicom field to match target_name with 
                              [default: PatientName]
+    --header-index FILE      Database of dicom headers to consult (and update)
+                             rather than re-reading unchanged archives
     -v,--verbose             Verbose logging
     --debug                  Debug logging
     -n,--dry-run             Dry run
@@ -74,6 +76,7 @@ import pandas as pd
 import datman as dm
 import datman.utils
 import datman.scanid
+import datman.headerindex
 import glob
 import os.path
 import sys
@@ -106,6 +109,7 @@ def main():
     targetdir    = arguments['<targetdir>']
     lookup_table = arguments['--lookup']
     scanid_field = arguments['--scanid_field']
+    indexfile    = arguments['--header-index']
     VERBOSE      = arguments['--verbose']
     DEBUG        = arguments['--debug']
     DRYRUN       = arguments['--dry-run']
@@ -114,6 +118,8 @@ def main():
     lookup = pd.read_table(lookup_table, sep='\s+', dtype=str)
     targetdir = os.path.normpath(targetdir)
 
+    index = indexfile and datman.headerindex.HeaderIndex(indexfile) or None
+
     already_linked = { os.path.realpath(f):f for f in glob.glob(targetdir+'/*') if os.path.islink(f)}
 
     for archivepath in archives: 
@@ -126,7 +132,8 @@ def main():
         header = None
         try:
             header = dm.utils.get_archive_headers(
-                                archivepath, stop_after_first=True).values()[0]
+                                archivepath, stop_after_first=True,
+                                index=index).values()[0]
         except:
             verbose("{}: Contains no DICOMs. Skipping.".format(archivepath))
             continue
@@ -11,10 +11,15 @@ Options:
     --dbdir DIR             Folder for the database (default, same as --qcdir)
     --project-settings YML  File with project settings (to read expected file list from)
     --subject SCANID        Scan ID to QC for. E.g. DTI_CMH_H001_01_01
-    --rewrite               Rewrite the html of an existing qc page
+    --rewrite               Rewrite the html of existing qc pages, redoing
+                            the QC of any scans that have changed
     --verbose               Be chatty
     --debug                 Be extra chatty
     --dry-run               Don't actually do any work
+    -j, --jobs N            Number of scans to QC at once [default: 1]
+    --afni-parity           Also make the fMRI mean, stdev, SFNR and mask
+                            images with AFNI, and log how they compare to our
+                            own
 
 DETAILS
 
@@ -27,6 +32,24 @@ DETAILS
     The database stores some of the numbers plotted here, and is used by web-
     build to generate interactive charts detailing the acquisitions over time.
 
+    The QC of each scan is cached in qc_<subject>.json, next to the subject's
+    html page, keyed on the contents of the scan (and of its .bvec/.bval),
+    the QC handler and its version (QC_VERSION), and the plot settings. When a
+    page is rewritten, only the scans whose inputs or handler have changed
+    since they were last QC'd (or whose images have gone missing) are QC'd
+    again, the html of the others is reused as is.
+
+    The fMRI mean, (detrended) standard deviation, SFNR and brain mask images
+    are computed here with numpy, in the same way as AFNI's 3dTstat, 3dcalc
+    and 3dAutomask -clfrac 0.5 -peels 3 (see fmri_stats). The mask is close
+    to, but not exactly, what 3dAutomask would make. --afni-parity runs the
+    AFNI programs as well and logs the differences.
+
+    With --jobs, the scans of all of the subjects are QC'd in parallel by a
+    pool of worker processes. Each subject's html page and database values
+    are still written by this process alone, subject by subject and scan by
+    scan, so the output is the same as with a single job.
+
 """
 
 import os
@@ -34,19 +57,25 @@ import sys
 import glob
 import logging
 import sqlite3
+import collections
+import hashlib
+import itertools
+import json
+import multiprocessing
+import StringIO
 import datetime
 import numpy as np
-import scipy as sp
+import scipy.ndimage as ndimage
 import scipy.signal as sig
 import dicom as dcm
 import nibabel as nib
 import datman as dm
 import datman.utils
 import datman.scanid
+import datman.qcdb
+import datman.checkdb
 import subprocess as proc
-from copy import copy
 from docopt import docopt
-import re
 import tempfile
 import textwrap
 import yaml
@@ -56,6 +85,8 @@ import matplotlib
 matplotlib.use('Agg')   # Force matplotlib to not use any Xwindows backend
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 
 logging.basicConfig(level=logging.WARN,
     format="[%(name)s] %(levelname)s: %(message)s")
@@ -66,6 +97,10 @@ VERBOSE = False
 DRYRUN = False
 FIGDPI = 144
 REWRITE = False
+AFNI_PARITY = False
+
+# Bump when the output of any QC handler changes, so that cached QC is redone
+QC_VERSION = 2
 
 # adds qascripts to the environment
 ASSETS = '{}/assets'.format(os.path.dirname(dm.utils.script_path()))
@@ -74,6 +109,38 @@ os.environ['PATH'] += os.pathsep + ASSETS + '/qascripts_version2'
 class Document:
     pass
 
+class HtmlBuffer(StringIO.StringIO):
+    """
+    Collects a piece of the html page <name> in memory, so that it can be
+    built away from the process that writes the page. The pics added to it
+    (see add_pic_to_html) are listed in pics.
+    """
+    def __init__(self, name):
+        StringIO.StringIO.__init__(self)
+        self.name = name
+        self.pics = []
+
+class MetricsBuffer:
+    """
+    Collects the values a scan's QC inserts into the database (see
+    insert_value), so that they can be written later on by the process that
+    owns the database.
+    """
+    def __init__(self, scan):
+        self.scan = scan
+        self.rows = []
+
+    def insert(self, table, subj, colname, value):
+        if isinstance(value, np.generic):
+            value = value.item()
+        self.rows.append((table, subj, self.scan, colname, value))
+
+# A scan to be QC'd by handler(fpath, qcpath, qchtml, cur), as part of the
+# html page htmlfile. key and stats are cached along with the result (see
+# get_qc_key).
+QCJob = collections.namedtuple('QCJob',
+        ['handler', 'fpath', 'qcpath', 'htmlfile', 'key', 'stats'])
+
 ###############################################################################
 # HELPERS
 
@@ -95,11 +162,6 @@ def run(cmd):
             out and logger.debug("stdout: \n>\t{}".format(out.replace('\n','\n>\t')))
             err and logger.debug("stderr: \n>\t{}".format(err.replace('\n','\n>\t')))
 
-def create_db(cur):
-    cur.execute('CREATE TABLE fmri (subj TEXT, site TEXT)')
-    cur.execute('CREATE TABLE dti (subj TEXT, site TEXT)')
-    cur.execute('CREATE TABLE t1 (subj TEXT, site TEXT)')
-
 def found_files_df(config, scanpath, subject):
     '''
     reads in the export info from the config file and
@@ -183,41 +245,11 @@ def nifti_basename(fpath):
 def insert_value(cur, table, subj, colname, value):
     """
     Insets values into the database (differently for numeric and string data).
-    """
-
-    # check if column exits, add if it does not
-    cur.execute('PRAGMA table_info({})'.format(table))
-    d = cur.fetchall()
-
-    cols = []
-    for col in d:
-        cols.append(str(col[1]))
-
-    if colname not in cols:
-        cur.execute('ALTER TABLE {table} ADD COLUMN {colname} FLOAT DEFAULT null'.format(
-                           table=table, colname=colname))
-
-    # check if subject exists
-    cur.execute("""SELECT * FROM {table} WHERE subj='{subj}'""".format(
-                       table=table, subj=subj))
-    d = cur.fetchall()
 
-    # if subject does not exist, insert row
-    if len(d) == 0:
-        if type(value) == str:
-            cur.execute("""INSERT INTO {table}(subj, {colname}) VALUES('{subj}', '{value}')""".format(
-                           table=table, subj=subj, colname=colname, value=value))
-        else:
-            cur.execute("""INSERT INTO {table}(subj, {colname}) VALUES('{subj}', {value})""".format(
-                           table=table, subj=subj, colname=colname, value=value))
-    # otherwise, update row
-    else:
-        if type(value) == str:
-            cur.execute("""UPDATE {table} SET {colname} = '{value}' WHERE subj='{subj}'""".format(
-                           table=table, subj=subj, colname=colname, value=value))
-        else:
-            cur.execute("""UPDATE {table} SET {colname} = {value} WHERE subj='{subj}'""".format(
-                           table=table, subj=subj, colname=colname, value=value))
+    cur is the MetricsBuffer of the scan being QC'd, the value is held there
+    until the subject's page is written out (see write_qc_page).
+    """
+    cur.insert(table, subj, colname, value)
 
 def factors(n):
     """
@@ -252,6 +284,7 @@ def add_pic_to_html(qchtml, pic):
     Adds a pic to an html page with this handler "qchtml"
     '''
     relpath = os.path.relpath(pic,os.path.dirname(qchtml.name))
+    qchtml.pics.append(relpath)
     qchtml.write('<a href="'+ relpath + '" >')
     qchtml.write('<img src="' + relpath + '" > ')
     qchtml.write('</a><br>\n')
@@ -272,24 +305,6 @@ def fslslicer_pic(fpath,pic,slicergap,picwidth):
     """
     run("slicer {} -S {} {} {}".format(fpath,slicergap,picwidth,pic))
 
-def load_masked_data(func, mask):
-    """
-    Accepts 'functional.nii.gz' and 'mask.nii.gz', and returns a voxels x
-    timepoints matrix of the functional data in non-zero mask locations.
-    """
-    func = nib.load(func).get_data()
-    mask = nib.load(mask).get_data()
-
-    mask = mask.reshape(mask.shape[0]*mask.shape[1]*mask.shape[2])
-    func = func.reshape(func.shape[0]*func.shape[1]*func.shape[2],
-                                                    func.shape[3])
-
-    # find within-brain timeseries
-    idx = np.where(mask > 0)[0]
-    func = func[idx, :]
-
-    return func
-
 def check_n_trs(fpath):
     """
     Returns the number of TRs for an input file. If the file is 3D, we also
@@ -315,75 +330,269 @@ def bounding_box(filename):
     """
 
     # find 3D bounding box
-    box = np.zeros((3,2))  # init bounding box
-    flag = 0  # ascending
+    box = np.zeros((3,2), dtype=int)  # init bounding box
 
     for i, dim in enumerate(filename.shape): # loop through (x, y, z)
 
-        # ascending search
-        while flag == 0:
-            for dim_test in np.arange(dim):
+        # get sum of all values in each slice
+        others = tuple(axis for axis in range(3) if axis != i)
+        test = np.sum(filename, axis=others)
 
-                # get sum of all values in each slice
-                if i == 0:   test = np.sum(filename[dim_test, :, :])
-                elif i == 1: test = np.sum(filename[:, dim_test, :])
-                elif i == 2: test = np.sum(filename[:, :, dim_test])
+        # the first and last nonzero slices are the bounds
+        nonzero = np.where(test >= 1)[0]
+        if len(nonzero) == 0:
+            box[i] = [0, dim - 1]
+        else:
+            box[i] = [nonzero[0], nonzero[-1]]
 
-                # if slice is nonzero, set starting bound, switch to descending
-                if test >= 1:
-                    box[i, 0] = dim_test
-                    flag = 1
-                    break
+    return box
 
-        # descending search
-        while flag == 1:
-            for dim_test in np.arange(dim):
+def load_montage_data(image, mode):
+    """
+    Loads the part of a nifti that montage() plots, reoriented to radiological.
 
-                dim_test = dim-dim_test - 1  # we have to reverse things
+    In '3d' mode, this is the first volume. In '4d' mode, this is the middle
+    coronal plane of every volume (as a z, x, time array). Only that part of
+    the file is read into memory.
 
-                # get sum of all values in each slice
-                if i == 0:   test = np.sum(filename[dim_test, :, :])
-                elif i == 1: test = np.sum(filename[:, dim_test, :])
-                elif i == 2: test = np.sum(filename[:, :, dim_test])
+    The image may also be a numpy array that is already in memory.
+    """
+    if isinstance(image, np.ndarray):
+        img = image
+    else:
+        img = nib.load(image).dataobj
 
-                # if slice is nonzero, set ending bound, switch to ascending
-                if test >= 1:
-                    box[i, 1] = dim_test
-                    flag = 0
-                    break
+    if mode == '3d':
+        if len(img.shape) > 3: # if image is 4D, only keep the first time-point
+            data = img[:, :, :, 0]
+        else:
+            data = img[:, :, :]
+        return dm.utils.reorient_to_radiological(np.asarray(data))
 
-    return box
+    # the middle coronal plane through time, ordered and flipped the same way
+    # as the axial slices of reorient_to_radiological
+    midslice = (img.shape[1] - 1) // 2
+    data = np.asarray(img[:, midslice, :, :])
+    return np.transpose(data, (1,0,2))[::-1, ::-1]
 
-def reorient_4d_image(image):
+# Figures made by montage(), by the number of rows (and columns) of images
+MONTAGE_FIGURES = {}
+
+def get_montage_figure(factor):
+    """
+    Returns a cleared (figure, axes, colorbar axes) for a factor x factor
+    montage. Figures are kept and reused for later montages of the same size.
+
+    The figures are made outside of pyplot, so they are never the current
+    figure (and plt.close() can't close them) while other plots are drawn.
     """
-    Reorients the data to radiological, one TR at a time
+    if factor not in MONTAGE_FIGURES:
+        fig = Figure(facecolor='white')
+        FigureCanvasAgg(fig)
+        axes = fig.subplots(nrows=factor, ncols=factor, squeeze=False)
+        fig.subplots_adjust(left=0, right=0.85, top=0.9, bottom=0)
+        cbar_ax = fig.add_axes([0.88, 0.10, 0.05, 0.7])
+        MONTAGE_FIGURES[factor] = (fig, axes, cbar_ax)
+
+    fig, axes, cbar_ax = MONTAGE_FIGURES[factor]
+    for ax in axes.flat:
+        ax.clear()
+    cbar_ax.clear()
+    return fig, axes, cbar_ax
+
+def save_mosaic(tiles, ncols, pic, cmap, vmin, vmax):
     """
-    for i in np.arange(image.shape[3]):
+    Saves a list of 2D arrays (all the same shape) to a .png as a grid with
+    ncols columns, without any titles or colorbar. Much faster than drawing a
+    figure.
+    """
+    rows, cols = tiles[0].shape
+    nrows = int(np.ceil(len(tiles) / float(ncols)))
 
-        if i == 0:
-            newimage = np.transpose(image[:, :, :, i], (2,0,1))
-            newimage = np.rot90(newimage, 2)
+    mosaic = np.empty((nrows*rows, ncols*cols))
+    mosaic.fill(np.nan) # empty tiles are drawn in the colormap's bad colour
+    for i, tile in enumerate(tiles):
+        r, c = divmod(i, ncols)
+        mosaic[r*rows:(r+1)*rows, c*cols:(c+1)*cols] = tile
 
-        elif i == 1:
-            tmpimage = np.transpose(image[:, :, :, i], (2,0,1))
-            tmpimage = np.rot90(tmpimage, 2)
-            newimage = np.concatenate((newimage[...,np.newaxis],
-                                       tmpimage[...,np.newaxis]), axis=3)
+    plt.imsave(pic, mosaic, cmap=cmap, vmin=vmin, vmax=vmax, format='png')
 
-        else:
-            tmpimage = np.transpose(image[:, :, :, i], (2,0,1))
-            tmpimage = np.rot90(tmpimage, 2)
-            newimage = np.concatenate((newimage,
-                                       tmpimage[...,np.newaxis]), axis=3)
+def normalize_timeseries(data):
+    """
+    Returns a voxels x timepoints array with each timeseries demeaned and
+    scaled to unit length, so that the dot product of two rows is their
+    correlation.
+    """
+    data = np.array(data, dtype=np.float64)
+    data -= np.mean(data, axis=1)[:, np.newaxis]
+    data /= np.sqrt(np.sum(data**2, axis=1))[:, np.newaxis]
+    return data
+
+def correlation_summary(func, fraction=0.1, seed=0, blocksize=1024,
+                        heatmap_size=256):
+    """
+    Summarizes the correlations between a random sample of the timeseries in
+    a voxels x timepoints array, without building the correlation matrix.
+
+    A fraction of the voxels is sampled (reproducibly, from the given seed),
+    leaving out voxels whose timeseries are constant. If Z holds the sampled
+    timeseries normalized to unit length, their correlation matrix is Z Z'.
+    The sum of its entries is the squared length of the sum of the rows of Z,
+    and the sum of their squares is the sum of the squares of the (timepoints
+    x timepoints) Gram matrix Z'Z. Both are accumulated a block of voxels at a
+    time.
+
+    Returns the mean and SD of the correlation matrix (diagonal included), and
+    the correlation matrix of the first heatmap_size sampled voxels for
+    plotting.
+    """
+    rng = np.random.RandomState(seed)
+    voxels = np.where(np.ptp(func, axis=1) > 0)[0]
+    idx = rng.choice(voxels, int(len(voxels) * fraction), replace=False)
+    n = len(idx)
+    if n == 0:
+        return np.nan, np.nan, np.zeros((0, 0))
+
+    total = np.zeros(func.shape[1])
+    gram = np.zeros((func.shape[1], func.shape[1]))
+    for start in range(0, n, blocksize):
+        z = normalize_timeseries(func[idx[start:start+blocksize], :])
+        total += np.sum(z, axis=0)
+        gram += np.dot(z.T, z)
+
+    mean = np.dot(total, total) / n**2
+    std = np.sqrt(max(np.sum(gram**2) / n**2 - mean**2, 0))
 
-    image = copy(newimage)
+    z = normalize_timeseries(func[idx[:heatmap_size], :])
+    heatmap = np.dot(z, z.T)
 
-    return image
+    return mean, std, heatmap
+
+# The fMRI statistics images computed by fmri_stats()
+FMRIStats = collections.namedtuple('FMRIStats',
+        ['mean', 'std', 'sfnr', 'mask'])
+
+def fmri_stats(func, clfrac=0.5, peels=3):
+    """
+    Computes the mean, standard deviation, SFNR and brain mask images of a 4D
+    nifti in a single pass through the file, a run of volumes at a time (see
+    datman.utils.iter_volumes).
+
+    As with AFNI's 3dTstat -stdev, the standard deviation is taken after
+    removing a linear trend from each timeseries. SFNR is mean / std (and 0
+    where std is 0), as with 3dcalc -expr 'a/b'. The mask is made from the mean
+    image by automask().
+
+    Returns an FMRIStats of 3D arrays.
+    """
+    img = nib.load(func)
+    dims = img.shape
+    ntrs = dims[3]
+
+    # the centered time axis for the linear trend
+    t = np.arange(ntrs) - (ntrs - 1) / 2.0
+    tss = np.sum(t**2)
+
+    # per voxel sums of y, t*y and y^2, with y taken relative to the first
+    # volume to keep the sums of squares well conditioned
+    first = None
+    sum_y = np.zeros(dims[:3])
+    sum_ty = np.zeros(dims[:3])
+    sum_yy = np.zeros(dims[:3])
+    for start, volumes in dm.utils.iter_volumes(img):
+        if first is None:
+            first = np.array(volumes[..., 0], dtype=np.float64)
+        volumes = volumes - first[..., np.newaxis]
+
+        sum_y += np.sum(volumes, axis=3)
+        sum_ty += np.dot(volumes, t[start:start+volumes.shape[3]])
+        sum_yy += np.sum(volumes**2, axis=3)
+
+    mean = first + sum_y / ntrs
+
+    # residual sum of squares about the least squares line
+    rss = sum_yy - sum_y**2 / ntrs - sum_ty**2 / tss
+    std = np.sqrt(np.maximum(rss, 0) / (ntrs - 1))
+
+    sfnr = np.zeros(dims[:3])
+    np.divide(mean, std, out=sfnr, where=std > 0)
+
+    mask = automask(mean, clfrac=clfrac, peels=peels)
+
+    return FMRIStats(mean, std, sfnr, mask)
+
+def get_cliplevel(image, clfrac=0.5):
+    """
+    Finds the intensity that separates brain from background, as AFNI does
+    for 3dAutomask: starting from clfrac times the median of the positive
+    voxels, the level is repeatedly set to clfrac times the median of the
+    voxels above it until it settles.
+    """
+    values = image[image > 0]
+    if len(values) == 0:
+        return 0
+
+    clip = clfrac * np.median(values)
+    for i in range(66):
+        above = values[values >= clip]
+        new_clip = clfrac * np.median(above)
+        if abs(new_clip - clip) <= 0.001 * clip:
+            break
+        clip = new_clip
+    return clip
+
+def automask(image, clfrac=0.5, peels=3):
+    """
+    Makes a brain mask from a 3D (mean) image, after 3dAutomask: voxels above
+    the clip level, opened (peeled and unpeeled) peels times, keeping the
+    largest connected cluster, with holes filled in.
+    """
+    mask = image >= get_cliplevel(image, clfrac)
+    if peels > 0:
+        mask = ndimage.binary_opening(mask, iterations=peels)
+
+    labels, nlabels = ndimage.label(mask)
+    if nlabels > 1:
+        sizes = np.bincount(labels.ravel())[1:]
+        mask = labels == (np.argmax(sizes) + 1)
+
+    return ndimage.binary_fill_holes(mask)
+
+def check_afni_parity(tmpdir, stats):
+    """
+    Makes the fMRI statistics images of {tmpdir}/mcorr.nii.gz with AFNI, and
+    logs how they compare to the FMRIStats from fmri_stats().
+    """
+    run('3dTstat -prefix {t}/mean.nii.gz {t}/mcorr.nii.gz'.format(t=tmpdir))
+    run('3dAutomask \
+         -prefix {t}/mask.nii.gz \
+         -clfrac 0.5 -peels 3 {t}/mean.nii.gz'.format(t=tmpdir))
+    run('3dTstat -prefix {t}/std.nii.gz  -stdev {t}/mcorr.nii.gz'.format(t=tmpdir))
+    run("""3dcalc \
+           -prefix {t}/sfnr.nii.gz \
+           -a {t}/mean.nii.gz -b {t}/std.nii.gz -expr 'a/b'""".format(t=tmpdir))
+    if DRYRUN:
+        return
+
+    for name in ['mean', 'std', 'sfnr']:
+        afni = nib.load('{}/{}.nii.gz'.format(tmpdir, name)).get_data()
+        ours = getattr(stats, name)
+        scale = np.maximum(np.abs(afni), 1e-6)
+        reldiff = np.abs(ours - afni.reshape(ours.shape)) / scale
+        logger.info('AFNI parity: {} max relative difference {:.2e}, '
+                    'median {:.2e}'.format(name, np.max(reldiff),
+                                           np.median(reldiff)))
+
+    afni = nib.load('{}/mask.nii.gz'.format(tmpdir)).get_data() > 0
+    afni = afni.reshape(stats.mask.shape)
+    dice = 2.0 * np.sum(afni & stats.mask) / max(np.sum(afni) + np.sum(stats.mask), 1)
+    logger.info('AFNI parity: mask dice {:.4f} ({} voxels, AFNI {})'.format(
+                dice, np.sum(stats.mask), np.sum(afni)))
 
 ###############################################################################
 # PLOTTERS / CALCULATORS
 
-def montage(image, name, filename, pic, cmaptype='grey', mode='3d', minval=None, maxval=None, box=None):
+def montage(image, name, filename, pic, cmaptype='grey', mode='3d', minval=None, maxval=None, box=None, annotate=True):
     """
     Creates a montage of images displaying a image set on top of a grayscale
     image.
@@ -398,7 +607,7 @@ def montage(image, name, filename, pic, cmaptype='grey', mode='3d', minval=None,
     Usage:
         montage(image, name, filename, pic)
 
-        image    -- submitted image file name
+        image    -- submitted image file name (or numpy array)
         name     -- name of the printout (e.g, SNR map, t-stats, etc.)
         cmaptype -- 'redblue', 'hot', or 'gray'.
         minval   -- colormap minimum value as a % (None == 'auto')
@@ -408,33 +617,29 @@ def montage(image, name, filename, pic, cmaptype='grey', mode='3d', minval=None,
         picpath  -- Path to save the figure .png to
         box      -- a (3,2) tuple that describes the start and end voxel
                     for x, y, and z, respectively. If None, we find it ourselves.
+        annotate -- if False, the images are saved as a plain grid, without
+                    the title or colorbar (and in '4d' mode, with a single
+                    colour scale for all timepoints)
     """
-    image = str(image) # input checks
-    opath = os.path.dirname(image) # grab the image folder
-    output = str(image)
-    image = nib.load(image).get_data() # load in the daterbytes
+    if not isinstance(image, np.ndarray): # input checks
+        image = str(image)
+    image = load_montage_data(image, mode) # load in the daterbytes
 
     if mode == '3d':
-        if len(image.shape) > 3: # if image is 4D, only keep the first time-point
-            image = image[:, :, :, 0]
-
-        image = np.transpose(image, (2,0,1))
-        image = np.rot90(image, 2)
-        steps = np.round(np.linspace(0,np.shape(image)[0]-2, 36)) # coronal plane
-        factor = 6
-
         # use bounding box (submitted or found) to crop extra-brain regions
-        if box == None:
+        if box is None:
             box = bounding_box(image) # get the image bounds
         elif box.shape != (3,2): # if we did, ensure it is the right shape
             logger.error('ERROR: Bounding box should have shape = (3,2).')
             raise ValueError
+        box = box.astype(int)
         image = image[box[0,0]:box[0,1], box[1,0]:box[1,1], box[2,0]:box[2,1]]
 
+        steps = np.round(np.linspace(0,np.shape(image)[0]-1, 36)).astype(int) # coronal plane
+        factor = 6
+
     if mode == '4d':
-        image = reorient_4d_image(image)
-        midslice = np.floor((image.shape[2]-1)/2) # print a single plane across all slices
-        factor = np.ceil(np.sqrt(image.shape[3])) # print all timepoints
+        factor = np.ceil(np.sqrt(image.shape[2])) # print all timepoints
         factor = factor.astype(int)
 
     # colormapping -- set value
@@ -458,7 +663,15 @@ def montage(image, name, filename, pic, cmaptype='grey', mode='3d', minval=None,
 
     cmap.set_bad('g', 0)  # value for transparent pixels in the overlay
 
-    fig, axes = plt.subplots(nrows=factor, ncols=factor, facecolor='white')
+    if not annotate:
+        if mode == '3d':
+            tiles = [image[step, :, :] for step in steps]
+        else:
+            tiles = [image[:, :, i] for i in range(image.shape[2])]
+        save_mosaic(tiles, factor, pic, cmap, minval, maxval)
+        return
+
+    fig, axes, cbar_ax = get_montage_figure(factor)
     for i, ax in enumerate(axes.flat):
 
         if mode == '3d':
@@ -467,23 +680,67 @@ def montage(image, name, filename, pic, cmaptype='grey', mode='3d', minval=None,
             ax.axes.get_xaxis().set_visible(False)
             ax.axes.get_yaxis().set_visible(False)
 
-        elif mode == '4d' and i < image.shape[3]:
-            im = ax.imshow(image[:, :, midslice, i], cmap=cmap, interpolation='nearest')
+        elif mode == '4d' and i < image.shape[2]:
+            im = ax.imshow(image[:, :, i], cmap=cmap, interpolation='nearest')
             ax.set_frame_on(False)
             ax.axes.get_xaxis().set_visible(False)
             ax.axes.get_yaxis().set_visible(False)
 
-        elif mode == '4d' and i >= image.shape[3]:
+        elif mode == '4d' and i >= image.shape[2]:
             ax.set_axis_off() # removes extra axes from plot
 
-    plt.subplots_adjust(left=0, right=0.85, top=0.9, bottom=0)
-
-    cbar_ax = fig.add_axes([0.88, 0.10, 0.05, 0.7])
     cb = fig.colorbar(im, cax=cbar_ax)
     fig.suptitle(filename + '\n' + name, size=10)
 
     fig.savefig(pic, format='png', dpi=FIGDPI)
-    plt.close()
+
+def epi_spike_table(image, bvec=None):
+    """
+    Computes the mean and standard deviation of a centre crop of every axial
+    slice of every TR of a 4D image (a numpy array).
+
+    If bvec is supplied, we remove all time points that are 0 in the bvec
+    vector.
+
+    Returns a table (pandas.DataFrame) with one row per slice and TR, and the
+    columns slice, volume (the TR in the original image), mean, sd, and spike
+    (True where the slice mean is higher than the mean over all kept TRs plus
+    the mean SD over all kept TRs).
+    """
+    image = dm.utils.reorient_to_radiological(image)
+
+    x = image.shape[1]
+    z = image.shape[0]
+
+    # sets the bounds of the image
+    c1 = int(np.round(x*0.25))
+    c2 = int(np.round(x*0.75))
+
+    # crop out b0 images
+    if bvec is None:
+        volumes = np.arange(image.shape[3])
+    else:
+        volumes = np.where(bvec != 0)[0]
+
+    # one slice at a time (through all TRs at once) keeps the temporary
+    # arrays numpy makes to a slice's worth of data
+    v_mean = np.zeros((z, len(volumes)))
+    v_sd = np.zeros((z, len(volumes)))
+    for i in np.arange(z):
+        sample = image[i, c1:c2, c1:c2, :][..., volumes]
+        v_mean[i] = np.mean(sample, axis=(0,1))
+        v_sd[i] = np.std(sample, axis=(0,1))
+
+    # keep track of spikes
+    threshold = np.mean(v_mean, axis=1) + np.mean(v_sd, axis=1)
+    v_spikes = v_mean > threshold[:, np.newaxis]
+
+    return pd.DataFrame({'slice':  np.repeat(np.arange(z), len(volumes)),
+                         'volume': np.tile(volumes, z),
+                         'mean':   v_mean.ravel(),
+                         'sd':     v_sd.ravel(),
+                         'spike':  v_spikes.ravel()},
+                        columns=['slice', 'volume', 'mean', 'sd', 'spike'])
 
 def find_epi_spikes(image, filename, pic, ftype, cur=None, bvec=None):
 
@@ -495,6 +752,8 @@ def find_epi_spikes(image, filename, pic, ftype, cur=None, bvec=None):
     If bvec is supplied, we remove all time points that are 0 in the bvec
     vector.
 
+    Returns the table of slice means and spikes (see epi_spike_table).
+
     Usage:
         find_epi_spikes(image, filename, picpath)
 
@@ -508,65 +767,27 @@ def find_epi_spikes(image, filename, pic, ftype, cur=None, bvec=None):
     """
 
     image = str(image)             # input checks
-    opath = os.path.dirname(image) # grab the image folder
 
     # load in the daterbytes
-    output = str(image)
     image = nib.load(image).get_data()
-    image = reorient_4d_image(image)
-
-    x = image.shape[1]
-    y = image.shape[2]
-    z = image.shape[0]
-    t = image.shape[3]
-
-    # initialize the spikecount
-    spikecount = 0
+    z = image.shape[2]
+    table = epi_spike_table(image, bvec)
+    spikecount = int(table['spike'].sum())
 
     # find the most square set of factors for n_trs
     factor = np.ceil(np.sqrt(z))
     factor = factor.astype(int)
 
-    fig, axes = plt.subplots(nrows=factor, ncols=factor, facecolor='white')
-
-    # sets the bounds of the image
-    c1 = np.round(x*0.25)
-    c2 = np.round(x*0.75)
+    fig, axes = plt.subplots(nrows=factor, ncols=factor, squeeze=False,
+                             facecolor='white')
 
     # for each axial slice
     for i, ax in enumerate(axes.flat):
         if i < z:
-
-            v_mean = np.array([])
-            v_sd = np.array([])
-
-            # find the mean, STD, of each dir and concatenate w. vector
-            for j in np.arange(t):
-
-                # gives us a subset of the image
-                sample = image[i, c1:c2, c1:c2, j]
-                mean = np.mean(sample)
-                sd = np.std(sample)
-
-                if j == 0:
-                    v_mean = copy(mean)
-                    v_sd = copy(sd)
-                else:
-                    v_mean = np.hstack((v_mean, mean))
-                    v_sd = np.hstack((v_sd, sd))
-
-            # crop out b0 images
-            if bvec is None:
-                v_t = np.arange(t)
-            else:
-                idx = np.where(bvec != 0)[0]
-                v_mean = v_mean[idx]
-                v_sd = v_sd[idx]
-                v_t = np.arange(len(idx))
-
-            # keep track of spikes
-            v_spikes = np.where(v_mean > np.mean(v_mean)+np.mean(v_sd))[0]
-            spikecount = spikecount + len(v_spikes)
+            rows = table[table['slice'] == i]
+            v_mean = rows['mean'].values
+            v_sd = rows['sd'].values
+            v_t = np.arange(len(rows))
 
             ax.plot(v_mean, color='black')
             ax.fill_between(v_t, v_mean-v_sd, v_mean+v_sd, alpha=0.5, color='black')
@@ -582,26 +803,31 @@ def find_epi_spikes(image, filename, pic, ftype, cur=None, bvec=None):
 
         insert_value(cur, ftype, subj, 'spikecount', spikecount)
 
-    plt.subplots_adjust(left=0, right=1, top=0.9, bottom=0)
-    plt.suptitle('{}\nDTI Slice/TR Wise Abnormalities'.format(filename), size=10)
+    fig.subplots_adjust(left=0, right=1, top=0.9, bottom=0)
+    fig.suptitle('{}\nDTI Slice/TR Wise Abnormalities'.format(filename), size=10)
 
 
     fig.savefig(pic, format='png', dpi=FIGDPI)
-    plt.close()
+    plt.close(fig)
+
+    return table
 
 def fmri_plots(func, mask, f, filename, pic, cur=None):
     """
     Calculates and plots:
          + Mean and SD of normalized spectra across brain.
          + Framewise displacement (mm/TR) of head motion.
-         + Mean correlation from 10% of the in-brain voxels.
+         + Mean correlation from 10% of the in-brain voxels (see
+           correlation_summary).
          + EMPTY ADD KEWL PLOT HERE PLZ.
 
     """
+    fig = plt.figure()
+
     ##############################################################################
     # spectra
-    plt.subplot(2,2,1)
-    func = load_masked_data(func, mask)
+    ax = fig.add_subplot(2,2,1)
+    func = dm.utils.load_masked_data(func, mask, dtype=np.float32)
     spec = sig.detrend(func, type='linear')
     spec = sig.periodogram(spec, fs=0.5, return_onesided=True, scaling='density')
     freq = spec[0]
@@ -609,19 +835,18 @@ def fmri_plots(func, mask, f, filename, pic, cur=None):
     sd = np.nanstd(spec, axis=0)
     mean = np.nanmean(spec, axis=0)
 
-    plt.plot(freq, mean, color='black', linewidth=2)
-    plt.plot(freq, mean + sd, color='black', linestyle='-.', linewidth=0.5)
-    plt.plot(freq, mean - sd, color='black', linestyle='-.', linewidth=0.5)
-    plt.title('Whole-brain spectra mean, SD', size=6)
-    plt.xticks(size=6)
-    plt.yticks(size=6)
-    plt.xlabel('Frequency (Hz)', size=6)
-    plt.ylabel('Power', size=6)
-    plt.xticks([])
+    ax.plot(freq, mean, color='black', linewidth=2)
+    ax.plot(freq, mean + sd, color='black', linestyle='-.', linewidth=0.5)
+    ax.plot(freq, mean - sd, color='black', linestyle='-.', linewidth=0.5)
+    ax.set_title('Whole-brain spectra mean, SD', size=6)
+    ax.tick_params(labelsize=6)
+    ax.set_xlabel('Frequency (Hz)', size=6)
+    ax.set_ylabel('Power', size=6)
+    ax.set_xticks([])
 
     ##############################################################################
     # framewise displacement
-    plt.subplot(2,2,2)
+    ax = fig.add_subplot(2,2,2)
     fd_thresh = 0.5
     f = np.genfromtxt(f)
     f[:,0] = np.radians(f[:,0]) * 50 # 50 = head radius, need not be constant.
@@ -631,15 +856,14 @@ def fmri_plots(func, mask, f, filename, pic, cur=None):
     f = np.sum(f, axis=1)
     t = np.arange(len(f))
 
-    plt.plot(t, f.T, lw=1, color='black')
-    plt.axhline(y=fd_thresh, xmin=0, xmax=len(t), color='r')
-    plt.xlim((-3, len(t) + 3)) # this is in TRs
-    plt.ylim(0, 2) # this is in mm/TRs
-    plt.xticks(size=6)
-    plt.yticks(size=6)
-    plt.xlabel('TR', size=6)
-    plt.ylabel('Framewise displacement (mm/TR)', size=6)
-    plt.title('Head motion', size=6)
+    ax.plot(t, f.T, lw=1, color='black')
+    ax.axhline(y=fd_thresh, xmin=0, xmax=len(t), color='r')
+    ax.set_xlim((-3, len(t) + 3)) # this is in TRs
+    ax.set_ylim(0, 2) # this is in mm/TRs
+    ax.tick_params(labelsize=6)
+    ax.set_xlabel('TR', size=6)
+    ax.set_ylabel('Framewise displacement (mm/TR)', size=6)
+    ax.set_title('Head motion', size=6)
 
     if cur:
         fdtot = np.sum(f) # total framewise displacement
@@ -653,23 +877,19 @@ def fmri_plots(func, mask, f, filename, pic, cur=None):
 
     ##############################################################################
     # whole brain correlation
-    plt.subplot(2,2,3)
-    idx = np.random.choice(func.shape[0], func.shape[0]/10, replace=False)
-    corr = func[idx, :]
-    corr = sp.corrcoef(corr, rowvar=1)
-    mean = np.mean(corr, axis=None)
-    std = np.std(corr, axis=None)
-
-    im = plt.imshow(corr, cmap=plt.cm.RdBu_r, interpolation='nearest', vmin=-1, vmax=1)
-    plt.xlabel('Voxel', size=6)
-    plt.ylabel('Voxel', size=6)
-    plt.xticks([])
-    plt.yticks([])
-    cb = plt.colorbar(im)
+    ax = fig.add_subplot(2,2,3)
+    mean, std, corr = correlation_summary(func)
+
+    im = ax.imshow(corr, cmap=plt.cm.RdBu_r, interpolation='nearest', vmin=-1, vmax=1)
+    ax.set_xlabel('Voxel', size=6)
+    ax.set_ylabel('Voxel', size=6)
+    ax.set_xticks([])
+    ax.set_yticks([])
+    cb = fig.colorbar(im, ax=ax)
     cb.set_label('Correlation (r)', labelpad=0, y=0.5, size=6)
     for tick in cb.ax.get_yticklabels():
         tick.set_fontsize(6)
-    plt.title('Whole-brain r mean={}, SD={}'.format(str(mean), str(std)), size=6)
+    ax.set_title('Whole-brain r mean={}, SD={}'.format(str(mean), str(std)), size=6)
 
     if cur:
         subj = filename.split('_')[0:4]
@@ -678,9 +898,9 @@ def fmri_plots(func, mask, f, filename, pic, cur=None):
         insert_value(cur, 'fmri', subj, 'corrmean', mean)
         insert_value(cur, 'fmri', subj, 'corrsd', std)
 
-    plt.suptitle(filename)
-    plt.savefig(pic, format='png', dpi=FIGDPI)
-    plt.close()
+    fig.suptitle(filename)
+    fig.savefig(pic, format='png', dpi=FIGDPI)
+    plt.close(fig)
 
 ###############################################################################
 # PIPELINES
@@ -711,14 +931,11 @@ def fmri_qc(fpath, qcpath, qchtml, cur):
          -prefix {t}/mcorr.nii.gz \
          -twopass -twoblur 3 -Fourier \
          -1Dfile {t}/motion.1D {f}'.format(t=tmpdir, f=fpath))
-    run('3dTstat -prefix {t}/mean.nii.gz {t}/mcorr.nii.gz'.format(t=tmpdir))
-    run('3dAutomask \
-         -prefix {t}/mask.nii.gz \
-         -clfrac 0.5 -peels 3 {t}/mean.nii.gz'.format(t=tmpdir))
-    run('3dTstat -prefix {t}/std.nii.gz  -stdev {t}/mcorr.nii.gz'.format(t=tmpdir))
-    run("""3dcalc \
-           -prefix {t}/sfnr.nii.gz \
-           -a {t}/mean.nii.gz -b {t}/std.nii.gz -expr 'a/b'""".format(t=tmpdir))
+
+    # mean, stdev, sfnr and mask images, kept in memory
+    stats = fmri_stats('{t}/mcorr.nii.gz'.format(t=tmpdir))
+    if AFNI_PARITY:
+        check_afni_parity(tmpdir, stats)
 
     # output BOLD-contrast qc-pic
     BOLDpic = os.path.join(qcpath, filestem + '_BOLD.png')
@@ -727,19 +944,18 @@ def fmri_qc(fpath, qcpath, qchtml, cur):
 
     # output fMRI plots
     fMRIplotspic = os.path.join(qcpath,filestem + '_fmriplots.png')
-    fmri_plots('{t}/mcorr.nii.gz'.format(t=tmpdir),
-                     '{t}/mask.nii.gz'.format(t=tmpdir),
+    fmri_plots('{t}/mcorr.nii.gz'.format(t=tmpdir), stats.mask,
                      '{t}/motion.1D'.format(t=tmpdir), filename, fMRIplotspic, cur)
     add_pic_to_html(qchtml, fMRIplotspic)
 
     SNRpic = os.path.join(qcpath,filestem + '_SNR.png')
-    montage('{t}/sfnr.nii.gz'.format(t=tmpdir),
-                  'SFNR', filename, SNRpic, cmaptype='hot', maxval=0.75)
+    montage(stats.sfnr, 'SFNR', filename, SNRpic, cmaptype='hot', maxval=0.75)
     add_pic_to_html(qchtml, SNRpic)
 
 
     Spikespic = os.path.join(qcpath,filestem + '_Spikes.png')
-    find_epi_spikes(fpath, filename, Spikespic, 'fmri', cur=cur)
+    spikes = find_epi_spikes(fpath, filename, Spikespic, 'fmri', cur=cur)
+    spikes.to_csv(os.path.join(qcpath, filestem + '_spikes.csv'), index=False)
     add_pic_to_html(qchtml, Spikespic)
 
     # run metrics from qascripts toolchain
@@ -816,7 +1032,8 @@ def dti_qc(fpath, qcpath, qchtml, cur):
     add_pic_to_html(qchtml, dti4dpic)
 
     spikespic = os.path.join(qcpath, filestem + '_spikes.png')
-    find_epi_spikes(fpath, filename, spikespic, 'dti', cur=cur, bvec=bvec)
+    spikes = find_epi_spikes(fpath, filename, spikespic, 'dti', cur=cur, bvec=bvec)
+    spikes.to_csv(os.path.join(qcpath, filestem + '_spikes.csv'), index=False)
     add_pic_to_html(qchtml, spikespic)
 
     # run metrics from qascripts toolchain
@@ -829,9 +1046,15 @@ def dti_qc(fpath, qcpath, qchtml, cur):
 
     run('rm -r {}'.format(tmpdir))
 
-def add_header_checks(fpath, qchtml, logdata):
+def add_header_checks(fpath, qchtml, checks):
+    """
+    Adds the header mismatches of a scan to the html, from a map of series ->
+    datman.checkdb Mismatches.
+    """
     filestem = os.path.basename(fpath).replace(dm.utils.get_extension(fpath),'')
-    lines = [re.sub('^.*?: *','',line) for line in logdata if filestem in line]
+    lines = ['header {}, expected = {}, actual = {} [tolerance = {}]'.format(
+                 m.header, m.expected, m.actual, m.tolerance)
+             for m in checks.get(filestem, [])]
     if not lines:
         return
 
@@ -840,9 +1063,18 @@ def add_header_checks(fpath, qchtml, logdata):
         qchtml.write('<tr><td>{}</td></tr>'.format(l))
     qchtml.write('</table>\n')
 
-def add_bvec_checks(fpath, qchtml, logdata):
+def add_bvec_checks(fpath, qchtml, checks):
+    """
+    Adds the bvec/bval differences of a scan to the html, from a map of
+    series -> datman.checkdb Mismatches.
+    """
     filestem = os.path.basename(fpath).replace(dm.utils.get_extension(fpath),'')
-    lines = [re.sub('^.*'+filestem,'',line) for line in logdata if filestem in line]
+    lines = []
+    for m in checks.get(filestem, []):
+        if m.expected is not None:
+            lines.append('.{}: + {}'.format(m.header, m.expected))
+        else:
+            lines.append('.{}: - {}'.format(m.header, m.actual))
     if not lines:
         return
 
@@ -853,40 +1085,109 @@ def add_bvec_checks(fpath, qchtml, logdata):
         qchtml.write('<tr><td>{}</td></tr>'.format(l))
     qchtml.write('</table>\n')
     
-def add_old_image(fpath, qcpath, qchtml, tag):
-    fname = nifti_basename(fpath)
-    fname = os.path.join(qcpath, fname)
-    
-    if os.path.exists(fname + '.png'):
-        add_pic_to_html(qchtml, fname + '.png')
-        return
-    elif os.path.exists(fname + '_BOLD.png'):
-        add_pic_to_html(qchtml, fname + '_BOLD.png')
-        add_pic_to_html(qchtml, fname + '_fmriplots.png')
-        add_pic_to_html(qchtml, fname + '_SNR.png')
-        add_pic_to_html(qchtml, fname + '_Spikes.png')
-    elif os.path.exists(fname + '_B0.png'):
-        add_pic_to_html(qchtml, fname + '_B0.png')
-        add_pic_to_html(qchtml, fname + '_dti4d.png')
-        add_pic_to_html(qchtml, fname + '_spikes.png')
-    elif tag == 'PDT2':
-        add_pic_to_html(qchtml, fname.replace('_PDT2_','_PD_') + '.png')
-        add_pic_to_html(qchtml, fname.replace('_PDT2_', '_T2_') + '.png')
-        
-        
+###############################################################################
+# QC CACHE
+
+def file_digest(path):
+    """
+    Returns the SHA1 hex digest of a file's contents.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024*1024), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_qc_inputs(fpath):
+    """
+    Returns the files the QC of a scan is made from: the scan, any .bvec and
+    .bval alongside it, and for PDT2 scans the split PD and T2 images.
+    """
+    stem = fpath[:-len(dm.utils.get_extension(fpath))]
+    candidates = [fpath, stem + '.bvec', stem + '.bval',
+                  fpath.replace('_PDT2_', '_PD_'),
+                  fpath.replace('_PDT2_', '_T2_')]
+
+    inputs = []
+    for path in candidates:
+        if path not in inputs and os.path.exists(path):
+            inputs.append(path)
+    return inputs
+
+def get_qc_key(handler, fpath, entry=None):
+    """
+    Returns the cache key for the QC of a scan by handler, and the stats
+    (mtime, size) of its inputs.
+
+    The key is made of the handler's name, QC_VERSION, the plot settings, and
+    the SHA1 of each input. Digests are reused from a cached entry for inputs
+    whose stats haven't changed.
+    """
+    old_stats = entry['stats'] if entry else {}
+    old_inputs = entry['key']['inputs'] if entry else {}
+
+    # inputs are named by file name alone, so that the cache still works
+    # when the data folder is given by another path
+    stats = {}
+    inputs = {}
+    for path in get_qc_inputs(fpath):
+        name = os.path.basename(path)
+        st = os.stat(path)
+        stats[name] = [st.st_mtime, st.st_size]
+        if old_stats.get(name) == stats[name] and name in old_inputs:
+            inputs[name] = old_inputs[name]
+        else:
+            inputs[name] = file_digest(path)
+
+    key = {'handler': handler.__name__,
+           'version': QC_VERSION,
+           'figdpi': FIGDPI,
+           'inputs': inputs}
+    return key, stats
+
+def load_qc_cache(cachefile):
+    """
+    Returns the cached QC of a subject, a map from scan file name to entry
+    (see write_qc_page).
+    """
+    if not os.path.exists(cachefile):
+        return {}
+    try:
+        with open(cachefile) as f:
+            return json.load(f)
+    except ValueError:
+        logger.warn("Ignoring unreadable QC cache {}".format(cachefile))
+        return {}
+
+def is_cached(entry, key, qcpath):
+    """
+    True if a cache entry matches key, and all of its pics still exist.
+    """
+    if not entry or entry['key'] != key:
+        return False
+    return all(os.path.exists(os.path.join(qcpath, pic))
+               for pic in entry['pics'])
+
 ###############################################################################
 # MAIN
 
-def qc_folder(scanpath, subject, qcdir, cur, pconfig, QC_HANDLERS):
+def qc_folder(scanpath, subject, qcdir, pconfig, QC_HANDLERS, checkdb=None):
     """
-    QC all the images in a folder (scanpath).
+    Plans the QC of all the images in a folder (scanpath).
 
     Outputs PDF and other files to outputdir. All files named startng with
     subject.
 
-    'cur' is a cursor pointing to the QC database.
-
     pconfig is loaded from the project_settings.yml file
+
+    checkdb is the datman.checkdb.CheckDatabase of header and bvec checks, if
+    any.
+
+    Returns None if the subject has already been QC'd, otherwise the path to
+    the subject's html page, a list of its parts in order, and the cache
+    entries of the scans that don't need QC'ing again. Each part is either a
+    QCJob to run (see run_qc_job) or an (html, MetricsBuffer) pair that is
+    ready to write out (see write_qc_page).
     """
 
     qcdir = dm.utils.define_folder(qcdir)
@@ -895,15 +1196,15 @@ def qc_folder(scanpath, subject, qcdir, cur, pconfig, QC_HANDLERS):
     htmlfile = os.path.join(qcpath, 'qc_{}.html'.format(subject))
     if os.path.exists(htmlfile) and not REWRITE:
         logger.debug("{} exists, skipping.".format(htmlfile))
-        return
+        return None
+
+    cache = load_qc_cache(os.path.join(qcpath, 'qc_{}.json'.format(subject)))
+    cached = {}
 
-    if REWRITE:
-        try: 
-            os.remove(htmlfile)
-        except:
-            print("{} does not exist. Reconstructing html file from any images present.".format(htmlfile))
+    parts = []
+    qchtml = HtmlBuffer(htmlfile)
+    metrics = MetricsBuffer('')
 
-    qchtml = open(htmlfile,'a')
     qchtml.write('<HTML><TITLE>{} qc</TITLE>\n'.format(subject))
     qchtml.write('<head>\n<style>\n'
                 'body { font-family: futura,sans-serif;'
@@ -929,11 +1230,6 @@ def qc_folder(scanpath, subject, qcdir, cur, pconfig, QC_HANDLERS):
 
     qchtml.write('<h1> QC report for {} <h1/>'.format(subject))
 
-    # add in sites to the database
-    insert_value(cur, 'fmri', subject, 'site', subject.split('_')[1])
-    insert_value(cur, 'dti', subject, 'site', subject.split('_')[1])
-    insert_value(cur, 't1', subject, 'site', subject.split('_')[1])
-
     ## now read exportinfo from config_yml
     exportinfo = found_files_df(pconfig, scanpath, subject)
     qchtml_writetable(qchtml, exportinfo)
@@ -954,45 +1250,110 @@ def qc_folder(scanpath, subject, qcdir, cur, pconfig, QC_HANDLERS):
         else:
             qchtml.write('<p>Tech Notes not found</p>\n')
 
-    # load up any header/bvec check log files for the subjectt
-    header_check_logs = glob.glob(os.path.join(
-                         qcdir, 'logs', 'dm-check-headers-{}*'.format(subject)))
-    header_check_log = []
-    for logfile in header_check_logs:
-        header_check_log += open(logfile).readlines()
-
-    # load up any header/bvec check log files for the subjectt
-    bvecs_check_logs = glob.glob(os.path.join(
-                           qcdir, 'logs', 'dm-check-bvecs-{}*'.format(subject)))
-    bvecs_check_log = []
-    for logfile in bvecs_check_logs:
-        bvecs_check_log += open(logfile).readlines()
+    # load up any header/bvec check results for the subject, by series
+    header_checks, bvecs_checks = {}, {}
+    if checkdb is not None:
+        header_checks = checkdb.get_by_series('dm-check-headers', subject)
+        bvecs_checks = checkdb.get_by_series('dm-check-bvecs', subject)
 
     for idx in range(0,len(exportinfo)):
         bname = exportinfo.loc[idx,'File']
         if bname!='' :
             fname = os.path.join(scanpath, bname)
-            logger.info("QC scan {}".format(fname))
             ident, tag, series, description = dm.scanid.parse_filename(fname)
             qchtml.write('<h2 id="{}">{}</h2>\n'.format(exportinfo.loc[idx,'bookmark'], bname))
             if tag not in QC_HANDLERS:
                 logger.info("MSG: No QC tag {} for scan {}. Skipping.".format(
                                                                     tag, fname))
                 continue
-            if header_check_log and tag!='PDT2':
-                add_header_checks(fname, qchtml, header_check_log)
-            if bvecs_check_log:
-                add_bvec_checks(fname, qchtml, bvecs_check_log)
+            if header_checks and tag!='PDT2':
+                add_header_checks(fname, qchtml, header_checks)
+            if bvecs_checks:
+                add_bvec_checks(fname, qchtml, bvecs_checks)
                 
-            if not REWRITE:    
-                QC_HANDLERS[tag](fname, qcpath, qchtml, cur)
+            handler = QC_HANDLERS[tag]
+            entry = cache.get(bname)
+            key, stats = get_qc_key(handler, fname, entry)
+
+            if is_cached(entry, key, qcpath):
+                logger.debug("Using cached QC of {}".format(fname))
+                qchtml.write(entry['html'])
+                cached[bname] = entry
             else:
-                add_old_image(fname, qcpath, qchtml, tag)
-                
+                # the scan's own html comes from the job, between what has
+                # been written so far and what follows
+                parts.append((qchtml.getvalue(), metrics))
+                parts.append(QCJob(handler, fname, qcpath, htmlfile, key, stats))
+                qchtml = HtmlBuffer(htmlfile)
+                metrics = MetricsBuffer('')
+
             qchtml.write('<br>')
 
+    parts.append((qchtml.getvalue(), metrics))
+    return htmlfile, parts, cached
+
+def run_qc_job(job):
+    """
+    Runs the QC handler of a QCJob.
+
+    Returns the html, the database values (a MetricsBuffer), and the pics
+    produced.
+    """
+    logger.info("QC scan {}".format(job.fpath))
+    qchtml = HtmlBuffer(job.htmlfile)
+    metrics = MetricsBuffer(nifti_basename(job.fpath))
+    job.handler(job.fpath, job.qcpath, qchtml, metrics)
+    return qchtml.getvalue(), metrics, qchtml.pics
+
+def run_qc_jobs(jobs, n_jobs=1):
+    """
+    Runs a list of QCJobs across a pool of n_jobs processes.
+
+    Returns an iterator over the results of run_qc_job(), in the same order as
+    the jobs.
+    """
+    if n_jobs == 1 or len(jobs) <= 1:
+        return itertools.imap(run_qc_job, jobs)
+
+    pool = multiprocessing.Pool(n_jobs)
+    results = pool.imap(run_qc_job, jobs)
+    pool.close()
+    return results
+
+def write_qc_page(htmlfile, parts, cached, results, qcdb):
+    """
+    Writes out a subject's html page, its values to the QC database (a
+    datman.qcdb.QCDatabase) in one transaction, and its QC cache.
+
+    parts and cached are from qc_folder(), and results is an iterator that
+    yields the result for each QCJob among the parts (in order).
+
+    The cache maps each scan's file name to an entry with the key of its QC
+    (see get_qc_key), the stats of its inputs, its html, and its pics.
+    """
+    qchtml = open(htmlfile, 'w')
+    rows = []
+    cache = dict(cached)
+    for part in parts:
+        if isinstance(part, QCJob):
+            html, metrics, pics = next(results)
+            cache[os.path.basename(part.fpath)] = {
+                    'key': part.key, 'stats': part.stats,
+                    'html': html, 'pics': pics}
+        else:
+            html, metrics = part
+        qchtml.write(html)
+        rows.extend(metrics.rows)
     qchtml.close()
 
+    qcdb.write(rows)
+
+    # nothing was made in a dry run, so there is nothing to cache
+    if not DRYRUN:
+        cachefile = htmlfile[:-len('.html')] + '.json'
+        with open(cachefile, 'w') as f:
+            json.dump(cache, f)
+
 def main():
     """
     This spits out our QCed data
@@ -1001,6 +1362,7 @@ def main():
     global DEBUG
     global DRYRUN
     global REWRITE
+    global AFNI_PARITY
 
     QC_HANDLERS = {   # map from tag to QC function
             "T1"            : t1_qc,
@@ -1047,6 +1409,8 @@ def main():
     VERBOSE   = arguments['--verbose']
     DEBUG     = arguments['--debug']
     DRYRUN    = arguments['--dry-run']
+    n_jobs    = int(arguments['--jobs'])
+    AFNI_PARITY = arguments['--afni-parity']
 
     if VERBOSE:
         logging.getLogger().setLevel(logging.INFO)
@@ -1060,24 +1424,24 @@ def main():
 
     if not dbdir: dbdir = qcdir
     db_filename = '{}/subject-qc.db'.format(dbdir)
-    db_is_new = not os.path.exists(db_filename)
 
     try:
-        db = sqlite3.connect(db_filename)
-    except:
+        qcdb = dm.qcdb.QCDatabase(db_filename)
+    except sqlite3.Error:
         logger.error('Invalid database path, or permissions issue.')
         sys.exit('Invalid database path, or permissions issue.')
 
-    cur = db.cursor()
-
-    # initialize the tables if the database does not yet exist
-    if db_is_new == True:
-        create_db(cur)
+    # the results of dm-check-headers and dm-check-bvecs, if they've been run
+    checkdb_filename = os.path.join(qcdir, 'logs', dm.checkdb.DB_NAME)
+    checkdb = None
+    if os.path.exists(checkdb_filename):
+        checkdb = dm.checkdb.CheckDatabase(checkdb_filename)
 
     # load the yml of project settings
     with open(ymlfile, 'r') as stream:
         pconfig = yaml.load(stream)
 
+    pages = []
     for path in glob.glob(timepoint_glob):
         subject = os.path.basename(path)
 
@@ -1086,11 +1450,24 @@ def main():
             pass
         else:
             logger.info("QCing folder {}".format(path))
-            qc_folder(path, subject, qcdir, cur, pconfig, QC_HANDLERS)
+            page = qc_folder(path, subject, qcdir, pconfig, QC_HANDLERS,
+                             checkdb)
+            if page:
+                pages.append(page)
+
+    # run the scan QC of every subject at once, then write each page (and
+    # its database values) here as its results come in
+    jobs = [part for htmlfile, parts, cached in pages
+                 for part in parts if isinstance(part, QCJob)]
+    results = run_qc_jobs(jobs, n_jobs)
+
+    for htmlfile, parts, cached in pages:
+        write_qc_page(htmlfile, parts, cached, results, qcdb)
 
     # close database properly
-    cur.close()
-    db.close()
+    qcdb.close()
+    if checkdb is not None:
+        checkdb.close()
 
 if __name__ == "__main__":
     main()
@@ -43,7 +43,7 @@ def get_scan_date(subj):
 
     for f in files:
         try:
-            d = dcm.read_file(os.path.join(subj, f))
+            d = dm.utils.read_headers(os.path.join(subj, f))
             date = d.SeriesDate
             date = datetime.date(int(date[0:4]), int(date[4:6]), int(date[6:8]))
             return date
@@ -28,7 +28,7 @@ import sys, os
 from copy import copy
 from docopt import docopt
 import datman as dm
-import sqlite3
+import datman.qcdb
 
 VERBOSE = False
 DRYRUN  = False
@@ -95,32 +95,18 @@ def convert_to_web(base_path, files):
                     f=f, output=f[9:]))
         os.system(cmd)
 
-def parse_db_cols(cur, table):
+def parse_db_cols(qcdb, table):
     """
-    Get the column names from the database.
+    Get the metric names of a type of QC (fmri, dti, t1) from the database
+    (a datman.qcdb.QCDatabase).
     """
-    cur.execute('PRAGMA table_info({})'.format(table))
-    d = cur.fetchall()
+    return qcdb.get_metrics(table)
 
-    cols = []
-    for col in d:
-        cols.append(str(col[1]))
-
-    return cols
-
-def get_subjects(cur, table):
+def get_subjects(qcdb, table):
     """
-    Get all of the subjects from the specified table in the database.
+    Get all of the subjects of a type of QC in the database.
     """
-    cur.execute('SELECT subj FROM {}'.format(table))
-    d = cur.fetchall()
-
-    subj = []
-    for sub in d:
-        subj.append(str(sub[0]))
-    subj.sort()
-
-    return subj
+    return qcdb.get_subjects(table)
 
 def get_sites(subj):
     """
@@ -134,31 +120,24 @@ def get_sites(subj):
 
     return sites
 
-def get_data(cur, table, col):
+def get_data(qcdb, table, col):
     """
-    Get all of the data from a specified table in the database.
+    Get all of the values of a metric of a type of QC in the database, one
+    per scan (ordered by subject).
     """
-    cur.execute('SELECT {} FROM {}'.format(col, table))
-    d = cur.fetchall()
-
-    data = []
-    for dat in d:
-        data.append(dat[0])
-
-    return data
+    return [row[col] for row in qcdb.table(table, [col])]
 
 
 # def read_subj_qc_database(base_path):
 #     """
 #     """
-#     db = sqlite3.connect('{}/qc/subject-qc.db'.format(base_path))
-#     cur = db.cursor()
+#     qcdb = dm.qcdb.QCDatabase('{}/qc/subject-qc.db'.format(base_path))
 
-#     fmri_cols = parse_db_cols(cur, 'fmri')
-#     dti_cols = parse_db_cols(cur, 'dti')
+#     fmri_cols = parse_db_cols(qcdb, 'fmri')
+#     dti_cols = parse_db_cols(qcdb, 'dti')
 
-#     fmri_subj = get_subjects(cur, 'fmri')
-#     dti_subj = get_subjects(cur, 'dti')
+#     fmri_subj = get_subjects(qcdb, 'fmri')
+#     dti_subj = get_subjects(qcdb, 'dti')
 #     subj = list(set().union(fmri_subj + dti_subj))
 #     subj.sort()
 
@@ -13,6 +13,17 @@ Options:
     --exportinfo FILE       Table listing acquisitions to export by format
                             [default: ./metadata/exportinfo.csv]
     --blacklist FILE        Table listing series to ignore
+    --header-index FILE     Database of dicom headers to consult (and update)
+                            rather than re-reading unchanged dicoms
+    -j, --jobs N            Number of series folders to scan, and of series
+                            exports to run, at once [default: 1]
+    --archive-jobs N        Number of archives to export at once, each in its
+                            own process [default: 1]
+    --manifest FILE         Write a CSV of every export job run (archive,
+                            series, format, status, seconds) to FILE
+    --ledger FILE           Database of past exports, used to skip archives
+                            and series that haven't changed since (see below)
+    --retry-failed          Retry failed exports recorded in the ledger
     -v, --verbose           Show intermediate steps
     --debug                 Show debug messages
     -n, --dry-run           Do nothing
@@ -90,6 +101,18 @@ EXPORT TABLE FORMAT
     DTI-33-b3000  b3000   no          yes         yes          1
     DTI-33-b1000  b1000   no          yes         yes          1
 
+EXTRACTION LEDGER
+    With --ledger, a record is kept of each archive and series exported: a
+    fingerprint of the SCANS/ folder (from the name, size and modification
+    time of every file within it), the status of each series export, and a
+    fingerprint of the export tools (the exportinfo table and loaded
+    environment modules).
+
+    On later runs, archives whose fingerprint and tools are unchanged are
+    skipped without reading any headers, and within changed archives only new
+    or modified series are exported. Series that failed to export are not
+    retried unless they change, the tools change, or --retry-failed is given.
+
 NON-DICOM DATA
     XNAT puts "other" (i.e. non-DICOM data) into the RESOURCES folder. This
     data will be copied to a subfolder of the data directory named
@@ -110,18 +133,30 @@ EXAMPLES
 
     xnat-extract.py /xnat/spred/archive/SPINS/arc001/SPN01_CMH_0001_01_01
 
+    To export a whole project, four archives at a time, and keep a record of
+    what was done:
+
+    xnat-extract.py --archive-jobs 4 --manifest extract-run.csv \\
+        /xnat/spred/archive/SPINS/arc001/*
+
 """
 from docopt import docopt
 import pandas as pd
 import datman as dm
 import datman.utils
 import datman.scanid
+import datman.headerindex
+import collections
+import hashlib
+import multiprocessing
 import os.path
+import sqlite3
 import sys
 import subprocess as proc
 import tempfile
 import glob
 import shutil
+import time
 
 DEBUG  = False
 VERBOSE= False
@@ -147,6 +182,7 @@ def makedirs(path):
     if not DRYRUN: os.makedirs(path)
 
 def run(cmd):
+    """Runs a shell command, returning its exit code (0 on a dry run)."""
     debug("exec: {}".format(cmd))
     if not DRYRUN:
         p = proc.Popen(cmd, shell=True, stdout=proc.PIPE, stderr=proc.PIPE)
@@ -159,6 +195,8 @@ def run(cmd):
             debug("rtnval: {}".format(p.returncode))
             out and debug("stdout: \n>\t{}".format(out.replace('\n','\n>\t')))
             err and debug("stderr: \n>\t{}".format(err.replace('\n','\n>\t')))
+        return p.returncode
+    return 0
 
 def main():
     global DEBUG
@@ -169,6 +207,12 @@ def main():
     exportinfofile = arguments['--exportinfo']
     datadir        = arguments['--datadir']
     blacklist      = arguments['--blacklist'] or []
+    indexfile      = arguments['--header-index']
+    jobs           = int(arguments['--jobs'])
+    archive_jobs   = int(arguments['--archive-jobs'])
+    manifestfile   = arguments['--manifest']
+    ledgerfile     = arguments['--ledger']
+    retry_failed   = arguments['--retry-failed']
     VERBOSE        = arguments['--verbose']
     DEBUG          = arguments['--debug']
     DRYRUN         = arguments['--dry-run']
@@ -187,12 +231,242 @@ def main():
                     blacklist))
             bl = []
 
+    plan = get_export_plan(exportinfo)
+    if plan is None:
+        return
+
+    ledger = None
+    if ledgerfile:
+        ledger = ExtractionLedger(ledgerfile,
+                get_tools_fingerprint(exportinfofile), retry_failed)
+
+    tasks = []
+    skipped = []
+    fingerprints = {}
     for archivepath in archives:
-        verbose("Exporting {}".format(archivepath))
-        extract_archive(exportinfo, archivepath, datadir, blacklist)
+        archivepath = os.path.normpath(archivepath)
+        done = {}
+        if ledger:
+            fingerprint = get_archive_fingerprint(archivepath)
+            fingerprints[archivepath] = fingerprint
+            if ledger.is_current(archivepath, fingerprint):
+                verbose("{} unchanged since last export. Skipping.".format(
+                    archivepath))
+                skipped.append(ExportRecord(archivepath, '', '', 'unchanged',
+                    0.0, '', fingerprint))
+                continue
+            done = ledger.get_exported_series(archivepath)
+        tasks.append((plan, archivepath, datadir, blacklist, indexfile, jobs,
+            done))
+
+    if archive_jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(archive_jobs, len(tasks)))
+        try:
+            results = pool.map(extract_archive_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(extract_archive_task, tasks)
+
+    records = skipped + [r for rs in results for r in rs]
+
+    if ledger and not DRYRUN:
+        ledger.update(dict((task[1], fingerprints[task[1]]) for task in tasks),
+                records)
+        ledger.close()
+
+    if manifestfile:
+        write_manifest(manifestfile, records)
+
+def extract_archive_task(task):
+    """
+    Extracts a single archive, for use with a (process) pool.
+
+    <task> is a tuple (plan, archivepath, exportdir, blacklist, indexfile,
+    jobs, done). Each task opens its own header index, since they can't be
+    shared between processes.
+    """
+    plan, archivepath, exportdir, blacklist, indexfile, jobs, done = task
+    index = indexfile and datman.headerindex.HeaderIndex(indexfile) or None
+
+    verbose("Exporting {}".format(archivepath))
+    try:
+        return extract_archive(plan, archivepath, exportdir, blacklist,
+                index, jobs, done)
+    except Exception, e:
+        error("{}: export failed: {}".format(archivepath, e))
+        return [ExportRecord(archivepath, '', '', 'failed', 0.0, '', '')]
+    finally:
+        if index:
+            index.close()
+
+# The outcome of an export job. <source> is the series folder exported and
+# <fingerprint> the fingerprint of the series (or archive, for records about a
+# whole archive) when it was exported.
+ExportRecord = collections.namedtuple('ExportRecord',
+        ['archive', 'series', 'format', 'status', 'seconds', 'source',
+         'fingerprint'])
+
+def write_manifest(path, records):
+    """
+    Writes a CSV run manifest of export records (archive, series, format,
+    status, seconds).
+    """
+    columns = ['archive', 'series', 'format', 'status', 'seconds']
+    data = pd.DataFrame([r[:len(columns)] for r in records], columns=columns)
+    data.to_csv(path, index=False, float_format='%.2f')
+
+def get_folder_fingerprint(path):
+    """
+    Fingerprints the files within a folder (and its subfolders) from the name,
+    size and modification time of each, so that a file rewritten in place is
+    noticed even if the folder's own modification time is unchanged.
+
+    Modification times are taken with repr() so none of their precision is
+    lost. Returns '' if <path> is not a folder.
+    """
+    if not os.path.isdir(path):
+        return ''
+
+    members = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            filepath = os.path.join(dirpath, filename)
+            st = os.stat(filepath)
+            members.append((os.path.relpath(filepath, path), st.st_size,
+                            repr(st.st_mtime)))
+    return hashlib.md5(repr(members)).hexdigest()
+
+def get_archive_fingerprint(archivepath):
+    """
+    Fingerprints the SCANS/ folder of an XNAT archive (see
+    get_folder_fingerprint).
+    """
+    return get_folder_fingerprint(os.path.join(archivepath, 'SCANS'))
+
+def get_tools_fingerprint(exportinfofile):
+    """
+    Fingerprints the export configuration: the exportinfo table and the
+    loaded environment modules (which pin the versions of the converters).
+    """
+    h = hashlib.md5()
+    h.update(open(exportinfofile).read())
+    h.update(dm.utils.get_loaded_modules())
+    return h.hexdigest()
+
+class ExtractionLedger:
+    """
+    A record of past exports, stored in an SQLite database.
+
+    The archives table records the fingerprint of each archive exported, and
+    the series table the status of each (series, format) export along with the
+    fingerprint of the series at the time. Entries are only valid for the
+    tools fingerprint they were recorded with.
+    """
+
+    def __init__(self, path, tools, retry_failed=False):
+        self.tools = tools
+        self.retry_failed = retry_failed
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.db.execute('CREATE TABLE IF NOT EXISTS archives ('
+                        'archive TEXT PRIMARY KEY, fingerprint TEXT, '
+                        'tools TEXT, failures INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS series ('
+                        'archive TEXT, source TEXT, format TEXT, '
+                        'fingerprint TEXT, tools TEXT, status TEXT, '
+                        'PRIMARY KEY (archive, source, format))')
+        self.db.commit()
+
+    def is_current(self, archive, fingerprint):
+        """
+        Returns True if <archive> was exported with the current tools and is
+        unchanged since.
+        """
+        row = self.db.execute('SELECT fingerprint, tools, failures '
+                              'FROM archives WHERE archive = ?',
+                              (archive,)).fetchone()
+        if row is None:
+            return False
+        if self.retry_failed and row[2]:
+            return False
+        return row[:2] == (fingerprint, self.tools)
+
+    def get_exported_series(self, archive):
+        """
+        Returns a map from (source, format) -> fingerprint of the series of
+        <archive> that needn't be exported again if they are unchanged.
+        """
+        sql = 'SELECT source, format, fingerprint FROM series ' \
+              'WHERE archive = ? AND tools = ?'
+        if self.retry_failed:
+            sql += " AND status != 'failed'"
+        rows = self.db.execute(sql, (archive, self.tools)).fetchall()
+        return dict(((source, fmt), fingerprint)
+                    for source, fmt, fingerprint in rows)
+
+    def update(self, archives, records):
+        """
+        Records the outcome of a run.
+
+        <archives> maps each archive exported to its fingerprint (taken
+        before the export), and <records> is the list of ExportRecords.
+        """
+        failures = collections.defaultdict(int)
+        for r in records:
+            if r.status == 'failed':
+                failures[r.archive] += 1
+            if r.format and r.status != 'unchanged':
+                self.db.execute('INSERT OR REPLACE INTO series '
+                                'VALUES (?, ?, ?, ?, ?, ?)',
+                                (r.archive, r.source, r.format,
+                                 r.fingerprint, self.tools, r.status))
+
+        for archive, fingerprint in archives.iteritems():
+            self.db.execute('INSERT OR REPLACE INTO archives '
+                            'VALUES (?, ?, ?, ?)',
+                            (archive, fingerprint, self.tools,
+                             failures[archive]))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+# Everything about an exportinfo table needed to export a series, worked out
+# once up front: the formats to export, the tag patterns, and the formats to
+# export for each tag.
+ExportPlan = collections.namedtuple('ExportPlan',
+        ['formats', 'tagmap', 'tag_formats'])
+
+def get_export_plan(exportinfo):
+    """
+    Compiles an exportinfo table into an ExportPlan.
+
+    Returns None (after complaining) if the table asks for unknown formats.
+    """
+    fmts         = get_formats_from_exportinfo(exportinfo)
+    unknown_fmts = [fmt for fmt in fmts if fmt not in exporters]
+
+    if len(unknown_fmts) > 0:
+        error("Unknown formats requested for export: {}.".format(
+              ",".join(unknown_fmts)))
+        return None
+
+    tagmap = dm.utils.TagMatcher(
+            zip(exportinfo['pattern'].tolist(), exportinfo['tag'].tolist()))
+
+    tag_formats = {}
+    for tag in set(exportinfo['tag'].tolist()):
+        tag_exportinfo = exportinfo[exportinfo['tag'] == tag]
+        tag_formats[tag] = [fmt for fmt in fmts
+                if not all(tag_exportinfo['export_'+fmt] == 'no')]
 
+    return ExportPlan(formats=fmts, tagmap=tagmap, tag_formats=tag_formats)
 
-def extract_archive(exportinfo, archivepath, exportdir, blacklist):
+def extract_archive(plan, archivepath, exportdir, blacklist,
+        index=None, jobs=1, done=None):
     """
     Exports an XNAT archive to various file formats.
 
@@ -203,6 +477,16 @@ def extract_archive(exportinfo, archivepath, exportdir, blacklist):
     This function searches through the SCANS subfolder (archivepath) for series
     and converts each series, placing them in an appropriately named folder
     under exportdir.
+
+    If given, the header <index> is used to avoid re-reading unchanged dicoms.
+    Series folders are scanned for headers, and the (series, format) exports
+    are run, with <jobs> threads.
+
+    <done> is a map from (series folder, format) -> series fingerprint of
+    exports that needn't be redone if the series is unchanged (see
+    ExtractionLedger).
+
+    Returns a list of ExportRecords.
     """
 
     archivepath = os.path.normpath(archivepath)
@@ -213,44 +497,65 @@ def extract_archive(exportinfo, archivepath, exportdir, blacklist):
     except datman.scanid.ParseException, e:
         error("{} folder is not named according to the data naming policy. " \
               "Skipping".format(archivepath))
-        return
+        return [ExportRecord(archivepath, '', '', 'failed', 0.0, '', '')]
 
     scanspath = os.path.join(archivepath,'SCANS')
     if not os.path.isdir(scanspath):
         error("{} doesn't exist. Not an XNAT archive. "\
               "Skipping.".format(scanspath))
-        return
-
-    fmts         = get_formats_from_exportinfo(exportinfo)
-    unknown_fmts = [fmt for fmt in fmts if fmt not in exporters]
-
-    if len(unknown_fmts) > 0:
-        error("Unknown formats requested for export of {}: {}. " \
-              "Skipping.".format(archivepath, ",".join(unknown_fmts)))
-        return
+        return [ExportRecord(archivepath, '', '', 'failed', 0.0, '', '')]
 
     # export each series to datadir/fmt/subject/
     timepoint = scanid.get_full_subjectid_with_timepoint()
 
     stem  = str(scanid)
-    for src, header in dm.utils.get_archive_headers(archivepath).items():
-        export_series(exportinfo, src, header, fmts, timepoint, stem,
-                exportdir, blacklist)
+    exportjobs = []
+    for src, header in dm.utils.get_archive_headers(archivepath,
+            index=index, jobs=jobs).items():
+        exportjobs.extend(export_series(plan, src, header, timepoint, stem,
+                exportdir, blacklist))
+
+    # skip series exported before that haven't changed since
+    done = done or {}
+    fingerprints = dict((src, get_folder_fingerprint(src))
+                        for src in set(job[1] for job in exportjobs))
+    records = []
+    todo = []
+    for job in exportjobs:
+        fmt, src, outputdir, stem = job
+        if done.get((src, fmt)) == fingerprints[src]:
+            debug("{}: {} unchanged since last export. Skipping.".format(
+                src, fmt))
+            records.append(ExportRecord(archivepath, stem, fmt, 'unchanged',
+                0.0, src, fingerprints[src]))
+        else:
+            todo.append(job)
+
+    results = dm.utils.parallel_map(run_export_job, todo, jobs)
+    debug("{}: {} export jobs took {:.1f}s in total".format(
+        archivepath, len(results), sum([r[2] for r in results])))
 
     # export non dicom resources
     export_resources(archivepath, exportdir, scanid)
 
-def export_series(exportinfo, src, header, formats, timepoint, stem,
-        exportdir, blacklist):
+    for job, status, seconds in results:
+        fmt, src, outputdir, stem = job
+        records.append(ExportRecord(archivepath, stem, fmt, status, seconds,
+            src, fingerprints[src]))
+    return records
+
+def export_series(plan, src, header, timepoint, stem, exportdir, blacklist):
     """
-    Exports the given DICOM folder into the given formats.
+    Plans the export of the given DICOM folder into the formats of the given
+    ExportPlan.
+
+    Returns a list of export jobs, (fmt, src, outputdir, stem) tuples, to be
+    run with run_export_job().
     """
     description   = header.get("SeriesDescription")
     mangled_descr = dm.utils.mangle(description)
     series        = str(header.get("SeriesNumber")).zfill(2)
-    tagmap        = dict(zip(exportinfo['pattern'].tolist(),
-                             exportinfo['tag'].tolist()))
-    tag           = dm.utils.guess_tag(mangled_descr, tagmap)
+    tag           = dm.utils.guess_tag(mangled_descr, plan.tagmap)
 
     debug("{}: description = {}, series = {}, tag = {}".format(
         src, description, series, tag))
@@ -258,23 +563,22 @@ def export_series(exportinfo, src, header, formats, timepoint, stem,
     if not tag:
         verbose("No matching export pattern for {}, descr: {}. Skipping".format(
             src, description))
-        return
+        return []
     elif type(tag) is list:
         error("Multiple export patterns match for {}, descr: {}, tags: {}".format(
             src, description, tag))
-        return
-
-    tag_exportinfo = exportinfo[exportinfo['tag'] == tag]
+        return []
 
     # update the filestem with _tag_series_description
     stem  += "_" + "_".join([tag,series,mangled_descr])
 
     if blacklist and stem in blacklist:
         debug("{} in blacklist. Skipping.".format(stem))
-        return
+        return []
 
-    for fmt in formats:
-        if all(tag_exportinfo['export_'+fmt] == 'no'):
+    exportjobs = []
+    for fmt in plan.formats:
+        if fmt not in plan.tag_formats[tag]:
             debug("{}: export_{} set to 'no' for tag {} so skipping".format(
                 src, fmt, tag))
             continue
@@ -282,7 +586,34 @@ def export_series(exportinfo, src, header, formats, timepoint, stem,
         outputdir  = os.path.join(exportdir,fmt,timepoint)
         if not os.path.exists(outputdir): makedirs(outputdir)
 
-        exporters[fmt](src,outputdir,stem)
+        exportjobs.append((fmt, src, outputdir, stem))
+    return exportjobs
+
+def run_export_job(job):
+    """
+    Runs an export job (from export_series).
+
+    Returns a tuple (job, status, seconds), where status is one of 'exported',
+    'skipped' (the output already exists) or 'failed'.
+    """
+    fmt, src, outputdir, stem = job
+    start = time.time()
+    try:
+        returncode = exporters[fmt](src, outputdir, stem)
+    except Exception, e:
+        error("{}: export to {} failed: {}".format(src, fmt, e))
+        returncode = 1
+    seconds = time.time() - start
+
+    if returncode is None:
+        status = 'skipped'
+    elif returncode == 0:
+        status = 'exported'
+    else:
+        status = 'failed'
+
+    verbose("{}: {} {} in {:.1f}s".format(stem, fmt, status, seconds))
+    return job, status, seconds
 
 def get_formats_from_exportinfo(dataframe):
     """
@@ -326,7 +657,7 @@ def export_mnc_command(seriesdir,outputdir,stem):
     verbose("Exporting series {} to {}".format(seriesdir, outputfile))
     cmd = 'dcm2mnc -fname {} -dname "" {}/* {}'.format(
             stem,seriesdir,outputdir)
-    run(cmd)
+    return run(cmd)
 
 def export_nii_command(seriesdir,outputdir,stem):
     """
@@ -343,7 +674,7 @@ def export_nii_command(seriesdir,outputdir,stem):
 
     # convert into tempdir
     tmpdir = tempfile.mkdtemp()
-    run('dcm2nii -x n -g y  -o {} {}'.format(tmpdir,seriesdir))
+    returncode = run('dcm2nii -x n -g y  -o {} {}'.format(tmpdir,seriesdir))
 
     # move nii in tempdir to proper location
     for f in glob.glob("{}/*".format(tmpdir)):
@@ -352,8 +683,10 @@ def export_nii_command(seriesdir,outputdir,stem):
         if bn.startswith("o") or bn.startswith("co"):
             continue
         else:
-            run("mv {} {}/{}{}".format(f, outputdir, stem, ext))
+            returncode = run("mv {} {}/{}{}".format(
+                f, outputdir, stem, ext)) or returncode
     shutil.rmtree(tmpdir)
+    return returncode
 
 def export_nrrd_command(seriesdir,outputdir,stem):
     """
@@ -371,7 +704,7 @@ def export_nrrd_command(seriesdir,outputdir,stem):
     cmd = 'DWIConvert -i {} --conversionMode DicomToNrrd -o {}.nrrd ' \
           '--outputDirectory {}'.format(seriesdir,stem,outputdir)
 
-    run(cmd)
+    return run(cmd)
 
 def export_dcm_command(seriesdir,outputdir,stem):
     """
@@ -387,7 +720,7 @@ def export_dcm_command(seriesdir,outputdir,stem):
     dcmfile = None
     for path in glob.glob(seriesdir + '/*'):
         try:
-            dicom.read_file(path)
+            dm.utils.read_headers(path)
             dcmfile = path
             break
         except dicom.filereader.InvalidDicomError, e:
@@ -396,7 +729,7 @@ def export_dcm_command(seriesdir,outputdir,stem):
     assert dcmfile is not None, "No dicom files found in {}".format(seriesdir)
     verbose("Exporting a dcm file from {} to {}".format(seriesdir, outputfile))
     cmd = 'cp {} {}'.format(dcmfile, outputfile)
-    run(cmd)
+    return run(cmd)
 
 exporters = {
     "mnc" : export_mnc_command,
@@ -1,14 +1,14 @@
 #!/usr/bin/env python
 """
-Uploads a scan archive to XNAT
+Uploads scan archives to XNAT
 
 Usage:
-    xnat-upload.py [options] -u USER <project> <archive>
-    xnat-upload.py [options] -c FILE <project> <archive>
+    xnat-upload.py [options] -u USER <project> <archive>...
+    xnat-upload.py [options] -c FILE <project> <archive>...
 
 Arguments:
     <project>             Study/Project name
-    <archive>             Properly named zip file
+    <archive>             Properly named zip file(s)
 
 Options:
     --server URL          XNAT server to connect to
@@ -21,19 +21,48 @@ Options:
     -u,--username USER    XNAT username. If specified then the credentials
                           file is ignored and you are prompted for password.
 
+    -j,--jobs N           Number of non-dicom files to upload at once
+                          [default: 4]
+
+    --retries N           Number of times to retry an upload when the server
+                          is unavailable or times out (with an increasing
+                          delay between tries) [default: 5]
+
+    -p,--parallel N       Number of archives to upload at once [default: 1]
+
+    --journal FILE        File to record the archives uploaded in. Archives
+                          already recorded there (and unchanged since) are
+                          skipped, so that an interrupted batch can be resumed
+
     -v,--verbose          Be chatty
 
+DETAILS
+    All requests are made over one pool of keep-alive connections, with one
+    login for the whole batch. The archive and each non-dicom file in it are
+    streamed to the server as they are read, rather than read into memory
+    first. The upload rate of each is logged with --verbose.
+
+    The journal has a line for each archive uploaded (a JSON object of its
+    path, size, mtime and when it was uploaded). An archive is only recorded
+    once all of it has been uploaded, so resuming works an archive at a time:
+    an archive that failed part way (say, one of its non-dicom files) is
+    uploaded again in full, dicoms and all, by the next batch. The dicom
+    import overwrites the session imported before. If any archive fails to
+    upload, the others are still uploaded and the exit status is 1.
+
 """
 from docopt import docopt
 import datman as dm
 import datman.scanid
 import datman.utils
-import dicom as dcm
+import datetime
 import getpass
-import io
+import json
 import logging
+import multiprocessing.pool
 import os.path
 import requests
+import requests.adapters
 import urllib
 import sys
 import zipfile
@@ -55,14 +84,25 @@ ATTACH_URL = "{server}/data/archive/projects/{project}/subjects/{subject}" \
 
 dcm_exts = ('dcm','img')
 
+# HTTP status codes worth retrying an upload for: the server (or a proxy in
+# front of it) is busy or timed out
+RETRY_STATUS = (502, 503, 504)
+
+# Seconds to wait before the first retry, doubled after each try
+RETRY_BACKOFF = 15
+
 def main():
     arguments = docopt(__doc__)
     server   = arguments['--server']
     project  = arguments['<project>']
-    archive  = arguments['<archive>']
+    archives = arguments['<archive>']
     verbose  = arguments['--verbose']
     username = arguments['--username']
     credfile = arguments['--credfile']
+    jobs     = int(arguments['--jobs'])
+    retries  = int(arguments['--retries'])
+    parallel = int(arguments['--parallel'])
+    journal  = arguments['--journal']
 
     if verbose:
         logger.setLevel(logging.INFO)
@@ -74,44 +114,189 @@ def main():
         username = lines[0].strip()
         password = lines[1].strip()
 
-    archivefile = os.path.basename(os.path.normpath(archive))
-    scanid      = archivefile[:-len(dm.utils.get_extension(archivefile))]
-    if not dm.scanid.is_scanid(scanid):
-        logger.error("{} is not a valid scan identifier".format(scanid))
+    session = get_session((username, password), jobs * parallel)
+    failures = upload_archives(session, server, project, archives, jobs,
+                               retries, parallel, journal)
+    if failures:
+        logger.error("{} of {} archives failed to upload".format(
+            failures, len(archives)))
         sys.exit(1)
 
+def get_scanid(archive):
+    archivefile = os.path.basename(os.path.normpath(archive))
+    return archivefile[:-len(dm.utils.get_extension(archivefile))]
+
+def upload_archives(session, server, project, archives, jobs=1, retries=5,
+                    parallel=1, journal=None):
+    """
+    Uploads many exam archives, <parallel> at a time, all over one session.
+
+    Archives recorded in the <journal> file (see read_journal) are skipped,
+    and each archive is recorded there once it has been uploaded.
+
+    Returns the number of archives that failed to upload.
+    """
+    done = journal and read_journal(journal) or set()
+
+    todo = []
+    failures = 0
+    for archive in archives:
+        if not dm.scanid.is_scanid(get_scanid(archive)):
+            logger.error("{} is not a valid scan identifier".format(
+                get_scanid(archive)))
+            failures += 1
+            continue
+
+        if journal:
+            try:
+                key = journal_key(archive)
+            except OSError, e:
+                logger.error("Can't read {}: {}".format(archive, e))
+                failures += 1
+                continue
+            if key in done:
+                logger.info("{} already uploaded, skipping".format(archive))
+                continue
+
+        todo.append(archive)
+
+    def upload(archive):
+        try:
+            ok = upload_archive(session, server, project, archive, jobs,
+                                retries)
+        except (requests.exceptions.RequestException, IOError,
+                zipfile.BadZipfile), e:
+            logger.exception("Error uploading {}".format(archive))
+            ok = False
+        return archive, ok
+
+    if parallel <= 1 or len(todo) < 2:
+        results = (upload(archive) for archive in todo)
+    else:
+        pool = multiprocessing.pool.ThreadPool(min(parallel, len(todo)))
+        results = pool.imap_unordered(upload, todo)
+        pool.close()
+
+    # archives are recorded by this thread alone, as they finish
+    for archive, ok in results:
+        if not ok:
+            failures += 1
+        elif journal:
+            append_journal(journal, archive)
+
+    return failures
+
+def journal_key(archive):
+    """Returns the (path, size, mtime) an archive is recorded by."""
+    st = os.stat(archive)
+    return os.path.abspath(archive), st.st_size, st.st_mtime
+
+def read_journal(journal):
+    """
+    Returns the set of journal_key()s recorded in a journal file (if it
+    exists). A partly written last line (from an interrupted batch) is
+    ignored.
+    """
+    done = set()
+    if not os.path.exists(journal):
+        return done
+
+    for line in open(journal):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            logger.warn("Ignoring bad line in journal {}: {}".format(
+                journal, line.strip()))
+            continue
+        done.add((entry['archive'], entry['size'], entry['mtime']))
+    return done
+
+def append_journal(journal, archive):
+    """
+    Records an uploaded archive in a journal file. A partly written last line
+    (from an interrupted batch) is ended first, so the entry gets a line of
+    its own.
+    """
+    path, size, mtime = journal_key(archive)
+    entry = {'archive': path, 'size': size, 'mtime': mtime,
+             'uploaded_at': datetime.datetime.utcnow().isoformat()}
+    line = json.dumps(entry) + '\n'
+    if os.path.exists(journal) and os.path.getsize(journal) > 0:
+        with open(journal, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != '\n':
+                line = '\n' + line
+    with open(journal, 'a') as f:
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+
+def get_session(auth, pool_size=4):
+    """
+    Returns a requests.Session that authenticates with <auth>, and keeps up
+    to <pool_size> connections to the server alive.
+    """
+    session = requests.Session()
+    session.auth = auth
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=max(pool_size, 1))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def upload_archive(session, server, project, archive, jobs=1, retries=5):
+    """
+    Uploads an exam archive (a zip named by scan ID) to XNAT: creates the
+    subject, imports the dicoms, then attaches the other files in the
+    archive to the session, <jobs> at a time.
+
+    Returns False if the dicoms failed to import, otherwise True. Raises
+    requests.exceptions.HTTPError if any of the other files fail to upload.
+    """
+    archivefile = os.path.basename(os.path.normpath(archive))
+    scanid      = get_scanid(archive)
+
     subject = scanid
-    session = scanid
-    auth = (username, password)
     url_params = { 'server'  : server,
                    'project' : project,
                    'subject' : subject,
-                   'session' : session }
+                   'session' : scanid }
 
     # Upload - https://wiki.xnat.org/pages/viewpage.action?pageId=5017279
 
     # create the subject
     logger.info("Creating subject {}".format(subject))
-    r = requests.put(CREATE_URL.format(**url_params), auth=auth)
+    r = session.put(CREATE_URL.format(**url_params))
 
-    if r.status_code is not 200 and r.status_code is not 201:
+    if r.status_code not in (200, 201):
         logger.error("{} http client error at folder creation: {}".format(scanid,r.status_code))
 
     # NOTE: If your project is not set to auto archive, then this will end up in the prearchive
     logger.info("Uploading dicom data...")
-    r = requests.post(UPLOAD_URL.format(**url_params),
-            auth=auth,
-            headers={'Content-Type' : 'application/zip'},
-            data=open(archive))
-
-    if r.status_code is not 200:
+    r = post_file(session, UPLOAD_URL.format(**url_params),
+                  lambda: ProgressReader(open(archive, 'rb'),
+                                         os.path.getsize(archive)),
+                  archivefile, retries,
+                  headers={'Content-Type' : 'application/zip'})
+
+    imported = r.status_code == 200
+    if not imported:
         logger.error("{} http client error dicom data upload: {}".format(scanid,r.status_code))
 
-        if r.status_code is 504:
-            time.sleep(30)
-
     # upload non-dicom stuff
     logger.info("Scanning for non-dicom data...")
+    files = get_resources(archive)
+
+    logger.info("Uploading non-dicom data...")
+    def upload(f):
+        upload_resource(session, archive, f, url_params, retries)
+    dm.utils.parallel_map(upload, files, jobs)
+
+    print("Subject {} uploaded to xnat".format(subject))
+    return imported
+
+def get_resources(archive):
+    """Returns the names of the non-dicom files in a zip archive."""
     zf = zipfile.ZipFile(archive)
 
     # filter dirs
@@ -122,32 +307,104 @@ def main():
     files = filter(lambda f: not is_named_like_a_dicom(f), files)
 
     # filter actual dicoms :D
-    files = filter(lambda f: not is_dicom(io.BytesIO(zf.read(f))), files)
+    files = filter(lambda f: not is_dicom(zf.open(f)), files)
 
-    logger.info("Uploading non-dicom data...")
-    for f in files:
-        # convert to HTTP language
-        uploadname = urllib.quote(f)
-        r = None
-        try:
-            r = requests.post(ATTACH_URL.format(filename=uploadname, **url_params), data=zf.read(f), auth=auth)
-            r.raise_for_status()
+    zf.close()
+    return files
 
-        except requests.exceptions.HTTPError, e:
-            logger.error("ERROR uploading file {}".format(f))
-            raise e
+def upload_resource(session, archive, f, url_params, retries=5):
+    """
+    Attaches the file <f> in a zip archive to the XNAT session, streaming it
+    straight out of the archive.
 
-    print("Subject {} uploaded to xnat".format(subject))
+    Each call opens the archive itself, so that files can be uploaded from
+    several threads at once.
+    """
+    # convert to HTTP language
+    uploadname = urllib.quote(f)
+    zf = zipfile.ZipFile(archive)
+    try:
+        size = zf.getinfo(f).file_size
+        r = post_file(session, ATTACH_URL.format(filename=uploadname, **url_params),
+                      lambda: ProgressReader(zf.open(f), size), f, retries)
+        r.raise_for_status()
+
+    except requests.exceptions.HTTPError, e:
+        logger.error("ERROR uploading file {}".format(f))
+        raise e
+    finally:
+        zf.close()
+
+def post_file(session, url, open_body, name, retries=5, **kwargs):
+    """
+    POSTs the body returned by open_body() (a ProgressReader) to url, and
+    returns the response.
+
+    If the server is unavailable or times out, the post is retried with a
+    fresh body up to <retries> times, waiting RETRY_BACKOFF seconds before the
+    first retry and twice as long before each one after.
+    """
+    delay = RETRY_BACKOFF
+    for attempt in range(retries + 1):
+        body = open_body()
+        start = time.time()
+        try:
+            r = session.post(url, data=body, **kwargs)
+        except requests.exceptions.ConnectionError, e:
+            if attempt == retries:
+                raise
+            logger.warn("Error uploading {}, retrying in {}s: {}".format(
+                name, delay, e))
+        else:
+            if r.status_code not in RETRY_STATUS or attempt == retries:
+                log_throughput(name, body.bytes_read, time.time() - start)
+                return r
+            logger.warn("Server error {} uploading {}, retrying in {}s".format(
+                r.status_code, name, delay))
+        finally:
+            body.close()
+
+        time.sleep(delay)
+        delay *= 2
+
+def log_throughput(name, nbytes, seconds):
+    logger.info("Uploaded {}: {:.1f} MB in {:.1f}s ({:.2f} MB/s)".format(
+        name, nbytes / 1e6, seconds, nbytes / 1e6 / max(seconds, 1e-6)))
+
+class ProgressReader(object):
+    """
+    A file-like body for requests that streams <fileobj> (of <size> bytes)
+    block by block, counting the bytes sent.
+
+    The size is given as the body's length, so it is sent with a
+    Content-Length rather than chunked.
+    """
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.size = size
+        self.bytes_read = 0
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        self.fileobj.close()
 
 def is_named_like_a_dicom(path):
     return any(map(lambda x: path.lower().endswith(x), dcm_exts))
 
 def is_dicom(fileobj):
+    """Sniffs the dicom preamble, without reading the rest of the file."""
     try:
-        dcm.read_file(fileobj)
-        return True
-    except dcm.filereader.InvalidDicomError:
-        return False
+        preamble = fileobj.read(dm.utils.DICOM_PREAMBLE_LENGTH)
+    finally:
+        fileobj.close()
+    return dm.utils.has_dicom_preamble(preamble)
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,142 @@
+"""
+The database of mismatches against the gold standards, written by
+dm-check-headers.py and dm-check-bvecs.py and read by qc-html.py.
+
+Each mismatch is a row of its own:
+
+    mismatches: checker, exam, series, header, expected, actual, tolerance,
+                checked_at
+
+where checker is the program that found it (e.g. dm-check-headers), exam is
+the name of the exam folder checked, and series is the stem of the file that
+differs from its gold standard (e.g. SPN01_CMH_0001_01_01_T1_02_Sag-T1-BRAVO).
+expected, actual and tolerance are kept as text (or NULL, when missing).
+
+In short:
+
+    import datman.checkdb
+
+    db = datman.checkdb.CheckDatabase('qc/logs/' + datman.checkdb.DB_NAME)
+    db.write('dm-check-headers', 'SPN01_CMH_0001_01_01',
+             [('SPN01_CMH_0001_01_01_T1_02_Sag-T1-BRAVO', 'EchoTime', 30.0,
+               49.0, 5)])
+    db.get('dm-check-headers', 'SPN01_CMH_0001')   # by exam name prefix
+    db.close()
+
+Each write replaces all of the earlier mismatches of the exam (by that
+checker), so an exam that has been fixed has no rows left.
+"""
+import collections
+import datetime
+import sqlite3
+
+# The name of the database in the checkers' log folder
+DB_NAME = 'checks.db'
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS mismatches (
+           checker     TEXT,
+           exam        TEXT,
+           series      TEXT,
+           header      TEXT,
+           expected    TEXT,
+           actual      TEXT,
+           tolerance   TEXT,
+           checked_at  TEXT)""",
+    """CREATE INDEX IF NOT EXISTS mismatches_exam
+           ON mismatches (checker, exam, series)""",
+]
+
+Mismatch = collections.namedtuple(
+    'Mismatch', ['exam', 'series', 'header', 'expected', 'actual', 'tolerance'])
+
+
+def to_text(value):
+    """Returns str(value), or None if value is None."""
+    if value is None:
+        return None
+    return str(value)
+
+
+def prefix_upper_bound(prefix):
+    """Returns the least string greater than every string that starts with
+    <prefix>, or None if there is none."""
+    prefix = prefix.rstrip('\xff')
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class CheckDatabase:
+    """The database of gold standard mismatches at <path>.
+
+    The database uses write-ahead logging, so the checkers can write to it
+    while qc-html.py reads from it.
+    """
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=timeout)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+
+    def write(self, checker, exam, rows):
+        """Replaces the mismatches of an exam with (series, header, expected,
+        actual, tolerance) rows, in one transaction."""
+        checked_at = datetime.datetime.utcnow().isoformat()
+        with self.db:
+            self.db.execute(
+                'DELETE FROM mismatches WHERE checker = ? AND exam = ?',
+                (checker, exam))
+            self.db.executemany(
+                'INSERT INTO mismatches VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(checker, exam, series, header, to_text(expected),
+                  to_text(actual), to_text(tolerance), checked_at)
+                 for series, header, expected, actual, tolerance in rows])
+
+    def has_exam(self, checker, exam):
+        """Returns True if the exam has any mismatches recorded by checker."""
+        row = self.db.execute(
+            'SELECT 1 FROM mismatches WHERE checker = ? AND exam = ? LIMIT 1',
+            (checker, exam)).fetchone()
+        return row is not None
+
+    def get(self, checker, exam=None, series=None):
+        """Returns the Mismatches found by a checker, in the order written.
+
+        The results can be narrowed to the exams whose names start with
+        <exam>, and to a <series>.
+        """
+        sql = 'SELECT exam, series, header, expected, actual, tolerance ' \
+              'FROM mismatches WHERE checker = ?'
+        params = [checker]
+        if exam is not None:
+            # a range rather than substr(), so the index on exam is used
+            sql += ' AND exam >= ?'
+            params.append(exam)
+            upper = prefix_upper_bound(exam)
+            if upper is not None:
+                sql += ' AND exam < ?'
+                params.append(upper)
+        if series is not None:
+            sql += ' AND series = ?'
+            params.append(series)
+
+        cur = self.db.execute(sql + ' ORDER BY exam, rowid', params)
+        return [Mismatch(*row) for row in cur]
+
+    def get_by_series(self, checker, exam=None):
+        """Returns a map from series -> list of Mismatches, see get()."""
+        result = collections.defaultdict(list)
+        for mismatch in self.get(checker, exam):
+            result[mismatch.series].append(mismatch)
+        return result
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+# vim: ts=4 sw=4:
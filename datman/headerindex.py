@@ -0,0 +1,222 @@
+"""
+A persistent, on-disk index of DICOM headers.
+
+Scanning an exam archive for headers means opening and parsing DICOM files,
+which over a large archive is by far the slowest part of most of our tools.
+The index remembers the headers read from each file (keyed by the file's path,
+modification time and size) so that later scans only parse files that have
+changed since they were last seen.
+
+In short:
+
+    import datman.headerindex
+    import datman.utils
+
+    index = datman.headerindex.HeaderIndex('headers.db')
+    manifest = datman.utils.get_archive_headers(archive, index=index)
+    index.close()
+
+Headers can also be queried straight from the index, without touching the
+archives themselves:
+
+    index.query(description='T1')
+    index.get_tag('PatientName', archive='/archive/SPN01_CMH_0001_01_01')
+
+The index is a SQLite database with two tables:
+
+    headers:  archive, member, source, mtime, size, series, description,
+              dataset
+
+    archives: archive, mtime, size, complete
+
+Each headers row is valid as long as the stat (mtime, size) of its source file
+is unchanged. For folders, the source is the dicom file itself and the member
+is its path. For zip and tar archives the source is the archive file and
+members are the folders inside the archive; the archives table records whether
+all of the archive's folders have been indexed.
+"""
+import cPickle as pickle
+import os
+import sqlite3
+import threading
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS headers (
+           archive     TEXT,
+           member      TEXT,
+           source      TEXT,
+           mtime       REAL,
+           size        INTEGER,
+           series      INTEGER,
+           description TEXT,
+           dataset     BLOB,
+           PRIMARY KEY (archive, member))""",
+    """CREATE INDEX IF NOT EXISTS headers_series
+           ON headers (series, description)""",
+    """CREATE TABLE IF NOT EXISTS archives (
+           archive  TEXT PRIMARY KEY,
+           mtime    REAL,
+           size     INTEGER,
+           complete INTEGER)""",
+]
+
+
+def stat_key(path):
+    """Returns the (mtime, size) pair used to decide if a file has changed."""
+    st = os.stat(path)
+    return st.st_mtime, st.st_size
+
+
+class HeaderIndex:
+    """Caches DICOM headers on disk, keyed by file path, mtime and size.
+
+    Lookups return a (hit, dataset) pair. A hit with a dataset of None means
+    the file was previously found not to be a dicom.
+
+    An index may be shared between threads; access to the database is
+    serialized. Separate processes should each open their own index, they will
+    wait up to <timeout> seconds for each other's writes.
+    """
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, timeout=timeout,
+                                  check_same_thread=False)
+        self.db.text_factory = str
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+
+    def lookup(self, archive, member, source):
+        """Returns (True, dataset) if <member> is indexed and <source> is
+        unchanged, otherwise (False, None)."""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT mtime, size, dataset FROM headers '
+                'WHERE archive = ? AND member = ? AND source = ?',
+                (archive, member, source)).fetchone()
+        if row is None:
+            return False, None
+
+        # stat outside of the lock, it is the slow part on network storage
+        mtime, size, blob = row
+        if (mtime, size) != stat_key(source):
+            return False, None
+
+        return True, self._load(blob)
+
+    def store(self, archive, member, source, dataset):
+        """Indexes the headers of <member>, validated by the stat of <source>.
+        """
+        mtime, size = stat_key(source)
+        series, description = None, None
+        if dataset is not None:
+            series = dataset.get('SeriesNumber')
+            description = dataset.get('SeriesDescription')
+            if series is not None:
+                series = int(series)
+            if description is not None:
+                description = str(description)
+
+        row = (archive, member, source, mtime, size, series, description,
+               self._dump(dataset))
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                row)
+
+    def lookup_archive(self, archive, stop_after_first=False):
+        """Returns the indexed manifest for a zip or tar archive, or None if
+        the archive has changed or was never (completely) indexed."""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT mtime, size, complete FROM archives WHERE archive = ?',
+                (archive,)).fetchone()
+            if row is None:
+                return None
+
+            mtime, size, complete = row
+            if (mtime, size) != stat_key(archive):
+                return None
+            if not complete and not stop_after_first:
+                return None
+
+            manifest = self.query(archive=archive, prefix=False)
+            if stop_after_first:
+                manifest = dict(manifest.items()[:1])
+            return manifest
+
+    def store_archive(self, archive, manifest, complete=True):
+        """Indexes the manifest (member -> headers) of a zip or tar archive."""
+        with self.lock:
+            mtime, size = stat_key(archive)
+            self.db.execute('DELETE FROM headers WHERE archive = ?', (archive,))
+            for member, dataset in manifest.iteritems():
+                self.store(archive, member, archive, dataset)
+            self.db.execute(
+                'INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?)',
+                (archive, mtime, size, int(complete)))
+
+    def query(self, archive=None, series=None, description=None,
+              prefix=True):
+        """Returns a map from member -> headers of all indexed dicoms.
+
+        The results can be narrowed to an <archive> (by default, the archive
+        and anything in the folders under it), a <series> number, or
+        a <description> (an SQL LIKE pattern matched anywhere in the
+        SeriesDescription). Files are not checked for changes.
+        """
+        with self.lock:
+            sql = 'SELECT member, dataset FROM headers ' \
+                  'WHERE dataset IS NOT NULL'
+            params = []
+            if archive is not None:
+                archive = os.path.abspath(archive)
+                if prefix:
+                    # everything under archive/ sorts between archive/ and
+                    # the path with the separator bumped up one character,
+                    # which (unlike LIKE) is case sensitive and uses the index
+                    sql += ' AND (archive = ? OR ' \
+                           '(archive >= ? AND archive < ?))'
+                    params += [archive, archive + os.sep,
+                               archive + chr(ord(os.sep) + 1)]
+                else:
+                    sql += ' AND archive = ?'
+                    params.append(archive)
+            if series is not None:
+                sql += ' AND series = ?'
+                params.append(int(series))
+            if description is not None:
+                sql += ' AND description LIKE ?'
+                params.append('%' + description + '%')
+
+            rows = self.db.execute(sql, params).fetchall()
+            return dict((member, self._load(blob)) for member, blob in rows)
+
+    def get_tag(self, name, archive=None, series=None, description=None):
+        """Returns a map from member -> value of the named dicom header."""
+        manifest = self.query(archive, series, description)
+        return dict((member, headers.get(name))
+                    for member, headers in manifest.iteritems())
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+    def _dump(self, dataset):
+        if dataset is None:
+            return None
+        return sqlite3.Binary(pickle.dumps(dataset, pickle.HIGHEST_PROTOCOL))
+
+    def _load(self, blob):
+        if blob is None:
+            return None
+        return pickle.loads(str(blob))
+
+# vim: ts=4 sw=4:
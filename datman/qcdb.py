@@ -0,0 +1,198 @@
+"""
+The subject QC metrics database written by qc-html.py.
+
+Each metric is a row of its own:
+
+    metrics: subj, site, scan, kind, metric, value, computed_at
+
+where kind is the type of QC (fmri, dti, t1), scan is the stem of the scan's
+nifti, and computed_at is when the value was written (an ISO 8601 timestamp
+in UTC). New metrics need no change to the schema.
+
+In short:
+
+    import datman.qcdb
+
+    db = datman.qcdb.QCDatabase('qc/subject-qc.db')
+    db.write([('fmri', 'SPN01_CMH_0001_01_01', 'SPN01_CMH_0001_01_01_RST_04',
+               'fdtot', 12.3)])
+    db.table('fmri', ['fdtot', 'corrmean'])   # one row per scan
+    db.pivot('fmri', 'fdtot')                 # mean per site, per month
+    db.close()
+
+Older databases kept a wide table for each kind of QC (fmri, dti, t1) with a
+column per metric. Their values are copied into the metrics table the first
+time the database is opened (with an empty scan and computed_at, as those were
+never recorded). The old tables are left in place. A migrated value is
+superseded once a subject's metric has been written for a scan: write()
+deletes it, and table() and pivot() leave it out.
+"""
+import collections
+import datetime
+import sqlite3
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS metrics (
+           subj        TEXT,
+           site        TEXT,
+           scan        TEXT,
+           kind        TEXT,
+           metric      TEXT,
+           value       REAL,
+           computed_at TEXT,
+           PRIMARY KEY (subj, scan, kind, metric))""",
+    """CREATE INDEX IF NOT EXISTS metrics_site
+           ON metrics (kind, metric, site, computed_at, value)""",
+    """CREATE INDEX IF NOT EXISTS metrics_subj
+           ON metrics (kind, subj, scan, metric, value)""",
+]
+
+# The wide tables of older databases, see migrate()
+OLD_TABLES = ['fmri', 'dti', 't1']
+
+# Bumped whenever migrate() has something new to do
+SCHEMA_VERSION = 1
+
+# Leaves out migrated values (with no scan) of metrics that have since been
+# recorded for a scan of the same subject
+NOT_SUPERSEDED = """NOT (scan = '' AND EXISTS (
+                        SELECT 1 FROM metrics AS m
+                        WHERE m.kind = metrics.kind AND m.subj = metrics.subj
+                        AND m.metric = metrics.metric AND m.scan != ''))"""
+
+
+def get_site(subj):
+    """Returns the site of a subject ID (e.g. CMH from SPN01_CMH_0001_01)."""
+    parts = subj.split('_')
+    if len(parts) < 2:
+        return None
+    return parts[1]
+
+
+class QCDatabase:
+    """The subject QC metrics database at <path>.
+
+    The database uses write-ahead logging, so it can be read (e.g. by
+    web-build.py) while qc-html.py is writing to it.
+    """
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=timeout)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+        self.migrate()
+
+    def migrate(self):
+        """Copies the values of the old wide tables into the metrics table."""
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+
+        tables = [row[0] for row in self.db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")]
+        with self.db:
+            for kind in OLD_TABLES:
+                if kind not in tables:
+                    continue
+                columns = [str(col[1]) for col in self.db.execute(
+                    'PRAGMA table_info({})'.format(kind))]
+                for metric in columns:
+                    if metric in ('subj', 'site'):
+                        continue
+                    self.db.execute(
+                        "INSERT OR IGNORE INTO metrics "
+                        "SELECT subj, site, '', ?, ?, {metric}, NULL "
+                        "FROM {kind} WHERE {metric} IS NOT NULL".format(
+                            kind=kind, metric=metric),
+                        (kind, metric))
+        self.db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+
+    def write(self, rows):
+        """Writes (kind, subj, scan, metric, value) rows, in one transaction.
+
+        Values replace any earlier values of the same metric for the scan, and
+        any migrated value of the metric for the subject.
+        """
+        computed_at = datetime.datetime.utcnow().isoformat()
+        with self.db:
+            self.db.executemany(
+                "DELETE FROM metrics WHERE kind = ? AND subj = ? "
+                "AND metric = ? AND scan = ''",
+                set((kind, subj, metric)
+                    for kind, subj, scan, metric, value in rows if scan))
+            self.db.executemany(
+                'INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(subj, get_site(subj), scan, kind, metric, value,
+                  computed_at)
+                 for kind, subj, scan, metric, value in rows])
+
+    def get_metrics(self, kind):
+        """Returns the names of the metrics recorded for a kind of QC."""
+        return [row[0] for row in self.db.execute(
+            'SELECT DISTINCT metric FROM metrics WHERE kind = ? '
+            'ORDER BY metric', (kind,))]
+
+    def get_subjects(self, kind=None):
+        """Returns the subjects with metrics (of a kind of QC), sorted."""
+        sql = 'SELECT DISTINCT subj FROM metrics'
+        params = []
+        if kind is not None:
+            sql += ' WHERE kind = ?'
+            params.append(kind)
+        return [row[0] for row in self.db.execute(sql + ' ORDER BY subj',
+                                                  params)]
+
+    def table(self, kind, metrics=None):
+        """Returns the metrics of a kind of QC with one row per scan.
+
+        Each row is an OrderedDict of subj, site, scan, computed_at (the latest
+        of its metrics) and the value of each of the requested <metrics> (by
+        default, all of them), ordered by subject and scan.
+        """
+        if metrics is None:
+            metrics = self.get_metrics(kind)
+
+        columns = ''.join(
+            ', MAX(CASE WHEN metric = ? THEN value END)' for m in metrics)
+        cur = self.db.execute(
+            'SELECT subj, site, scan, MAX(computed_at){columns} '
+            'FROM metrics WHERE kind = ? AND {current} '
+            'GROUP BY subj, site, scan ORDER BY subj, scan'.format(
+                columns=columns, current=NOT_SUPERSEDED),
+            list(metrics) + [kind])
+
+        names = ['subj', 'site', 'scan', 'computed_at'] + list(metrics)
+        return [collections.OrderedDict(zip(names, row)) for row in cur]
+
+    def pivot(self, kind, metric, period='%Y-%m'):
+        """Returns the mean of a metric for each site over time.
+
+        Values are grouped by when they were computed, using the strftime()
+        format <period> (by default, by month). Migrated values with no
+        computed_at fall in a period of None.
+
+        Returns an OrderedDict that maps each period (in order) to a map from
+        site -> (mean, number of values).
+        """
+        cur = self.db.execute(
+            'SELECT strftime(?, computed_at) AS period, site, AVG(value), '
+            'COUNT(value) FROM metrics WHERE kind = ? AND metric = ? '
+            'AND {current} '
+            'GROUP BY period, site ORDER BY period, site'.format(
+                current=NOT_SUPERSEDED),
+            (period, kind, metric))
+
+        result = collections.OrderedDict()
+        for period, site, mean, count in cur:
+            result.setdefault(period, {})[site] = (mean, count)
+        return result
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+# vim: ts=4 sw=4:
@@ -1,6 +1,7 @@
 """
 Represents scan identifiers that conform to the TIGRLab naming scheme
 """
+import collections
 import os.path
 import re
 
@@ -35,7 +36,21 @@ FILENAME_PHA_PATTERN = re.compile('^'+FILENAME_PHA_RE+'$')
 class ParseException(Exception):
     pass
 
-class Identifier:
+# The columns returned by parse_filenames()
+FILENAME_COLUMNS = ['path', 'ident', 'study', 'site', 'subject', 'timepoint',
+                    'session', 'tag', 'series', 'description', 'ext']
+
+class Identifier(object):
+    """
+    A parsed scan identifier.
+
+    Identifiers compare equal (and hash the same) when all of their parts are
+    equal, so they can be used as dictionary keys and in sets. The parse
+    functions share a single Identifier between every file of the same scan,
+    so an Identifier should not be modified once it is made.
+    """
+    __slots__ = ['study', 'site', 'subject', 'timepoint', 'session']
+
     def __init__(self, study, site, subject, timepoint, session):
         self.study = study
         self.site = site
@@ -43,6 +58,26 @@ class Identifier:
         self.timepoint = timepoint
         self.session = session
 
+    def _key(self):
+        return (self.study, self.site, self.subject, self.timepoint,
+                self.session)
+
+    def __eq__(self, other):
+        if not isinstance(other, Identifier):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __ne__(self, other):
+        if not isinstance(other, Identifier):
+            return NotImplemented
+        return self._key() != other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return "Identifier({!r}, {!r}, {!r}, {!r}, {!r})".format(*self._key())
+
     def get_full_subjectid(self):
         return "_".join([self.study, self.site, self.subject])
 
@@ -62,6 +97,24 @@ class Identifier:
         else:  # it's a phantom, so no timepoints
             return self.get_full_subjectid() 
                   
+# Identifiers already made, so that parsing many files of the same scan
+# shares one Identifier (and one copy of each of its strings).
+_identifiers = {}
+
+def _intern(string):
+    # intern() only takes byte strings
+    if type(string) is str:
+        return intern(string)
+    return string
+
+def _get_identifier(match):
+    key = match.group("study", "site", "subject", "timepoint", "session")
+    ident = _identifiers.get(key)
+    if ident is None:
+        ident = Identifier(*[_intern(part) for part in key])
+        _identifiers[key] = ident
+    return ident
+
 def parse(identifier):
     if type(identifier) is not str: raise ParseException()
 
@@ -69,31 +122,59 @@ def parse(identifier):
     if not match: match = SCANID_PHA_PATTERN.match(identifier)
     if not match: raise ParseException()
 
-    ident = Identifier(study    = match.group("study"), 
-                       site     = match.group("site"),
-                       subject  = match.group("subject"),
-                       timepoint= match.group("timepoint"),
-                       session  = match.group("session"))
+    return _get_identifier(match)
 
-    return ident
+def _match_filename(fname):
+    match = None
+    if '_PHA_' in fname:   # check PHA first
+        match = FILENAME_PHA_PATTERN.match(fname)
+    if not match: match = FILENAME_PATTERN.match(fname)
+    return match
 
 def parse_filename(path):
     fname = os.path.basename(path)
-    match = FILENAME_PHA_PATTERN.match(fname)  # check PHA first
-    if not match: match = FILENAME_PATTERN.match(fname)
+    match = _match_filename(fname)
     if not match: raise ParseException()
 
-    ident = Identifier(study    = match.group("study"), 
-                       site     = match.group("site"),
-                       subject  = match.group("subject"),
-                       timepoint= match.group("timepoint"),
-                       session  = match.group("session"))
-
+    ident = _get_identifier(match)
     tag = match.group("tag")
     series = match.group("series")
     description = match.group("description")
     return ident, tag, series, description
 
+def parse_filenames(paths):
+    """
+    Parses many filenames at once.
+
+    Returns an OrderedDict of columns (see FILENAME_COLUMNS), each a list with
+    one entry per path that conforms to the naming scheme. Paths that do not
+    conform are left out. The result can be handed straight to
+    pandas.DataFrame().
+    """
+    columns = collections.OrderedDict((c, []) for c in FILENAME_COLUMNS)
+    path_col, ident_col, study_col, site_col, subject_col, timepoint_col, \
+        session_col, tag_col, series_col, description_col, ext_col = \
+        columns.values()
+
+    for path in paths:
+        match = _match_filename(os.path.basename(path))
+        if not match: continue
+
+        ident = _get_identifier(match)
+        path_col.append(path)
+        ident_col.append(ident)
+        study_col.append(ident.study)
+        site_col.append(ident.site)
+        subject_col.append(ident.subject)
+        timepoint_col.append(ident.timepoint)
+        session_col.append(ident.session)
+        tag_col.append(_intern(match.group("tag")))
+        series_col.append(match.group("series"))
+        description_col.append(match.group("description"))
+        ext_col.append(match.group("ext"))
+
+    return columns
+
 def make_filename(ident, tag, series, description, ext = None):
     filename = "_".join([str(ident), tag, series, description])
     if ext: 
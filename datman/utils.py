@@ -11,9 +11,12 @@ import io
 import glob
 import numpy as np
 import logging
+import resource
 import subprocess as proc
+from multiprocessing.pool import ThreadPool
 import scanid
 import nibabel as nib
+import nibabel.openers
 
 SERIES_TAGS_MAP = {
 "T1"         :  "T1",
@@ -34,6 +37,18 @@ SERIES_TAGS_MAP = {
 "Loc"        :  "LOC",
 }
 
+# When reading headers from dicom files on disk, elements larger than this
+# (in bytes) are skipped over and only read from the file if they are accessed.
+HEADER_DEFER_SIZE = 2048
+
+# A dicom file starts with a 128 byte preamble followed by the magic 'DICM'
+DICOM_PREAMBLE_LENGTH = 132
+
+# Roughly how much of a nifti (in bytes) iter_volumes() reads at once
+MASKED_LOAD_CHUNK_SIZE = 64 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
 def get_subject_from_filename(filename):
     filename = os.path.basename(filename)
     filename = filename.split('_')[0:5]
@@ -47,6 +62,43 @@ def script_path():
     """
     return os.path.abspath(os.path.dirname(sys.argv[0]))
 
+class TagMatcher(object):
+    """
+    Matches series descriptions against a set of tag patterns.
+
+    <tagmap> is either a dictionary that maps a regex to a series tag, or a
+    list of (regex, tag) pairs. The patterns are compiled once, and the tags
+    found for each description are remembered, so that matching the same
+    description again (as happens for every exam in a study) is a dictionary
+    lookup.
+
+    Calling a TagMatcher with a description returns what guess_tag() would.
+    """
+
+    def __init__(self, tagmap):
+        if hasattr(tagmap, 'items'):
+            tagmap = tagmap.items()
+        self.patterns = [(re.compile(p), tag) for p, tag in tagmap]
+        self.cache = {}
+
+    def __call__(self, description):
+        try:
+            return self.cache[description]
+        except KeyError:
+            pass
+
+        matches = []
+        for pattern, tag in self.patterns:
+            if tag not in matches and pattern.search(description):
+                matches.append(tag)
+
+        if len(matches) == 0: result = None
+        elif len(matches) == 1: result = matches[0]
+        else: result = matches
+
+        self.cache[description] = result
+        return result
+
 def guess_tag(description, tagmap = SERIES_TAGS_MAP):
     """
     Given a series description return a list of series tags this might be.
@@ -56,14 +108,17 @@ def guess_tag(description, tagmap = SERIES_TAGS_MAP):
     SeriesDescription).
 
     <tagmap> is a dictionary that maps a regex to a series tag, where the regex
-    matches the series description dicom header. If not specified this modules
-    SERIES_TAGS_MAP is used.
-    """
-    matches = list(set(
-        [tag for p,tag in tagmap.iteritems() if re.search(p,description)]
-        ))
-    if len(matches) == 0: return None
-    if len(matches) == 1: return matches[0]
+    matches the series description dicom header, or a TagMatcher. If not
+    specified this modules SERIES_TAGS_MAP is used.
+
+    When guessing tags for many series, build a TagMatcher once and pass it in
+    as the <tagmap>, rather than compiling the patterns on every call.
+    """
+    if not isinstance(tagmap, TagMatcher):
+        tagmap = TagMatcher(tagmap)
+    matches = tagmap(description)
+    if type(matches) is list:
+        return list(matches)
     return matches
 
 def mangle_basename(base_path):
@@ -101,7 +156,8 @@ def get_extension(path):
     else:
         return os.path.splitext(path)[1]
 
-def get_archive_headers(path, stop_after_first = False):
+def get_archive_headers(path, stop_after_first = False, index = None,
+        jobs = 1):
     """
     Get dicom headers from a scan archive.
 
@@ -115,62 +171,166 @@ def get_archive_headers(path, stop_after_first = False):
     If stop_after_first == True only a single set of dicom headers are
     returned for the entire archive, which is useful if you only care about the
     exam details.
+
+    If <index> (a datman.headerindex.HeaderIndex) is given, it is consulted
+    before any dicoms are read, and updated with any headers that had to be
+    read.
+
+    Folders are scanned with up to <jobs> threads (see get_folder_headers).
     """
     if os.path.isdir(path):
-        return get_folder_headers(path, stop_after_first)
+        manifest = get_folder_headers(path, stop_after_first, index, jobs)
     elif zipfile.is_zipfile(path):
-        return get_zipfile_headers(path, stop_after_first)
+        manifest = get_indexed_archive_headers(get_zipfile_headers, path,
+                stop_after_first, index)
     elif os.path.isfile(path) and path.endswith('.tar.gz'):
-        return get_tarfile_headers(path, stop_after_first)
+        manifest = get_indexed_archive_headers(get_tarfile_headers, path,
+                stop_after_first, index)
     else:
-	raise Exception("{} must be a file (zip/tar) or folder.".format(path))
+        raise Exception("{} must be a file (zip/tar) or folder.".format(path))
+
+    if index is not None:
+        index.commit()
+    return manifest
+
+def get_indexed_archive_headers(reader, path, stop_after_first, index):
+    """
+    Get headers for a zip or tar archive with <reader>, unless the archive is
+    unchanged since it was last stored in the header index.
+    """
+    if index is None:
+        return reader(path, stop_after_first)
+
+    path = os.path.abspath(path)
+    manifest = index.lookup_archive(path, stop_after_first)
+    if manifest is None:
+        manifest = reader(path, stop_after_first)
+        index.store_archive(path, manifest, complete = not stop_after_first)
+    return manifest
+
+def read_headers(path, index = None):
+    """
+    Read the dicom headers of a single file (or file-like object).
+
+    Only the headers are read: reading stops before the pixel data, and for
+    files on disk any element larger than HEADER_DEFER_SIZE is skipped until it
+    is accessed. File-like objects are read up to the pixel data.
+
+    If <index> (a datman.headerindex.HeaderIndex) is given and the file is
+    unchanged since it was indexed, the headers are taken from the index and
+    the file is not opened.
+
+    Raises dcm.filereader.InvalidDicomError if the file is not a dicom.
+    """
+    if not isinstance(path, basestring):
+        return dcm.read_file(path, stop_before_pixels=True)
+
+    if index is None:
+        return dcm.read_file(path, defer_size=HEADER_DEFER_SIZE,
+                stop_before_pixels=True)
+
+    path = os.path.abspath(path)
+    dirname = os.path.dirname(path)
+    hit, headers = index.lookup(dirname, path, path)
+    if not hit:
+        try:
+            headers = dcm.read_file(path, defer_size=HEADER_DEFER_SIZE,
+                    stop_before_pixels=True)
+        except dcm.filereader.InvalidDicomError, e:
+            headers = None
+        index.store(dirname, path, path, headers)
+
+    if headers is None:
+        raise dcm.filereader.InvalidDicomError(
+                "{} is not a dicom file (indexed)".format(path))
+    return headers
+
+def has_dicom_preamble(data):
+    """
+    Returns True if <data> (the first bytes of a file) starts with a dicom
+    preamble.
+    """
+    return len(data) >= DICOM_PREAMBLE_LENGTH and \
+            data[DICOM_PREAMBLE_LENGTH-4:DICOM_PREAMBLE_LENGTH] == 'DICM'
+
+def read_member_headers(fileobj):
+    """
+    Read the dicom headers from an archive member (a file-like object, like
+    those from ZipFile.open() or TarFile.extractfile()).
+
+    Only the preamble is read to decide whether the member is a dicom, so
+    non-dicom members (however large) cost a single small read. Dicoms are
+    buffered in memory since archive members can't seek backwards.
+
+    Raises dcm.filereader.InvalidDicomError if the member is not a dicom.
+    """
+    preamble = fileobj.read(DICOM_PREAMBLE_LENGTH)
+    if not has_dicom_preamble(preamble):
+        raise dcm.filereader.InvalidDicomError("No dicom preamble found")
+    return read_headers(io.BytesIO(preamble + fileobj.read()))
 
 def get_tarfile_headers(path, stop_after_first = False):
     """
     Get headers for dicom files within a tarball
+
+    The tarball is read as a stream in a single pass, so the member listing is
+    never built up front (which for a compressed tarball means decompressing
+    all of it). Only the first dicom in each folder is read, the rest are
+    skipped over, and with stop_after_first the rest of the archive isn't
+    decompressed at all.
     """
-    tar = tarfile.open(path)
-    members = tar.getmembers()
+    tar = tarfile.open(path, 'r|*')
 
     manifest = {}
-    # for each dir, we want to inspect files inside of it until we find a dicom
-    # file that has header information
-    for f in filter(lambda x: x.isfile(), members):
-        dirname = os.path.dirname(f.name)
-        if dirname in manifest: continue
-        try:
-            manifest[dirname] = dcm.read_file(tar.extractfile(f))
-            if stop_after_first: break
-        except dcm.filereader.InvalidDicomError, e:
-            continue
+    try:
+        # for each dir, we want to inspect files inside of it until we find a
+        # dicom file that has header information
+        for f in tar:
+            tar.members = []  # don't hold on to every member seen
+            if not f.isfile(): continue
+            dirname = os.path.dirname(f.name)
+            if dirname in manifest: continue
+            try:
+                manifest[dirname] = read_member_headers(tar.extractfile(f))
+                if stop_after_first: break
+            except dcm.filereader.InvalidDicomError, e:
+                continue
+    finally:
+        tar.close()
     return manifest
 
 def get_zipfile_headers(path, stop_after_first = False):
     """
     Get headers for a dicom file within a zipfile
+
+    Members are opened as streams and only their preamble is read unless they
+    are dicoms, and once a folder has headers the rest of its members are
+    skipped without being decompressed.
     """
     zf = zipfile.ZipFile(path)
 
     manifest = {}
-    for f in zf.namelist():
-        dirname = os.path.dirname(f)
-        if dirname in manifest: continue
-        try:
-            manifest[dirname] = dcm.read_file(io.BytesIO(zf.read(f)))
-            if stop_after_first: break
-        except dcm.filereader.InvalidDicomError, e:
-            continue
+    try:
+        for f in zf.namelist():
+            if f.endswith('/'): continue
+            dirname = os.path.dirname(f)
+            if dirname in manifest: continue
+            try:
+                manifest[dirname] = read_member_headers(zf.open(f))
+                if stop_after_first: break
+            except dcm.filereader.InvalidDicomError, e:
+                continue
+    finally:
+        zf.close()
     return manifest
 
-def get_folder_headers(path, stop_after_first = False):
-    """
-    Generate a dictionary of subfolders and dicom headers.
+def scan_folder(path, index = None):
     """
+    Find the headers of the first dicom file in a folder.
 
-    manifest = {}
-
-    # for each dir, we want to inspect files inside of it until we find a dicom
-    # file that has header information
+    Returns a tuple (headers, subdirs) where headers is None if no dicom was
+    found, and subdirs is a list of the subfolders seen before the first dicom.
+    """
     subdirs = []
     for filename in os.listdir(path):
         filepath = os.path.join(path,filename)
@@ -178,37 +338,85 @@ def get_folder_headers(path, stop_after_first = False):
             if os.path.isdir(filepath):
                 subdirs.append(filepath)
                 continue
-            manifest[path] = dcm.read_file(filepath)
-            break
+            return read_headers(filepath, index), subdirs
         except dcm.filereader.InvalidDicomError, e:
             pass
+    return None, subdirs
+
+def get_folder_headers(path, stop_after_first = False, index = None,
+        jobs = 1):
+    """
+    Generate a dictionary of subfolders and dicom headers.
+
+    If jobs > 1, the subfolders at each level of the folder tree are scanned
+    concurrently by a pool of that many threads. The result is the same as a
+    serial scan.
+    """
+
+    manifest = {}
+
+    # for each dir, we want to inspect files inside of it until we find a dicom
+    # file that has header information
+    headers, subdirs = scan_folder(path, index)
+    if headers is not None:
+        manifest[path] = headers
 
     if stop_after_first: return manifest
 
-    # recurse
-    for subdir in subdirs:
-        manifest.update(get_folder_headers(subdir, stop_after_first))
+    if jobs <= 1:
+        # recurse
+        for subdir in subdirs:
+            manifest.update(get_folder_headers(subdir, stop_after_first, index))
+        return manifest
+
+    # breadth first, a level of the tree at a time
+    pool = ThreadPool(jobs)
+    try:
+        while subdirs:
+            results = pool.map(lambda d: scan_folder(d, index), subdirs)
+            nextdirs = []
+            for subdir, (headers, found) in zip(subdirs, results):
+                if headers is not None:
+                    manifest[subdir] = headers
+                nextdirs.extend(found)
+            subdirs = nextdirs
+    finally:
+        pool.close()
     return manifest
 
-def get_all_headers_in_folder(path, recurse = False):
+def get_all_headers_in_folder(path, recurse = False, index = None, jobs = 1):
     """
     Get DICOM headers for all files in the given path.
 
     Returns a dictionary mapping path->headers for *all* files (headers == None
     for files that are not dicoms).
+
+    If <index> (a datman.headerindex.HeaderIndex) is given, only files that
+    have changed since they were indexed are read.
+
+    If jobs > 1, files are read concurrently by a pool of that many threads.
     """
 
-    manifest = {}
+    filepaths = []
     for dirname, dirnames, filenames in os.walk(path):
         for filename in filenames:
-            filepath = os.path.join(dirname,filename)
-            headers = None
-            try:
-                headers = dcm.read_file(filepath)
-            except dcm.filereader.InvalidDicomError, e:
-                continue
-            manifest[filepath] = headers
+            filepaths.append(os.path.join(dirname,filename))
         if not recurse: break
+
+    def read(filepath):
+        try:
+            return read_headers(filepath, index)
+        except dcm.filereader.InvalidDicomError, e:
+            return None
+
+    manifest = {}
+    for filepath, headers in zip(filepaths, parallel_map(read, filepaths, jobs)):
+        if headers is None:
+            continue
+        manifest[filepath] = headers
+
+    if index is not None:
+        index.commit()
     return manifest
 
 def col(arr, colname):
@@ -381,14 +589,12 @@ def get_files_with_tag(parentdir, tag, fuzzy = False):
     within the filename's tag.
     """
 
+    parsed = scanid.parse_filenames(os.listdir(parentdir))
+
     files = []
-    for f in os.listdir(parentdir):
-        try:
-            _, filetag, _, _ = scanid.parse_filename(f)
-            if tag == filetag or (fuzzy and tag in filetag):
-                files.append(os.path.join(parentdir,f))
-        except scanid.ParseException:
-            continue
+    for f, filetag in zip(parsed['path'], parsed['tag']):
+        if tag == filetag or (fuzzy and tag in filetag):
+            files.append(os.path.join(parentdir,f))
 
     return files
 
@@ -435,6 +641,126 @@ def loadnii(filename):
 
     return nifti, affine, header, dims
 
+def iter_volumes(image, chunk_size = MASKED_LOAD_CHUNK_SIZE):
+    """
+    Yields (t, data) for consecutive runs of volumes of a nifti (a filename or
+    nibabel image), where data is an x, y, z, volumes array of the volumes
+    starting at volume t, as get_data() would give them.
+
+    The volumes are read in a single pass through the file, about chunk_size
+    bytes (as float64) at a time. A volume is contiguous on disk, so this
+    never re-reads (or, for .nii.gz files, re-decompresses) any of the file.
+    """
+    if isinstance(image, basestring):
+        image = nib.load(image)
+    dims = image.shape
+    if len(dims) == 3:
+        dims = tuple(list(dims) + [1])
+    nvox = int(np.prod(dims[:3]))
+    nvols = max(1, chunk_size // (nvox * 8))
+
+    proxy = image.dataobj
+    if getattr(proxy, 'order', None) != 'F' or \
+            not isinstance(getattr(proxy, 'file_like', None), basestring):
+        # not a plain nifti on disk, just slice it in memory
+        data = np.asarray(proxy).reshape(dims)
+        for t in range(0, dims[3], nvols):
+            yield t, data[..., t:t+nvols]
+        return
+
+    scaled = proxy.slope != 1 or proxy.inter != 0
+    vol_bytes = nvox * proxy.dtype.itemsize
+    with nib.openers.ImageOpener(proxy.file_like) as fileobj:
+        fileobj.seek(proxy.offset)
+        for t in range(0, dims[3], nvols):
+            n = min(nvols, dims[3] - t)
+            raw = fileobj.read(n * vol_bytes)
+            if len(raw) != n * vol_bytes:
+                raise ValueError('{} is shorter than its header says'.format(
+                                 proxy.file_like))
+            data = np.frombuffer(raw, dtype=proxy.dtype)
+            data = data.reshape((n,) + dims[:3][::-1]).T
+            if scaled:
+                data = data * proxy.slope + proxy.inter
+            yield t, data
+
+def load_masked_data(func, mask, dtype = None):
+    """
+    Usage:
+        data = load_masked_data('functional.nii.gz', 'mask.nii.gz')
+
+    Returns a voxels x timepoints matrix of the functional data at the
+    non-zero locations of the mask, in the same order as loadnii() gives them.
+
+    The mask may be a filename or a 3D numpy array. The functional data is
+    read a run of volumes at a time (see iter_volumes), so only the masked
+    voxels are ever held in memory as a whole. If dtype is given (e.g.
+    np.float32), the data is converted to it as it is read.
+    """
+    if isinstance(mask, basestring):
+        mask = nib.load(mask).get_data()
+    mask = mask.reshape(mask.shape[:3]) > 0
+
+    func = nib.load(func)
+    dims = func.shape
+    if len(dims) == 3:
+        dims = tuple(list(dims) + [1])
+    if mask.shape != dims[:3]:
+        raise ValueError('Mask shape {} does not match data shape {}'.format(
+                         mask.shape, dims[:3]))
+
+    if dtype is None:
+        dtype = func.get_data_dtype()
+        if func.dataobj.slope != 1 or func.dataobj.inter != 0:
+            dtype = np.float64
+
+    data = np.empty((np.count_nonzero(mask), dims[3]), dtype=dtype)
+    for t, volumes in iter_volumes(func):
+        data[:, t:t+volumes.shape[3]] = volumes[mask]
+
+    logger.debug('Loaded {} masked voxels from {}, peak memory use {} MB'.format(
+                 data.shape[0], func.get_filename(), get_peak_rss()))
+    return data
+
+def get_peak_rss():
+    """
+    Returns the peak resident memory use of this process so far, in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+def reorient_to_radiological(image):
+    """
+    Reorients a 3D or 4D image (a numpy array) to radiological orientation
+    for plotting: axial slices along the first axis, each flipped to match
+    the scanner's view. Any dimensions past the third (e.g. time) are kept,
+    in order, at the end.
+
+    Returns a view of the image, no data is copied.
+    """
+    if image.ndim < 3:
+        raise ValueError('Image has less than 3 dimensions')
+
+    axes = (2, 0, 1) + tuple(range(3, image.ndim))
+    return np.transpose(image, axes)[::-1, ::-1]
+
+def parallel_map(func, items, jobs = 1):
+    """
+    Returns map(func, items), computed by a pool of <jobs> threads.
+
+    This is meant for I/O bound work (reading files, running external
+    commands), where threads don't contend for the interpreter. With jobs <= 1
+    (or fewer than two items) the items are processed serially, in order.
+    """
+    items = list(items)
+    if jobs <= 1 or len(items) < 2:
+        return map(func, items)
+
+    pool = ThreadPool(min(jobs, len(items)))
+    try:
+        return pool.map(func, items, chunksize=1)
+    finally:
+        pool.close()
+
 def check_returncode(returncode):
     if returncode != 0:
         raise ValueError
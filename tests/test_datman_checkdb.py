@@ -0,0 +1,50 @@
+from nose.tools import *
+import datman.checkdb as checkdb
+
+
+def test_write_then_get():
+    db = checkdb.CheckDatabase(':memory:')
+    db.write('dm-check-headers', 'SPN01_CMH_0001_01_01',
+             [('SPN01_CMH_0001_01_01_T1_02_Sag', 'EchoTime', 30.0, 49.0, 5),
+              ('SPN01_CMH_0001_01_01_T1_02_Sag', 'Manufacturer', 'GE', None,
+               None)])
+
+    eq_(db.get('dm-check-headers'), [
+        checkdb.Mismatch('SPN01_CMH_0001_01_01', 'SPN01_CMH_0001_01_01_T1_02_Sag',
+                         'EchoTime', '30.0', '49.0', '5'),
+        checkdb.Mismatch('SPN01_CMH_0001_01_01', 'SPN01_CMH_0001_01_01_T1_02_Sag',
+                         'Manufacturer', 'GE', None, None)])
+    eq_(db.get('dm-check-bvecs'), [])
+
+
+def test_write_replaces_exam():
+    db = checkdb.CheckDatabase(':memory:')
+    db.write('dm-check-headers', 'SPN01_CMH_0001_01_01',
+             [('SPN01_CMH_0001_01_01_T1_02_Sag', 'EchoTime', 30, 49, 5)])
+    ok_(db.has_exam('dm-check-headers', 'SPN01_CMH_0001_01_01'))
+
+    db.write('dm-check-headers', 'SPN01_CMH_0001_01_01', [])
+    ok_(not db.has_exam('dm-check-headers', 'SPN01_CMH_0001_01_01'))
+
+
+def test_get_by_exam_prefix_and_series():
+    db = checkdb.CheckDatabase(':memory:')
+    db.write('dm-check-bvecs', 'SPN01_CMH_0001_01_01',
+             [('SPN01_CMH_0001_01_01_DTI_05', 'bvec', '0 1', None, None)])
+    db.write('dm-check-bvecs', 'SPN01_CMH_0002_01_01',
+             [('SPN01_CMH_0002_01_01_DTI_05', 'bval', None, '1000', None)])
+    db.write('dm-check-bvecs', 'SPN01_CMH_0001_01_02',
+             [('SPN01_CMH_0001_01_02_DTI_05', 'bval', None, '1000', None)])
+
+    eq_([m.exam for m in db.get('dm-check-bvecs', 'SPN01_CMH_0001')],
+        ['SPN01_CMH_0001_01_01', 'SPN01_CMH_0001_01_02'])
+    eq_(db.get_by_series('dm-check-bvecs', 'SPN01_CMH_0002_01_01').keys(),
+        ['SPN01_CMH_0002_01_01_DTI_05'])
+
+
+def test_prefix_upper_bound():
+    eq_(checkdb.prefix_upper_bound('SPN01_CMH'), 'SPN01_CMI')
+    eq_(checkdb.prefix_upper_bound('SPN\xff'), 'SPO')
+    eq_(checkdb.prefix_upper_bound(''), None)
+
+# vim: set ts=4 sw=4 :
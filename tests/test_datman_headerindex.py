@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+from nose.tools import *
+import datman.headerindex as headerindex
+
+TMPDIR = None
+
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp(prefix='test-headerindex-')
+
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+
+def make_file(name, contents='dicom'):
+    path = os.path.join(TMPDIR, name)
+    with open(path, 'w') as f:
+        f.write(contents)
+    return path
+
+
+def test_lookup_missing():
+    index = headerindex.HeaderIndex(':memory:')
+    source = make_file('missing.dcm')
+    eq_(index.lookup(TMPDIR, source, source), (False, None))
+
+
+def test_store_then_lookup():
+    index = headerindex.HeaderIndex(':memory:')
+    source = make_file('stored.dcm')
+    headers = {'SeriesNumber': 3, 'SeriesDescription': 'T1'}
+    index.store(TMPDIR, source, source, headers)
+    eq_(index.lookup(TMPDIR, source, source), (True, headers))
+
+
+def test_store_non_dicom():
+    index = headerindex.HeaderIndex(':memory:')
+    source = make_file('catalog.xml')
+    index.store(TMPDIR, source, source, None)
+    eq_(index.lookup(TMPDIR, source, source), (True, None))
+
+
+def test_changed_file_is_stale():
+    index = headerindex.HeaderIndex(':memory:')
+    source = make_file('changed.dcm')
+    index.store(TMPDIR, source, source, {'SeriesNumber': 1})
+    make_file('changed.dcm', 'a much longer dicom')
+    eq_(index.lookup(TMPDIR, source, source), (False, None))
+
+
+def test_query_by_series_and_description():
+    index = headerindex.HeaderIndex(':memory:')
+    t1 = make_file('t1.dcm')
+    dti = make_file('dti.dcm')
+    index.store(TMPDIR, t1, t1,
+                {'SeriesNumber': 2, 'SeriesDescription': 'Sag-T1-BRAVO'})
+    index.store(TMPDIR, dti, dti,
+                {'SeriesNumber': 5, 'SeriesDescription': 'Ax-DTI-60'})
+
+    eq_(index.query(series=5).keys(), [dti])
+    eq_(index.query(description='T1').keys(), [t1])
+    eq_(index.get_tag('SeriesNumber', archive=TMPDIR), {t1: 2, dti: 5})
+
+
+def test_query_by_archive_prefix():
+    index = headerindex.HeaderIndex(':memory:')
+    source = make_file('prefix.dcm')
+    exam = os.path.join(TMPDIR, 'SPN01_CMH_0001_01_01')
+    for archive, member in [
+            (exam, 'a.dcm'),
+            (exam + '/SCANS/1', 'b.dcm'),
+            # named the same but for the character where the _ is, or case
+            (exam.replace('SPN01_', 'SPN01-') + '/SCANS/1', 'c.dcm'),
+            (exam.replace('SPN01_CMH', 'spn01_cmh') + '/SCANS/1', 'd.dcm'),
+            (exam + '_extra', 'e.dcm')]:
+        index.store(archive, member, source, {'SeriesNumber': 1})
+
+    eq_(sorted(index.query(archive=exam)), ['a.dcm', 'b.dcm'])
+    eq_(sorted(index.query(archive=exam, prefix=False)), ['a.dcm'])
+
+
+def test_archive_manifest():
+    index = headerindex.HeaderIndex(':memory:')
+    archive = make_file('exam.zip')
+    manifest = {'SCANS/1': {'SeriesNumber': 1},
+                'SCANS/2': {'SeriesNumber': 2}}
+
+    index.store_archive(archive, manifest, complete=False)
+    eq_(index.lookup_archive(archive), None)
+    eq_(len(index.lookup_archive(archive, stop_after_first=True)), 1)
+
+    index.store_archive(archive, manifest)
+    eq_(index.lookup_archive(archive), manifest)
+
+# vim: set ts=4 sw=4 :
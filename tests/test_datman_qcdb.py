@@ -0,0 +1,104 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+from nose.tools import *
+import datman.qcdb as qcdb
+
+TMPDIR = None
+
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp(prefix='test-qcdb-')
+
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+
+def test_get_site():
+    eq_(qcdb.get_site('SPN01_CMH_0001_01_01'), 'CMH')
+    eq_(qcdb.get_site('garbage'), None)
+
+
+def test_write_then_table():
+    db = qcdb.QCDatabase(':memory:')
+    db.write([('fmri', 'SPN01_CMH_0001_01_01', 'RST_04', 'fdtot', 1.5),
+              ('fmri', 'SPN01_CMH_0001_01_01', 'RST_04', 'fdnum', 3),
+              ('fmri', 'SPN01_MRC_0002_01_01', 'RST_04', 'fdtot', 2.5),
+              ('dti', 'SPN01_CMH_0001_01_01', 'DTI_05', 'spikecount', 7)])
+
+    eq_(db.get_metrics('fmri'), ['fdnum', 'fdtot'])
+    eq_(db.get_subjects('dti'), ['SPN01_CMH_0001_01_01'])
+
+    rows = db.table('fmri', ['fdtot', 'fdnum'])
+    eq_([(r['subj'], r['site'], r['fdtot'], r['fdnum']) for r in rows],
+        [('SPN01_CMH_0001_01_01', 'CMH', 1.5, 3),
+         ('SPN01_MRC_0002_01_01', 'MRC', 2.5, None)])
+
+
+def test_write_replaces_values():
+    db = qcdb.QCDatabase(':memory:')
+    db.write([('fmri', 'SPN01_CMH_0001_01_01', 'RST_04', 'fdtot', 1.5)])
+    db.write([('fmri', 'SPN01_CMH_0001_01_01', 'RST_04', 'fdtot', 4.0)])
+    eq_([r['fdtot'] for r in db.table('fmri')], [4.0])
+
+
+def test_pivot():
+    db = qcdb.QCDatabase(':memory:')
+    db.write([('fmri', 'SPN01_CMH_0001_01_01', 'RST_04', 'fdtot', 1.0),
+              ('fmri', 'SPN01_CMH_0002_01_01', 'RST_04', 'fdtot', 3.0),
+              ('fmri', 'SPN01_MRC_0003_01_01', 'RST_04', 'fdtot', 5.0)])
+    pivot = db.pivot('fmri', 'fdtot')
+    eq_(len(pivot), 1)
+    eq_(pivot.values()[0], {'CMH': (2.0, 2), 'MRC': (5.0, 1)})
+
+
+def test_migrate_wide_tables():
+    path = os.path.join(TMPDIR, 'old.db')
+    old = sqlite3.connect(path)
+    old.execute('CREATE TABLE fmri (subj TEXT, site TEXT, fdtot FLOAT)')
+    old.execute('CREATE TABLE dti (subj TEXT, site TEXT)')
+    old.execute("INSERT INTO fmri VALUES ('SPN01_CMH_0001_01_01', 'CMH', 2)")
+    old.execute("INSERT INTO fmri VALUES ('SPN01_CMH_0002_01_01', 'CMH', null)")
+    old.commit()
+    old.close()
+
+    db = qcdb.QCDatabase(path)
+    rows = db.table('fmri')
+    eq_([(r['subj'], r['scan'], r['fdtot']) for r in rows],
+        [('SPN01_CMH_0001_01_01', '', 2.0)])
+    db.close()
+
+    # migrating again does nothing
+    db = qcdb.QCDatabase(path)
+    eq_(len(db.table('fmri')), 1)
+    db.close()
+
+    # a new value for a scan supersedes the migrated one
+    db = qcdb.QCDatabase(path)
+    db.write([('fmri', 'SPN01_CMH_0001_01_01', 'RST_04', 'fdtot', 4)])
+    eq_([(r['subj'], r['scan'], r['fdtot']) for r in db.table('fmri')],
+        [('SPN01_CMH_0001_01_01', 'RST_04', 4.0)])
+    eq_(db.pivot('fmri', 'fdtot').values(), [{'CMH': (4.0, 1)}])
+    db.close()
+
+
+def test_migrated_values_left_out_of_queries():
+    db = qcdb.QCDatabase(':memory:')
+    # as left by migrate(), e.g. in a database written before write()
+    # deleted migrated values
+    db.db.execute("INSERT INTO metrics VALUES ('SPN01_CMH_0001_01_01', 'CMH', "
+                  "'', 'fmri', 'fdtot', 2, NULL)")
+    db.db.execute("INSERT INTO metrics VALUES ('SPN01_CMH_0001_01_01', 'CMH', "
+                  "'RST_04', 'fmri', 'fdtot', 4, '2016-01-01T00:00:00')")
+    db.db.execute("INSERT INTO metrics VALUES ('SPN01_CMH_0002_01_01', 'CMH', "
+                  "'', 'fmri', 'fdtot', 6, NULL)")
+
+    eq_([(r['subj'], r['fdtot']) for r in db.table('fmri', ['fdtot'])],
+        [('SPN01_CMH_0001_01_01', 4.0), ('SPN01_CMH_0002_01_01', 6.0)])
+    eq_(db.pivot('fmri', 'fdtot'),
+        {None: {'CMH': (6.0, 1)}, '2016-01': {'CMH': (4.0, 1)}})
+
+# vim: set ts=4 sw=4 :
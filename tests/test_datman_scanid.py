@@ -95,4 +95,36 @@ def test_parse_filename_with_path():
     eq_(series, '02')
     eq_(description, 'description')
 
+def test_identifiers_equal():
+    ident = scanid.Identifier("DTI","CMH","H001","01","02")
+    eq_(ident, scanid.parse("DTI_CMH_H001_01_02"))
+    eq_(len(set([ident, scanid.parse("DTI_CMH_H001_01_02")])), 1)
+    ok_(ident != scanid.parse("DTI_CMH_H001_01_03"))
+
+def test_parse_shares_identifiers():
+    ident, _, _, _ = scanid.parse_filename(
+            'DTI_CMH_H001_01_01_T1_02_description.nii.gz')
+    ok_(ident is scanid.parse("DTI_CMH_H001_01_01"))
+
+def test_parse_filenames():
+    parsed = scanid.parse_filenames([
+            '/data/DTI_CMH_H001_01_01_T1_02_description.nii.gz',
+            '/data/garbage.nii.gz',
+            'SPN01_MRC_PHA_FBN0013_RST_04_EPI-3x3x4xTR2.nii.gz'])
+    eq_(parsed.keys(), scanid.FILENAME_COLUMNS)
+    eq_(parsed['path'], ['/data/DTI_CMH_H001_01_01_T1_02_description.nii.gz',
+                         'SPN01_MRC_PHA_FBN0013_RST_04_EPI-3x3x4xTR2.nii.gz'])
+    eq_(parsed['ident'], [scanid.parse('DTI_CMH_H001_01_01'),
+                          scanid.parse('SPN01_MRC_PHA_FBN0013')])
+    eq_(parsed['subject'], ['H001', 'PHA_FBN0013'])
+    eq_(parsed['timepoint'], ['01', ''])
+    eq_(parsed['tag'], ['T1', 'RST'])
+    eq_(parsed['series'], ['02', '04'])
+    eq_(parsed['description'], ['description', 'EPI-3x3x4xTR2'])
+    eq_(parsed['ext'], ['.nii.gz', '.nii.gz'])
+
+def test_parse_filenames_empty():
+    parsed = scanid.parse_filenames([])
+    eq_(parsed['path'], [])
+
 # vim: ts=4 sw=4:
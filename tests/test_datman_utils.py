@@ -0,0 +1,278 @@
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+import dicom
+import dicom.dataset
+import nibabel as nib
+import numpy as np
+import datman.utils as utils
+from nose.tools import *
+
+TAGMAP = {
+    "T1"    : "T1",
+    "DTI"   : "DTI",
+    "Rest"  : "REST",
+    "Fiel"  : "FMAP",
+    "Field" : "FMAP",
+}
+
+def test_guess_tag_no_match():
+    eq_(utils.guess_tag("Localizer", TAGMAP), None)
+
+def test_guess_tag_single_match():
+    eq_(utils.guess_tag("Sag-T1-BRAVO", TAGMAP), "T1")
+
+def test_guess_tag_patterns_with_same_tag():
+    eq_(utils.guess_tag("FieldMap", TAGMAP), "FMAP")
+
+def test_guess_tag_multiple_matches():
+    eq_(sorted(utils.guess_tag("Rest-DTI", TAGMAP)), ["DTI", "REST"])
+
+def test_guess_tag_with_matcher():
+    matcher = utils.TagMatcher(TAGMAP)
+    eq_(utils.guess_tag("Ax-DTI-60", matcher), "DTI")
+
+def test_tag_matcher_pairs_keep_order():
+    matcher = utils.TagMatcher([("DTI", "DTI"), ("Rest", "REST")])
+    eq_(matcher("Rest-DTI"), ["DTI", "REST"])
+
+def test_tag_matcher_caches_results():
+    matcher = utils.TagMatcher(TAGMAP)
+    eq_(matcher("Sag-T1-BRAVO"), "T1")
+    eq_(matcher.cache, {"Sag-T1-BRAVO": "T1"})
+    eq_(matcher("Sag-T1-BRAVO"), "T1")
+
+def test_reorient_to_radiological_3d():
+    image = np.arange(24).reshape(2,3,4)
+    reoriented = utils.reorient_to_radiological(image)
+    eq_(reoriented.shape, (4,2,3))
+    ok_(np.array_equal(reoriented,
+                       np.rot90(np.transpose(image, (2,0,1)), 2)))
+
+def test_reorient_to_radiological_4d():
+    image = np.arange(120).reshape(2,3,4,5)
+    reoriented = utils.reorient_to_radiological(image)
+    eq_(reoriented.shape, (4,2,3,5))
+    for t in range(5):
+        ok_(np.array_equal(reoriented[..., t],
+            utils.reorient_to_radiological(image[..., t])))
+
+def test_reorient_to_radiological_is_a_view():
+    image = np.zeros((2,3,4))
+    ok_(np.may_share_memory(utils.reorient_to_radiological(image), image))
+
+@raises(ValueError)
+def test_reorient_to_radiological_2d():
+    utils.reorient_to_radiological(np.zeros((2,3)))
+
+def test_load_masked_data_gzipped_scaled():
+    tmpdir = tempfile.mkdtemp(prefix='test-utils-')
+    try:
+        rng = np.random.RandomState(0)
+        func = (rng.rand(6, 5, 4, 30) * 1000).astype(np.int16)
+        mask = rng.rand(6, 5, 4) > 0.5
+        img = nib.Nifti1Image(func, np.eye(4))
+        img.header.set_slope_inter(0.5, 10)
+        funcfile = os.path.join(tmpdir, 'func.nii.gz')
+        nib.save(img, funcfile)
+
+        expected = nib.load(funcfile).get_data()
+        ok_(np.array_equal(utils.load_masked_data(funcfile, mask),
+                           expected[mask]))
+
+        # a few volumes at a time
+        chunks = list(utils.iter_volumes(funcfile, chunk_size=6*5*4*8*7))
+        eq_([t for t, data in chunks], [0, 7, 14, 21, 28])
+        ok_(np.array_equal(np.concatenate([data for t, data in chunks],
+                                          axis=3), expected))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_load_masked_data():
+    tmpdir = tempfile.mkdtemp(prefix='test-utils-')
+    try:
+        rng = np.random.RandomState(0)
+        func = rng.rand(9, 7, 5, 4).astype(np.float32)
+        mask = (rng.rand(9, 7, 5) > 0.5).astype(np.int16)
+        funcfile = os.path.join(tmpdir, 'func.nii.gz')
+        maskfile = os.path.join(tmpdir, 'mask.nii.gz')
+        nib.save(nib.Nifti1Image(func, np.eye(4)), funcfile)
+        nib.save(nib.Nifti1Image(mask, np.eye(4)), maskfile)
+
+        expected = utils.loadnii(funcfile)[0][mask.reshape(-1) > 0]
+        ok_(np.array_equal(utils.load_masked_data(funcfile, maskfile),
+                           expected))
+        ok_(np.array_equal(utils.load_masked_data(funcfile, mask), expected))
+        eq_(utils.load_masked_data(funcfile, mask, dtype=np.float64).dtype,
+            np.float64)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def make_dicom(series, uid, preamble=True):
+    """Returns the bytes of a small dicom, without the preamble if asked."""
+    meta = dicom.dataset.Dataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = uid
+    meta.ImplementationClassUID = '1.2.3.4'
+    meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+    ds = dicom.dataset.FileDataset('', {}, file_meta=meta, preamble='\0'*128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SeriesNumber = series
+    ds.SOPInstanceUID = uid
+    ds.PixelData = '\0' * 32
+    ds[0x7fe00010].VR = 'OW'
+    data = io.BytesIO()
+    ds.save_as(data)
+    data = data.getvalue()
+    return data if preamble else data[utils.DICOM_PREAMBLE_LENGTH:]
+
+# (member, contents) of the fixture archives. Dicoms are interleaved with
+# non-dicoms, some folders have no dicoms at all, and some dicoms have no
+# preamble (which isn't enough to be read as a dicom).
+ARCHIVE_MEMBERS = [
+    ('exam/1/DICOM/catalog.xml', '<catalog/>'),
+    ('exam/1/DICOM/nopreamble.dcm', make_dicom(1, '1.1', preamble=False)),
+    ('exam/2/DICOM/notes.txt', 'x' * 4096),
+    ('exam/1/DICOM/a.dcm', make_dicom(1, '1.2')),
+    ('exam/2/DICOM/b.dcm', make_dicom(2, '2.1')),
+    ('exam/1/DICOM/c.dcm', make_dicom(1, '1.3')),
+    ('exam/3/behav/log.csv', 'a,b\n1,2\n'),
+    ('exam/4/nested/deeper/d.dcm', make_dicom(4, '4.1')),
+    ('exam/4/nested/e.dcm', make_dicom(4, '4.2')),
+    ('exam/2/DICOM/f.dcm', make_dicom(2, '2.2')),
+]
+
+def summarize(manifest, root):
+    """Returns {folder: sorted (header, value)s} for a header manifest, with
+    folders relative to root."""
+    return dict((os.path.relpath(os.path.join(root, path), root),
+                 sorted((name, str(headers.get(name)))
+                        for name in headers.dir() if name != 'PixelData'))
+                for path, headers in manifest.items())
+
+def baseline_get_folder_headers(path, stop_after_first = False):
+    """The original get_folder_headers."""
+    manifest = {}
+    subdirs = []
+    for filename in os.listdir(path):
+        filepath = os.path.join(path,filename)
+        try:
+            if os.path.isdir(filepath):
+                subdirs.append(filepath)
+                continue
+            manifest[path] = dicom.read_file(filepath)
+            break
+        except dicom.filereader.InvalidDicomError, e:
+            pass
+
+    if stop_after_first: return manifest
+
+    for subdir in subdirs:
+        manifest.update(baseline_get_folder_headers(subdir, stop_after_first))
+    return manifest
+
+def test_folder_headers_match_baseline():
+    tmpdir = tempfile.mkdtemp(prefix='test-utils-')
+    try:
+        for name, contents in ARCHIVE_MEMBERS:
+            path = os.path.join(tmpdir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(contents)
+        os.makedirs(os.path.join(tmpdir, 'exam', '5', 'empty'))
+
+        exam = os.path.join(tmpdir, 'exam')
+        expected = summarize(baseline_get_folder_headers(exam), tmpdir)
+        # (whether nested/deeper is reached depends on the listing order)
+        ok_(set(['exam/1/DICOM', 'exam/2/DICOM', 'exam/4/nested']) <=
+            set(expected))
+        for jobs in [1, 3]:
+            eq_(summarize(utils.get_folder_headers(exam, jobs=jobs), tmpdir),
+                expected)
+            eq_(summarize(utils.get_archive_headers(exam, jobs=jobs), tmpdir),
+                expected)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def baseline_get_tarfile_headers(path, stop_after_first = False):
+    """The original get_tarfile_headers."""
+    tar = tarfile.open(path)
+    members = tar.getmembers()
+
+    manifest = {}
+    for f in filter(lambda x: x.isfile(), members):
+        dirname = os.path.dirname(f.name)
+        if dirname in manifest: continue
+        try:
+            manifest[dirname] = dicom.read_file(tar.extractfile(f))
+            if stop_after_first: break
+        except dicom.filereader.InvalidDicomError, e:
+            continue
+    return manifest
+
+def test_tarfile_headers_match_baseline():
+    tmpdir = tempfile.mkdtemp(prefix='test-utils-')
+    try:
+        path = os.path.join(tmpdir, 'exam.tar.gz')
+        tar = tarfile.open(path, 'w:gz')
+        for name, contents in ARCHIVE_MEMBERS:
+            info = tarfile.TarInfo(name)
+            info.size = len(contents)
+            tar.addfile(info, io.BytesIO(contents))
+        tar.close()
+
+        for stop_after_first in [False, True]:
+            expected = baseline_get_tarfile_headers(path, stop_after_first)
+            eq_(len(expected), 1 if stop_after_first else 4)
+            eq_(summarize(utils.get_tarfile_headers(path, stop_after_first),
+                          tmpdir),
+                summarize(expected, tmpdir))
+            eq_(summarize(utils.get_archive_headers(path, stop_after_first),
+                          tmpdir),
+                summarize(expected, tmpdir))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def baseline_get_zipfile_headers(path, stop_after_first = False):
+    """The original get_zipfile_headers."""
+    zf = zipfile.ZipFile(path)
+
+    manifest = {}
+    for f in zf.namelist():
+        dirname = os.path.dirname(f)
+        if dirname in manifest: continue
+        try:
+            manifest[dirname] = dicom.read_file(io.BytesIO(zf.read(f)))
+            if stop_after_first: break
+        except dicom.filereader.InvalidDicomError, e:
+            continue
+    return manifest
+
+def test_zipfile_headers_match_baseline():
+    tmpdir = tempfile.mkdtemp(prefix='test-utils-')
+    try:
+        path = os.path.join(tmpdir, 'exam.zip')
+        zf = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        zf.writestr('exam/3/', '')
+        zf.writestr('exam/2/DICOM/nopreamble.dcm',
+                    make_dicom(2, '2.0', preamble=False))
+        for name, contents in ARCHIVE_MEMBERS:
+            zf.writestr(name, contents)
+        zf.close()
+
+        for stop_after_first in [False, True]:
+            expected = baseline_get_zipfile_headers(path, stop_after_first)
+            eq_(len(expected), 1 if stop_after_first else 4)
+            eq_(summarize(utils.get_zipfile_headers(path, stop_after_first),
+                          tmpdir),
+                summarize(expected, tmpdir))
+            eq_(summarize(utils.get_archive_headers(path, stop_after_first),
+                          tmpdir),
+                summarize(expected, tmpdir))
+    finally:
+        shutil.rmtree(tmpdir)
@@ -36,3 +36,13 @@ def test_mismatched_bvec_bval():
     assert bval in diffs.keys()
     assert bvec in diffs.keys()
 
+
+def test_mismatch_rows():
+    diffs = {'exam/SPN01_CMH_0001_01_01_DTI60-1000_04_Ax.bval':
+                 '- 0 1000 1000\n+ 0 1000 1000 1000\n'}
+    rows = check.get_mismatch_rows(diffs)
+
+    expected = [
+        ('SPN01_CMH_0001_01_01_DTI60-1000_04_Ax', 'bval', None, '0 1000 1000', None),
+        ('SPN01_CMH_0001_01_01_DTI60-1000_04_Ax', 'bval', '0 1000 1000 1000', None, None)]
+    assert rows == expected, rows
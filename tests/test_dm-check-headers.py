@@ -1,7 +1,11 @@
 from nose.tools import *
 import importlib
+import os
+import shutil
 import sys
+import tempfile
 from StringIO import StringIO
+import dicom
 
 check_headers = importlib.import_module('bin.dm-check-headers')
 
@@ -75,4 +79,69 @@ def test_header_single_mismatch():
         tolerance=None)]
     assert mismatches == expected
 
+
+def test_header_names_match_dir():
+    headers = dicom.dataset.Dataset()
+    headers.EchoTime = '30'
+    headers.SeriesDescription = 'T1'
+    headers.add_new(0x00191010, 'LO', 'private')
+    eq_(check_headers.get_header_names(headers), set(headers.dir()))
+
+
+def test_plan_mismatches():
+    stdhdr = mock_header({"EchoTime": 30.0, "RepetitionTime": 2.0,
+                          "same": "a", "std-only": 1, "ignored": 1})
+    cmphdr = mock_header({"EchoTime": 34.0, "RepetitionTime": 2.2,
+                          "same": "b", "cmp-only": 2, "ignored": 2})
+    plan = check_headers.compile_standard(stdhdr, ignore_headers=["ignored"])
+
+    eq_(check_headers.check_headers(plan, mock_header(stdhdr)), [])
+    eq_(check_headers.check_headers(plan, cmphdr), [
+        check_headers.Mismatch("RepetitionTime", 2.0, 2.2, 1),
+        check_headers.Mismatch("cmp-only", None, 2, None),
+        check_headers.Mismatch("same", "a", "b", None),
+        check_headers.Mismatch("std-only", 1, None, None)])
+
+
+def test_plan_tolerances():
+    stdhdr = mock_header({"EchoTime": 30.0})
+    plan = check_headers.compile_standard(stdhdr)
+
+    eq_(check_headers.check_headers(plan, mock_header({"EchoTime": 35.4})), [])
+    eq_(check_headers.check_headers(plan, mock_header({"EchoTime": 36.0})),
+        [check_headers.Mismatch(header="EchoTime", expected=30.0, actual=36.0,
+                                tolerance=5)])
+
+
+def test_result_cache():
+    cache = check_headers.ResultCache(':memory:')
+    eq_(cache.lookup('exam', 'e1', 's1', 'c1'), None)
+
+    cache.store('exam', 'e1', 's1', 'c1', ['a mismatch'])
+    eq_(cache.lookup('exam', 'e1', 's1', 'c1'), ['a mismatch'])
+    eq_(cache.lookup('exam', 'e2', 's1', 'c1'), None)
+    eq_(cache.lookup('exam', 'e1', 's2', 'c1'), None)
+    eq_(cache.lookup('exam', 'e1', 's1', 'c2'), None)
+
+
+def test_fingerprint_follows_files():
+    tmpdir = tempfile.mkdtemp(prefix='test-dm-check-headers-')
+    try:
+        dcm = os.path.join(tmpdir, 'scan.dcm')
+        open(dcm, 'w').write('dicom')
+        key = check_headers.get_fingerprint(tmpdir)
+        eq_(check_headers.get_fingerprint(tmpdir), key)
+
+        open(dcm, 'w').write('a longer dicom')
+        assert_not_equal(check_headers.get_fingerprint(tmpdir), key)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_config_key_follows_settings():
+    eq_(check_headers.get_config_key(['b', 'a']),
+        check_headers.get_config_key(['a', 'b']))
+    assert_not_equal(check_headers.get_config_key(['a']),
+                     check_headers.get_config_key(['a', 'b']))
+
 # vim: set ts=4 sw=4 :
@@ -0,0 +1,173 @@
+from nose.tools import *
+import importlib
+import os
+import shutil
+import tempfile
+import nibabel as nib
+import numpy as np
+
+qc_html = importlib.import_module('bin.qc-html')
+
+
+def random_timeseries(voxels=200, timepoints=40):
+    rng = np.random.RandomState(1)
+    signal = rng.randn(timepoints)
+    weights = rng.rand(voxels, 1)
+    return weights * signal + rng.randn(voxels, timepoints)
+
+
+def test_correlation_summary_matches_corrcoef():
+    func = random_timeseries()
+    mean, std, heatmap = qc_html.correlation_summary(func, fraction=1.0,
+                                                     blocksize=16)
+    corr = np.corrcoef(func)
+    assert_almost_equal(mean, np.mean(corr))
+    assert_almost_equal(std, np.std(corr))
+
+
+def test_correlation_summary_is_seeded():
+    func = random_timeseries()
+    eq_(qc_html.correlation_summary(func)[:2],
+        qc_html.correlation_summary(func)[:2])
+
+
+def test_correlation_summary_drops_constant_voxels():
+    func = random_timeseries()
+    func[::2] = 7
+    mean, std, heatmap = qc_html.correlation_summary(func, fraction=1.0)
+    corr = np.corrcoef(func[1::2])
+    assert_almost_equal(mean, np.mean(corr))
+    eq_(heatmap.shape, (100, 100))
+
+
+def test_correlation_summary_heatmap_size():
+    func = random_timeseries(voxels=1000)
+    mean, std, heatmap = qc_html.correlation_summary(func, heatmap_size=50)
+    eq_(heatmap.shape, (50, 50))
+    assert_almost_equal(heatmap[0, 0], 1.0)
+
+
+def test_epi_spike_table():
+    image = np.ones((8, 8, 3, 5))
+    image[:, :, 1, 2] = 100
+    table = qc_html.epi_spike_table(image)
+    eq_(len(table), 3 * 5)
+    spikes = table[table['spike']]
+    eq_(spikes[['slice', 'volume']].values.tolist(), [[1, 2]])
+
+
+def test_epi_spike_table_drops_b0s():
+    image = np.ones((8, 8, 3, 5))
+    bvec = np.array([0, 1, 1, 0, 1])
+    table = qc_html.epi_spike_table(image, bvec)
+    eq_(sorted(set(table['volume'])), [1, 2, 4])
+
+def test_fmri_stats_detrended_stdev():
+    tmpdir = tempfile.mkdtemp(prefix='test-qc-html-')
+    try:
+        rng = np.random.RandomState(0)
+        data = 100 + rng.randn(6, 5, 4, 20) + 0.5 * np.arange(20)
+        fpath = os.path.join(tmpdir, 'func.nii.gz')
+        nib.save(nib.Nifti1Image(data, np.eye(4)), fpath)
+
+        stats = qc_html.fmri_stats(fpath)
+
+        t = np.arange(20)
+        fit = np.polyfit(t, data.reshape(-1, 20).T, 1)
+        resid = data.reshape(-1, 20) - (np.outer(fit[0], t) + fit[1][:, None])
+        expected = np.std(resid, axis=1, ddof=1).reshape(6, 5, 4)
+        assert_true(np.allclose(stats.std, expected))
+        assert_true(np.allclose(stats.mean, data.mean(axis=3)))
+        assert_true(np.allclose(stats.sfnr, stats.mean / stats.std))
+
+        # the same, a few volumes at a time
+        iter_volumes = qc_html.dm.utils.iter_volumes
+        qc_html.dm.utils.iter_volumes = lambda img: iter_volumes(
+            img, chunk_size=6*5*4*8*3)
+        try:
+            chunked = qc_html.fmri_stats(fpath)
+        finally:
+            qc_html.dm.utils.iter_volumes = iter_volumes
+        assert_true(np.allclose(chunked.std, expected))
+        assert_true(np.allclose(chunked.mean, stats.mean))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_automask_keeps_largest_blob():
+    image = np.zeros((30, 30, 30))
+    image[5:20, 5:20, 5:20] = 100
+    image[10:14, 10:14, 10:14] = 0     # a hole
+    image[25:28, 25:28, 25:28] = 100   # a smaller, separate blob
+
+    mask = qc_html.automask(image, clfrac=0.5, peels=1)
+    ok_(mask[12, 12, 12])
+    ok_(not mask[26, 26, 26])
+    ok_(mask[6:19, 6:19, 6:19].all())
+    ok_(not mask[:5].any())
+
+def test_fmri_plots_leave_montages_alone():
+    tmpdir = tempfile.mkdtemp(prefix='test-qc-html-')
+    try:
+        rng = np.random.RandomState(0)
+        func = os.path.join(tmpdir, 'func.nii.gz')
+        nib.save(nib.Nifti1Image(100 + rng.randn(8, 8, 6, 30), np.eye(4)),
+                 func)
+        motion = os.path.join(tmpdir, 'motion.1D')
+        np.savetxt(motion, rng.randn(30, 6) * 0.1)
+        mask = np.ones((8, 8, 6), dtype=bool)
+        first = rng.rand(8, 8, 6)
+        second = rng.rand(8, 8, 6)
+
+        def pic(name):
+            return os.path.join(tmpdir, name + '.png')
+
+        qc_html.MONTAGE_FIGURES.clear()
+        qc_html.montage(second, 'SFNR', 'scan', pic('alone'), cmaptype='hot')
+
+        qc_html.MONTAGE_FIGURES.clear()
+        qc_html.montage(first, 'BOLD', 'scan', pic('first'))
+        qc_html.fmri_plots(func, mask, motion, 'scan', pic('plots'))
+        qc_html.montage(second, 'SFNR', 'scan', pic('second'), cmaptype='hot')
+
+        fig, axes, cbar_ax = qc_html.MONTAGE_FIGURES.values()[0]
+        eq_(len(fig.axes), axes.size + 1)
+        ok_(np.array_equal(qc_html.plt.imread(pic('alone')),
+                           qc_html.plt.imread(pic('second'))))
+    finally:
+        qc_html.MONTAGE_FIGURES.clear()
+        shutil.rmtree(tmpdir)
+
+
+def test_qc_key_follows_contents():
+    tmpdir = tempfile.mkdtemp(prefix='test-qc-html-')
+    try:
+        fpath = os.path.join(tmpdir, 'STUDY_CMH_0001_01_01_DTI_05_Ax.nii.gz')
+        open(fpath, 'w').write('dti')
+        open(fpath.replace('.nii.gz', '.bvec'), 'w').write('0 1 1')
+
+        key, stats = qc_html.get_qc_key(qc_html.dti_qc, fpath)
+        eq_(sorted(key['inputs']), ['STUDY_CMH_0001_01_01_DTI_05_Ax.bvec',
+                                    'STUDY_CMH_0001_01_01_DTI_05_Ax.nii.gz'])
+        entry = {'key': key, 'stats': stats, 'html': '', 'pics': []}
+        ok_(qc_html.is_cached(entry, qc_html.get_qc_key(qc_html.dti_qc,
+                                                        fpath)[0], tmpdir))
+
+        open(fpath.replace('.nii.gz', '.bvec'), 'w').write('0 1 0')
+        ok_(not qc_html.is_cached(entry, qc_html.get_qc_key(qc_html.dti_qc,
+                                                            fpath)[0], tmpdir))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_is_cached_needs_pics():
+    tmpdir = tempfile.mkdtemp(prefix='test-qc-html-')
+    try:
+        entry = {'key': {}, 'stats': {}, 'html': '', 'pics': ['scan.png']}
+        ok_(not qc_html.is_cached(entry, {}, tmpdir))
+        open(os.path.join(tmpdir, 'scan.png'), 'w').write('png')
+        ok_(qc_html.is_cached(entry, {}, tmpdir))
+    finally:
+        shutil.rmtree(tmpdir)
+
+# vim: set ts=4 sw=4 :
@@ -0,0 +1,206 @@
+from nose.tools import *
+import dicom
+import dicom.dataset
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import pandas as pd
+
+xnat_extract = importlib.import_module('bin.xnat-extract')
+
+TMPDIR = None
+EXPORTED = []
+EXPORTED_LOCK = threading.Lock()
+
+EXPORTINFO = """\
+pattern   tag   export_nii  export_dcm  count
+T1        T1    yes         yes         1
+Resting   RST   yes         no          1
+"""
+
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp(prefix='test-xnat-extract-')
+    xnat_extract.exporters = {'nii': fake_exporter('nii'),
+                              'dcm': fake_exporter('dcm')}
+
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+
+def fake_exporter(fmt):
+    """Returns an exporter that records what it is asked to export."""
+    def export(seriesdir, outputdir, stem):
+        with EXPORTED_LOCK:
+            EXPORTED.append((fmt, stem))
+        return 0
+    return export
+
+
+def make_dicom(path, series, description):
+    meta = dicom.dataset.Dataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = '1.2.3.{}'.format(series)
+    meta.ImplementationClassUID = '1.2.3.4'
+    meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+    ds = dicom.dataset.FileDataset(path, {}, file_meta=meta,
+                                   preamble='\0' * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SeriesNumber = series
+    ds.SeriesDescription = description
+    ds.save_as(path)
+
+
+def make_archive(name, series):
+    """Makes an XNAT archive with a few dicoms in each (number, description)
+    series."""
+    archive = os.path.join(TMPDIR, 'archive', name)
+    for number, description in series:
+        dicomdir = os.path.join(archive, 'SCANS', str(number), 'DICOM')
+        os.makedirs(dicomdir)
+        for i in range(3):
+            make_dicom(os.path.join(dicomdir, '{}.dcm'.format(i)), number,
+                       description)
+        with open(os.path.join(dicomdir, 'catalog.xml'), 'w') as f:
+            f.write('<catalog/>')
+    return archive
+
+
+def make_exportinfo():
+    path = os.path.join(TMPDIR, 'exportinfo.csv')
+    with open(path, 'w') as f:
+        f.write(EXPORTINFO)
+    return path
+
+
+def run_main(*args):
+    """Runs xnat-extract.py, returning the exports made."""
+    del EXPORTED[:]
+    argv = sys.argv
+    sys.argv = ['xnat-extract.py'] + list(args)
+    try:
+        xnat_extract.main()
+    finally:
+        sys.argv = argv
+    return sorted(EXPORTED)
+
+
+def read_manifest(path):
+    manifest = pd.read_csv(path, dtype={'series': str, 'format': str})
+    return sorted(manifest.fillna('').itertuples(index=False))
+
+
+def test_export_plan():
+    exportinfo = pd.read_table(make_exportinfo(), sep='\s*', engine='python')
+    plan = xnat_extract.get_export_plan(exportinfo)
+
+    eq_(plan.formats, ['nii', 'dcm'])
+    eq_(plan.tag_formats, {'T1': ['nii', 'dcm'], 'RST': ['nii']})
+    eq_(plan.tagmap('Sag-T1-BRAVO'), 'T1')
+
+
+def test_export_series_follows_plan_formats():
+    exportinfo = pd.read_table(make_exportinfo(), sep='\s*', engine='python')
+    plan = xnat_extract.get_export_plan(exportinfo)
+    header = {'SeriesDescription': 'Sag T1', 'SeriesNumber': 3}
+
+    jobs = xnat_extract.export_series(plan, '/src', header, 'SPN01_CMH_0001_01',
+            'SPN01_CMH_0001_01_01', os.path.join(TMPDIR, 'plan'), [])
+
+    stem = 'SPN01_CMH_0001_01_01_T1_03_Sag-T1'
+    eq_([(fmt, src, stem) for fmt, src, outputdir, stem in jobs],
+        [('nii', '/src', stem), ('dcm', '/src', stem)])
+
+
+def test_run_export_jobs_in_order():
+    delays = {'a': 0.2, 'b': 0.0, 'c': 0.1}
+
+    def export(seriesdir, outputdir, stem):
+        time.sleep(delays[stem])
+        if stem == 'c':
+            raise IOError('disk full')
+        return None if stem == 'b' else 0
+
+    xnat_extract.exporters['slow'] = export
+    try:
+        jobs = [('slow', '/src', '/out', stem) for stem in 'abc']
+        results = xnat_extract.dm.utils.parallel_map(
+            xnat_extract.run_export_job, jobs, 3)
+    finally:
+        del xnat_extract.exporters['slow']
+
+    # results come back in job order, whichever finishes first
+    eq_([job for job, status, seconds in results], jobs)
+    eq_([status for job, status, seconds in results],
+        ['exported', 'skipped', 'failed'])
+    ok_(results[0][2] >= 0.2)
+
+
+def test_manifest():
+    archive = make_archive('SPN01_CMH_0001_01_01',
+                           [(1, 'Sag T1'), (2, 'Resting State'), (3, 'Loc')])
+    manifest = os.path.join(TMPDIR, 'manifest.csv')
+
+    exported = run_main('--exportinfo', make_exportinfo(),
+                        '--datadir', os.path.join(TMPDIR, 'data'),
+                        '--manifest', manifest, archive)
+
+    t1 = 'SPN01_CMH_0001_01_01_T1_01_Sag-T1'
+    rst = 'SPN01_CMH_0001_01_01_RST_02_Resting-State'
+    eq_(exported, [('dcm', t1), ('nii', rst), ('nii', t1)])
+
+    eq_(open(manifest).readline().strip(),
+        'archive,series,format,status,seconds')
+    eq_([row[:4] for row in read_manifest(manifest)],
+        [(archive, rst, 'nii', 'exported'),
+         (archive, t1, 'dcm', 'exported'),
+         (archive, t1, 'nii', 'exported')])
+
+
+def test_ledger_skips_unchanged_archive():
+    archive = make_archive('SPN01_CMH_0002_01_01',
+                           [(1, 'Sag T1'), (2, 'Resting State')])
+    ledger = os.path.join(TMPDIR, 'skip.db')
+    manifest = os.path.join(TMPDIR, 'skip.csv')
+    args = ['--exportinfo', make_exportinfo(), '--ledger', ledger,
+            '--datadir', os.path.join(TMPDIR, 'data'), '--manifest', manifest,
+            archive]
+
+    eq_(len(run_main(*args)), 3)
+    eq_(run_main(*args), [])
+    eq_([row[:4] for row in read_manifest(manifest)],
+        [(archive, '', '', 'unchanged')])
+
+
+def test_ledger_rescans_rewritten_file():
+    archive = make_archive('SPN01_CMH_0003_01_01',
+                           [(1, 'Sag T1'), (2, 'Resting State')])
+    ledger = os.path.join(TMPDIR, 'rescan.db')
+    args = ['--exportinfo', make_exportinfo(), '--ledger', ledger,
+            '--datadir', os.path.join(TMPDIR, 'data'), archive]
+    eq_(len(run_main(*args)), 3)
+
+    # rewrite a dicom in place: same name and size, the folders untouched
+    dicomdir = os.path.join(archive, 'SCANS', '2', 'DICOM')
+    dirstat = os.stat(dicomdir)
+    path = os.path.join(dicomdir, '0.dcm')
+    stat = os.stat(path)
+    data = open(path, 'rb').read()
+    with open(path, 'r+b') as f:
+        f.write(data)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 0.25))
+    os.utime(dicomdir, (dirstat.st_atime, dirstat.st_mtime))
+    eq_(os.stat(path).st_size, stat.st_size)
+
+    eq_(run_main(*args),
+        [('nii', 'SPN01_CMH_0003_01_01_RST_02_Resting-State')])
+    eq_(run_main(*args), [])
+
+# vim: set ts=4 sw=4 :
@@ -0,0 +1,202 @@
+from nose.tools import *
+import BaseHTTPServer
+import SocketServer
+import importlib
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+
+xnat_upload = importlib.import_module('bin.xnat-upload')
+
+TMPDIR = None
+SERVER = None
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Records the requests made to it. The first len(failures) POSTs are
+    answered with those status codes, the rest with 200."""
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, failures=()):
+        self.requests = []
+        self.failures = list(failures)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_PUT(self):
+        self.respond(201)
+
+    def do_POST(self):
+        status = 200
+        with self.server.lock:
+            if self.server.failures:
+                status = self.server.failures.pop(0)
+        self.respond(status)
+
+    def respond(self, status):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = self.rfile.read(length)
+        with self.server.lock:
+            self.server.requests.append((self.command, self.path, body,
+                                         status))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def setup():
+    global TMPDIR, SERVER
+    TMPDIR = tempfile.mkdtemp(prefix='test-xnat-upload-')
+    SERVER = StubServer()
+    thread = threading.Thread(target=SERVER.serve_forever)
+    thread.daemon = True
+    thread.start()
+    xnat_upload.RETRY_BACKOFF = 0
+
+
+def teardown():
+    SERVER.shutdown()
+    SERVER.server_close()
+    shutil.rmtree(TMPDIR)
+
+
+def make_archive(scanid):
+    archive = os.path.join(TMPDIR, scanid + '.zip')
+    zf = zipfile.ZipFile(archive, 'w')
+    zf.writestr(scanid + '/1/IM-0001.dcm', 'dicom')
+    zf.writestr(scanid + '/1/IM-0002', '\0' * 128 + 'DICM' + 'dicom')
+    zf.writestr(scanid + '/notes.txt', 'tech notes')
+    zf.writestr(scanid + '/behav/log.csv', 'a,b\n1,2\n')
+    zf.close()
+    return archive
+
+
+def test_upload_archive():
+    SERVER.reset()
+    archive = make_archive('SPN01_CMH_0001_01_01')
+    session = xnat_upload.get_session(('user', 'pass'), 2)
+
+    xnat_upload.upload_archive(session, SERVER.url, 'SPN01', archive, jobs=2)
+
+    methods = [(method, path.split('?')[0]) for method, path, body, status
+               in SERVER.requests]
+    eq_(methods[:2], [
+        ('PUT', '/REST/projects/SPN01/subjects/SPN01_CMH_0001_01_01'),
+        ('POST', '/data/services/import')])
+    eq_(sorted(methods[2:]), [
+        ('POST', '/data/archive/projects/SPN01/subjects/SPN01_CMH_0001_01_01'
+                 '/experiments/SPN01_CMH_0001_01_01/files/'
+                 'SPN01_CMH_0001_01_01/behav/log.csv'),
+        ('POST', '/data/archive/projects/SPN01/subjects/SPN01_CMH_0001_01_01'
+                 '/experiments/SPN01_CMH_0001_01_01/files/'
+                 'SPN01_CMH_0001_01_01/notes.txt')])
+
+    eq_(SERVER.requests[1][2], open(archive, 'rb').read())
+    bodies = sorted(body for method, path, body, status in SERVER.requests[2:])
+    eq_(bodies, ['a,b\n1,2\n', 'tech notes'])
+
+
+def test_post_file_retries():
+    SERVER.reset(failures=[504, 503])
+    path = os.path.join(TMPDIR, 'body.txt')
+    open(path, 'w').write('body')
+    session = xnat_upload.get_session(('user', 'pass'))
+
+    r = xnat_upload.post_file(
+        session, SERVER.url + '/upload',
+        lambda: xnat_upload.ProgressReader(open(path, 'rb'), 4), 'body.txt')
+
+    eq_(r.status_code, 200)
+    eq_([(body, status) for method, path, body, status in SERVER.requests],
+        [('body', 504), ('body', 503), ('body', 200)])
+
+
+def test_post_file_gives_up():
+    SERVER.reset(failures=[504, 504])
+    path = os.path.join(TMPDIR, 'body.txt')
+    open(path, 'w').write('body')
+    session = xnat_upload.get_session(('user', 'pass'))
+
+    r = xnat_upload.post_file(
+        session, SERVER.url + '/upload',
+        lambda: xnat_upload.ProgressReader(open(path, 'rb'), 4), 'body.txt',
+        retries=1)
+
+    eq_(r.status_code, 504)
+    eq_(len(SERVER.requests), 2)
+
+
+def test_journal_roundtrip():
+    journal = os.path.join(TMPDIR, 'roundtrip.journal')
+    archive = make_archive('SPN01_CMH_0002_01_01')
+    eq_(xnat_upload.read_journal(journal), set())
+
+    xnat_upload.append_journal(journal, archive)
+    open(journal, 'a').write('{"archive": "/interrupted')
+    eq_(xnat_upload.read_journal(journal),
+        set([xnat_upload.journal_key(archive)]))
+
+    # a batch resumed after the interruption records on a line of its own
+    resumed = make_archive('SPN01_CMH_0006_01_01')
+    xnat_upload.append_journal(journal, resumed)
+    eq_(xnat_upload.read_journal(journal),
+        set([xnat_upload.journal_key(archive),
+             xnat_upload.journal_key(resumed)]))
+
+
+def test_upload_archives_resumes():
+    journal = os.path.join(TMPDIR, 'batch.journal')
+    done = make_archive('SPN01_CMH_0003_01_01')
+    todo = [make_archive('SPN01_CMH_0004_01_01'),
+            make_archive('SPN01_CMH_0005_01_01')]
+    xnat_upload.append_journal(journal, done)
+
+    SERVER.reset(failures=[404])
+    session = xnat_upload.get_session(('user', 'pass'), 4)
+    failures = xnat_upload.upload_archives(
+        session, SERVER.url, 'SPN01', [done] + todo + ['not-a-scanid.zip'],
+        parallel=2, journal=journal)
+
+    imports = [path for method, path, body, status in SERVER.requests
+               if path.startswith('/data/services/import')]
+    eq_(len(imports), 2)
+    ok_(not any('0003' in path for path in imports))
+
+    # one import failed, and the bad scan ID
+    eq_(failures, 2)
+    eq_(len(xnat_upload.read_journal(journal)), 2)
+
+
+def test_upload_archives_missing_archive():
+    archive = make_archive('SPN01_CMH_0007_01_01')
+    missing = os.path.join(TMPDIR, 'SPN01_CMH_0008_01_01.zip')
+    session = xnat_upload.get_session(('user', 'pass'))
+
+    for journal in [None, os.path.join(TMPDIR, 'missing.journal')]:
+        SERVER.reset()
+        failures = xnat_upload.upload_archives(
+            session, SERVER.url, 'SPN01', [missing, archive], journal=journal)
+
+        eq_(failures, 1)
+        imports = [path for method, path, body, status in SERVER.requests
+                   if path.startswith('/data/services/import')]
+        eq_(len(imports), 1)
+        ok_('0007' in imports[0])
+
+# vim: set ts=4 sw=4 :